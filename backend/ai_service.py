@@ -58,7 +58,8 @@ class AIService:
         Process an attached file using the document processor.
         
         Args:
-            attachment: Dict with 'data', 'name', 'type' keys
+            attachment: Dict with 'name', 'type' and either 'file' (an open
+                binary file, e.g. a multipart upload) or 'data' (base64)
             
         Returns:
             Tuple of (extracted_text, success, error_message)
@@ -69,26 +70,37 @@ class AIService:
         if not self.doc_processor:
             return (None, False, "Document processor not available")
         
-        file_data = attachment.get('data', '')
         file_name = attachment.get('name', 'unknown')
         
         print(f"📄 Processing file: {file_name}")
         
         try:
             # Process the document
-            result: ProcessedDocument = self.doc_processor.process_base64(
-                base64_data=file_data,
-                filename=file_name
-            )
+            if attachment.get('file') is not None:
+                result: ProcessedDocument = self.doc_processor.process_file(
+                    attachment['file'],
+                    filename=file_name,
+                    max_chars=self.max_doc_length
+                )
+            else:
+                result: ProcessedDocument = self.doc_processor.process_base64(
+                    base64_data=attachment.get('data', ''),
+                    filename=file_name,
+                    max_chars=self.max_doc_length
+                )
             
             if not result.success:
                 return (None, False, result.error or "Failed to process document")
             
-            # Truncate if too long
+            # Extraction stopped at max_doc_length; say how much was read
             text = result.text
-            if len(text) > self.max_doc_length:
-                text = text[:self.max_doc_length]
-                text += f"\n\n[... Document truncated. Original length: {len(result.text)} characters ...]"
+            if result.truncated:
+                pages_extracted = result.metadata.get('pages_extracted')
+                if pages_extracted is not None:
+                    text += (f"\n\n[... Document truncated: content from the first {pages_extracted} "
+                             f"of {result.page_count} pages ...]")
+                else:
+                    text += f"\n\n[... Document truncated to the first {len(text)} characters ...]"
             
             # Build context with metadata
             context_parts = [
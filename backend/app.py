@@ -1,12 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify, stream_with_context, g
 from flask_cors import CORS
 from ai_service import ai_service
 import database
+from password_hasher import password_hasher, HashingBusy
+from session_tokens import create_session_tokens
+from rate_limiter import create_rate_limiter, RateLimited
+from extraction_cache import extraction_cache
+from idempotency import create_idempotency_store, request_fingerprint, IdempotencyConflict, MAX_KEY_LENGTH
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import RequestEntityTooLarge
+from functools import wraps
 import os
+import io
 import sys
 import json
+import multiprocessing
+import base64
+import tempfile
 import traceback
-import sqlite3  # ADD THIS IMPORT
 import logging  # ADD THIS IMPORT
 
 # Force UTF-8 encoding for stdout to handle Twi characters
@@ -15,16 +26,303 @@ if sys.platform == 'win32':
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
+class AppRequest(Request):
+    """Request whose MAX_CONTENT_LENGTH cap skips endpoints that stream their body"""
+    # These read the body line by line and bound each line themselves
+    uncapped_endpoints = {'import_chats'}
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in self.uncapped_endpoints:
+            return None
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = AppRequest
 # Enable CORS for all origins (you can restrict this in production)
 CORS(app)  # Allow all origins to support file:// access
 
+# Variables set by hosting platforms that route every request through one proxy
+PLATFORM_PROXY_VARS = ('RENDER', 'DYNO')  # Render, Heroku
+
+def trusted_proxy_count(environ=os.environ):
+    """TRUSTED_PROXIES if set, else 1 on a known proxying platform and 0 elsewhere"""
+    if environ.get('TRUSTED_PROXIES'):
+        return int(environ['TRUSTED_PROXIES'])
+    return 1 if any(environ.get(name) for name in PLATFORM_PROXY_VARS) else 0
+
+# Number of reverse proxies in front of the app; see the rate limiter below
+TRUSTED_PROXIES = trusted_proxy_count()
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Define DATABASE_PATH here (must match database.py)
-DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'users.db')
+# Database location is owned by database.py
+DATABASE_PATH = database.DATABASE_PATH
+
+# Reject requests that identify the user only by a user_id parameter
+# (older clients); by default they are still accepted
+REQUIRE_SESSION_TOKEN = os.environ.get('REQUIRE_SESSION_TOKEN', '').lower() in ('1', 'true', 'yes')
+
+# Largest number of chats accepted by a single /api/chats/sync request
+MAX_SYNC_BATCH = 1000
+
+# Page sizes for /api/chats/list
+DEFAULT_LIST_LIMIT = 50
+MAX_LIST_LIMIT = 200
+
+# Longest NDJSON line accepted by /api/chats/import; bounds memory per line
+MAX_IMPORT_LINE_BYTES = 16 * 1024 * 1024
+
+# Page sizes for /api/chats/search
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# Largest file accepted by /api/upload and /api/analyze
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+# Raw upload bodies stay in memory up to this size, then spill to a temp file
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+
+# Werkzeug refuses larger bodies (413) even when no Content-Length is sent;
+# the extra 1 MB is room for the other form fields next to the file
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
+
+def wants_archived():
+    """True when the request asks for archived chats too (?archived=1)"""
+    return request.args.get('archived', '').lower() in ('1', 'true', 'yes')
+
+def encode_cursor(position):
+    """Turn a (updated_at, chat_id) position into an opaque cursor string"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError for malformed cursors"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(position, list) or len(position) != 2:
+        raise ValueError("Invalid cursor")
+    return position
+
+def hashing_busy_response(e):
+    """429 reply for auth requests turned away by the password hashing pool"""
+    response = jsonify({"success": False, "error": str(e)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def rate_limited_response(e):
+    """429 reply for requests over their rate limit or shed under load"""
+    response = jsonify({"success": False, "error": str(e), "response": str(e)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def current_session():
+    """Claims of the request's Bearer session token, or None if none or invalid"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    return session_tokens.verify(token.strip())
+
+def require_user(view):
+    """
+    Resolve the calling user into g.user_id before the view runs.
+    A Bearer session token is verified in memory, with no database lookup.
+    Clients that only send user_id are accepted unless REQUIRE_SESSION_TOKEN is set.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        claimed = request.args.get('user_id')
+        if claimed is None:
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                claimed = data.get('user_id')
+
+        if request.headers.get('Authorization'):
+            session = current_session()
+            if session is None:
+                return jsonify({
+                    "success": False,
+                    "error": "Session expired, please sign in again"
+                }), 401
+            if claimed is not None and str(claimed) != str(session['uid']):
+                return jsonify({
+                    "success": False,
+                    "error": "Session does not belong to this user"
+                }), 403
+            g.user_id = session['uid']
+        elif REQUIRE_SESSION_TOKEN:
+            return jsonify({
+                "success": False,
+                "error": "Sign in required"
+            }), 401
+        elif claimed is None:
+            return jsonify({
+                "success": False,
+                "error": "Missing user_id"
+            }), 400
+        else:
+            g.user_id = claimed
+        return view(*args, **kwargs)
+    return wrapper
+
+def client_identity():
+    """
+    Key for per-client state: the signed-in user, else the IP address.
+    A claimed user_id is not trusted here, since anyone can send one.
+    """
+    session = current_session() if request.headers.get('Authorization') else None
+    return f"user:{session['uid']}" if session else f"ip:{request.remote_addr}"
+
+def rate_limited(endpoint_class):
+    """
+    Admit the request through the limiter's token bucket for endpoint_class
+    and its in-flight cap, or answer 429.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            client = client_identity()
+            try:
+                slot = rate_limiter.acquire(endpoint_class, client)
+            except RateLimited as e:
+                print(f"🚦 {endpoint_class} limited for {client}: {e}")
+                return rate_limited_response(e)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                rate_limiter.release(endpoint_class, slot)
+        return wrapper
+    return decorator
+
+def upload_too_large():
+    """True if the request declares a body over MAX_UPLOAD_BYTES"""
+    return (request.content_length or 0) > MAX_UPLOAD_BYTES
+
+def spool_request_body(stream):
+    """
+    Copy a raw request body into a temporary file in chunks; it stays in
+    memory only while smaller than UPLOAD_SPOOL_BYTES.
+    Raises ValueError past MAX_UPLOAD_BYTES (bodies without Content-Length).
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    total = 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > MAX_UPLOAD_BYTES:
+            spooled.close()
+            raise ValueError("File is too large")
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+def request_upload():
+    """
+    The file sent with a multipart request (field "file") or as a raw
+    binary body, as (binary file, filename), or (None, None) if there is
+    none. Multipart parts are spooled to disk by the form parser and raw
+    bodies by spool_request_body, so the file is never held in memory whole.
+    A raw body names its file with ?filename= or an X-Filename header.
+    """
+    if request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        upload = request.files.get('file')
+        if upload is None:
+            return None, None
+        return upload.stream, upload.filename or 'unknown'
+    if not request.content_length and not request.headers.get('Transfer-Encoding'):
+        return None, None
+    filename = request.args.get('filename') or request.headers.get('X-Filename') or 'unknown'
+    return spool_request_body(request.stream), filename
+
+def request_body_parts():
+    """Request body to fingerprint, with uploaded files read back in chunks"""
+    if request.mimetype != 'multipart/form-data':
+        yield request.get_data(cache=True)
+        return
+    yield json.dumps(sorted(request.form.items(multi=True))).encode('utf-8')
+    for field_name, upload in sorted(request.files.items(multi=True)):
+        yield f"\n{field_name}:{upload.filename}\n".encode('utf-8')
+        upload.stream.seek(0)
+        for chunk in iter(lambda: upload.stream.read(64 * 1024), b''):
+            yield chunk
+        upload.stream.seek(0)
+
+def idempotent(view):
+    """
+    Honour an Idempotency-Key header: the first request with a key runs,
+    duplicates wait for it and get its stored response back. Server errors
+    and 429s are not stored, so a retry with the same key runs again.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key', '').strip()
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({
+                "success": False,
+                "error": f"Idempotency-Key is longer than {MAX_KEY_LENGTH} characters"
+            }), 400
+
+        store_key = f"{request.path}:{client_identity()}:{key}"
+        fingerprint = request_fingerprint(request.method, request.path, request_body_parts())
+        try:
+            stored = idempotency_store.begin(store_key, fingerprint)
+        except IdempotencyConflict as e:
+            response = jsonify({"success": False, "error": str(e)})
+            response.status_code = e.status
+            if e.retry_after:
+                response.headers['Retry-After'] = str(e.retry_after)
+            return response
+
+        if stored is not None:
+            status, headers, body = stored
+            response = app.response_class(body, status=status, headers=headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.abandon(store_key)
+            raise
+        if response.status_code >= 500 or response.status_code == 429 or response.is_streamed:
+            idempotency_store.abandon(store_key)
+        else:
+            idempotency_store.finish(store_key, response.status_code,
+                                     {'Content-Type': response.content_type}, response.get_data())
+        return response
+    return wrapper
+
+def read_your_writes(view):
+    """
+    Commit the caller's buffered chat saves before the view reads or changes chats.
+    If they cannot be committed yet (database locked), reads serve what is
+    already committed and writes are refused, so a save still queued can
+    never land on top of a newer change.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            database.flush_pending_saves(g.user_id)
+        except Exception as e:
+            if request.method != 'GET':
+                response = jsonify({"success": False, "error": "Earlier chat saves are still being written, please retry"})
+                response.status_code = 503
+                response.headers['Retry-After'] = str(int(database.WRITE_BEHIND_MAX_DELAY) + 1)
+                return response
+            print(f"⚠️ Pending saves of user {g.user_id} not committed, serving committed chats: {e}")
+        return view(*args, **kwargs)
+    return wrapper
 
 # Check database path
 print(f"Database path: {DATABASE_PATH}")
@@ -36,12 +334,36 @@ if db_dir and not os.path.exists(db_dir):
     os.makedirs(db_dir)
     print(f"Created database directory: {db_dir}")
 
-# Initialize database
+# The schema is migrated once when database.py is imported
+
+# Signed session tokens issued at login, revoked by password changes and account deletion
+session_tokens = create_session_tokens(DATABASE_PATH, database.get_token_generation)
+
+# Per-client budgets and concurrency caps for /api/analyze and /api/upload.
+# Anonymous clients are keyed by IP address (client_identity), taken from
+# the X-Forwarded-For entries added by the TRUSTED_PROXIES nearest proxies.
+# Too low and every anonymous user shares the proxy's bucket; too high and
+# clients can pick their own bucket by sending X-Forwarded-For themselves.
+# It defaults to 1 on Render and Heroku and to 0 elsewhere.
+rate_limiter = create_rate_limiter(DATABASE_PATH)
+
+# Cap password hashes across all workers with the limiter's shared slots
+password_hasher.use_shared_slots(rate_limiter.slots)
+
+# Stored responses for requests retried with an Idempotency-Key
+idempotency_store = create_idempotency_store(DATABASE_PATH)
+
+# The extraction cache's disk tier is shared by all workers
 try:
-    database.init_db()
-    print("Database initialized successfully")
+    extraction_cache.create_schema()
 except Exception as e:
-    print(f"Error initializing database: {e}")
+    print(f"⚠️ Extraction cache disk tier unavailable: {e}")
+
+# Start maintenance jobs (recompression, purging deleted chats, vacuum) off the request path.
+# Skipped in multiprocessing children (the PDF extraction pool), which
+# re-import this module when the app is started with `python app.py`.
+if multiprocessing.parent_process() is None:
+    database.jobs.start()
 
 @app.route('/')
 def home():
@@ -59,8 +381,8 @@ def home():
             "Cloud Chat Sync"
         ],
         "endpoints": {
-            "analyze": "/api/analyze (POST) - Chat with AI, supports file attachments",
-            "upload": "/api/upload (POST) - Upload and process documents",
+            "analyze": "/api/analyze (POST) - Chat with AI, supports file attachments and Idempotency-Key",
+            "upload": "/api/upload (POST) - Upload and process documents (multipart or raw body)",
             "supported-formats": "/api/supported-formats (GET) - List supported file formats",
             "register": "/api/register (POST) - Create account",
             "login": "/api/login (POST) - Sign in",
@@ -69,18 +391,37 @@ def home():
             "check-email": "/api/check-email (POST) - Check if email exists",
             "reset-password": "/api/reset-password (POST) - Reset password",
             "chats": {
-                "save": "/api/chats/save (POST)",
-                "load": "/api/chats/load (GET)",
+                "save": "/api/chats/save (POST) - Supports Idempotency-Key",
+                "sync": "/api/chats/sync (POST) - Save many chats in one request",
+                "append": "/api/chats/append (POST) - Add new messages to a chat",
+                "list": "/api/chats/list (GET) - Paginated chat titles without messages, archived=1 includes archived chats",
+                "messages": "/api/chats/messages (GET) - Messages of one chat",
+                "search": "/api/chats/search (GET) - Full-text search across your chats",
+                "load": "/api/chats/load (GET) - Pass since=<watermark> for changes only, archived=1 for archived chats",
+                "export": "/api/chats/export (GET) - All chats as NDJSON",
+                "import": "/api/chats/import (POST) - NDJSON body in the export format",
                 "delete": "/api/chats/delete (POST)",
                 "status": "/api/chats/status (GET)"
             },
+            "stats": "/api/stats (GET) - Users, chats, messages and bytes stored, purge and archive progress",
             "debug": {
                 "database": "/api/debug/database (GET)",
+                "auth": "/api/debug/auth (GET) - Password hashing queue and latency",
+                "limits": "/api/debug/limits (GET) - Rate limits, shed requests and idempotent replays",
+                "documents": "/api/debug/documents (GET) - Extraction cache hits, misses and size",
                 "ai": "/api/debug/ai (GET)"
             }
         }
     })
 
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(e):
+    # Bodies over MAX_CONTENT_LENGTH, e.g. read by a decorator before the view runs
+    return jsonify({
+        "success": False,
+        "error": f"Request is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+    }), 413
+
 # Add this error handler
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -108,35 +449,7 @@ def register():
                 "error": "Missing required fields (username, email, password)"
             }), 400
 
-        # Check if email already exists using database function
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE email = ?', (data['email'],))
-        existing_user = cursor.fetchone()
-        conn.close()
-        
-        if existing_user:
-            print(f"❌ Email already exists: {data['email']}")
-            return jsonify({
-                "success": False,
-                "error": "Email already registered"
-            }), 400
-
-        # Check if username already exists
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE username = ?', (data['username'],))
-        existing_username = cursor.fetchone()
-        conn.close()
-        
-        if existing_username:
-            print(f"❌ Username already exists: {data['username']}")
-            return jsonify({
-                "success": False,
-                "error": "Username already exists"
-            }), 400
-
-        # Create user using database function
+        # Duplicate emails and usernames are reported by create_user
         result = database.create_user(data['username'], data['email'], data['password'])
         print(f"✅ Create user result: {result}")
 
@@ -144,11 +457,14 @@ def register():
             return jsonify({
                 "success": True,
                 "message": "Registration successful!",
-                "user": result['user']
+                "user": result['user'],
+                "token": session_tokens.issue(result['user'])
             }), 201
         else:
             return jsonify(result), 400
 
+    except HashingBusy as e:
+        return hashing_busy_response(e)
     except Exception as e:
         print(f"❌ Error in register endpoint: {str(e)}")
         traceback.print_exc()
@@ -175,11 +491,14 @@ def login():
             return jsonify({
                 "success": True,
                 "message": "Login successful!",
-                "user": result['user']
+                "user": result['user'],
+                "token": session_tokens.issue(result['user'])
             }), 200
         else:
             return jsonify(result), 401
 
+    except HashingBusy as e:
+        return hashing_busy_response(e)
     except Exception as e:
         return jsonify({
             "success": False,
@@ -200,24 +519,35 @@ def update_profile():
                 "error": "Need to know which user to update (originalEmail required)"
             }), 400
 
+        # A recent sign-in stands in for the current password
+        session = current_session()
+        fresh = session_tokens.recently_authenticated(session)
+
         # Call database function to update user
         result = database.update_user_profile(
             original_email=data['originalEmail'],
             name=data.get('name'),
             new_email=data.get('newEmail'),
             current_password=data.get('currentPassword'),
-            new_password=data.get('newPassword')
+            new_password=data.get('newPassword'),
+            session_user_id=session['uid'] if fresh else None
         )
 
         if result['success']:
-            return jsonify({
+            response = {
                 "success": True,
                 "message": "Profile updated successfully!",
                 "user": result['user']
-            }), 200
+            }
+            # Reissue the session for the (possibly changed) email
+            if session and session['uid'] == result['user']['id']:
+                response['token'] = session_tokens.issue(result['user'], auth_time=session['auth'])
+            return jsonify(response), 200
         else:
             return jsonify(result), 400
 
+    except HashingBusy as e:
+        return hashing_busy_response(e)
     except Exception as e:
         print(f"❌ Error in update_profile: {str(e)}")
         return jsonify({
@@ -232,14 +562,21 @@ def delete_account():
         data = request.get_json()
         print(f"🗑️ Delete account request received for email: {data.get('email')}")
 
-        if not data or 'email' not in data or 'password' not in data:
+        session = current_session()
+        fresh = session_tokens.recently_authenticated(session)
+
+        if not data or 'email' not in data or ('password' not in data and not fresh):
             return jsonify({
                 "success": False,
                 "error": "Email and password are required"
             }), 400
 
         # Call database function to delete account
-        result = database.delete_user_account(data['email'], data['password'])
+        result = database.delete_user_account(
+            data['email'],
+            data.get('password'),
+            session_user_id=session['uid'] if fresh else None
+        )
 
         if result['success']:
             return jsonify({
@@ -249,6 +586,8 @@ def delete_account():
         else:
             return jsonify(result), 400
 
+    except HashingBusy as e:
+        return hashing_busy_response(e)
     except Exception as e:
         print(f"❌ Error in delete_account: {str(e)}")
         return jsonify({
@@ -309,6 +648,8 @@ def reset_password():
         else:
             return jsonify(result), 400
             
+    except HashingBusy as e:
+        return hashing_busy_response(e)
     except Exception as e:
         print(f"❌ Error in reset_password: {str(e)}")
         return jsonify({
@@ -317,20 +658,16 @@ def reset_password():
         }), 500
 
 @app.route('/api/chats/save', methods=['POST'])
+@require_user
+@idempotent
 def save_chat():
     """Save chat to cloud database"""
     try:
         data = request.get_json()
         
-        if not data or 'user_id' not in data:
-            return jsonify({
-                "success": False,
-                "error": "Missing user_id"
-            }), 400
-        
         # Call database function
         result = database.save_chat_to_cloud(
-            user_id=data['user_id'],
+            user_id=g.user_id,
             chat_data=data.get('chat_data', {})
         )
         
@@ -343,57 +680,319 @@ def save_chat():
             "error": str(e)
         }), 500
 
+@app.route('/api/chats/sync', methods=['POST'])
+@require_user
+@read_your_writes
+def sync_chats():
+    """Save a batch of chats to cloud database in one transaction"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'chats' not in data:
+            return jsonify({
+                "success": False,
+                "error": "Missing chats"
+            }), 400
+        
+        # Accept either a list of chats or the frontend's {chat_id: chat} map
+        chats = data['chats']
+        if isinstance(chats, dict):
+            chats = list(chats.values())
+        
+        if not isinstance(chats, list):
+            return jsonify({
+                "success": False,
+                "error": "chats must be a list or an object keyed by chat id"
+            }), 400
+        
+        if len(chats) > MAX_SYNC_BATCH:
+            return jsonify({
+                "success": False,
+                "error": f"Too many chats in one sync (max {MAX_SYNC_BATCH})"
+            }), 413
+        
+        result = database.sync_chats_to_cloud(user_id=g.user_id, chats=chats)
+        
+        return jsonify(result), (200 if result['success'] else 500)
+        
+    except Exception as e:
+        print(f"❌ Error in sync_chats: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/chats/append', methods=['POST'])
+@require_user
+@read_your_writes
+def append_chat():
+    """Append new messages to a cloud chat"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'chat_id' not in data:
+            return jsonify({
+                "success": False,
+                "error": "Missing chat_id"
+            }), 400
+        
+        messages = data.get('messages', [])
+        if not isinstance(messages, list):
+            return jsonify({
+                "success": False,
+                "error": "messages must be a list"
+            }), 400
+        
+        result = database.append_chat_messages(
+            user_id=g.user_id,
+            chat_id=data['chat_id'],
+            messages=messages,
+            expected_count=data.get('expected_count'),
+            title=data.get('title')
+        )
+        
+        if result['success']:
+            return jsonify(result)
+        return jsonify(result), (409 if result.get('conflict') else 500)
+        
+    except Exception as e:
+        print(f"❌ Error in append_chat: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
 @app.route('/api/chats/load', methods=['GET'])
+@require_user
+@read_your_writes
 def load_chats():
-    """Load user chats from cloud"""
+    """
+    Load user chats from cloud.
+    With a since watermark only chats changed at or after it are returned,
+    plus the ids of chats deleted since then. Full loads skip archived
+    chats unless archived=1 is passed.
+    """
+    try:
+        user_id = g.user_id
+        since = request.args.get('since')
+        
+        # Read the watermark before the data so no change can slip between them
+        watermark = database.get_last_sync(user_id)
+        etag = f"{user_id}-{watermark or 'empty'}"
+        
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
+        print(f"📥 Loading chats for user_id: {user_id}" + (f" since {since}" if since else ""))
+        
+        # Stored message JSON is streamed through without decoding it
+        body = database.stream_user_chats_json(user_id, since=since, watermark=watermark, include_archived=wants_archived())
+        response = app.response_class(stream_with_context(body), mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+        
+    except Exception as e:
+        print(f"❌ Error in load_chats: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/chats/list', methods=['GET'])
+@require_user
+@read_your_writes
+def list_chats():
+    """List a page of chat titles and dates for the sidebar"""
     try:
-        user_id = request.args.get('user_id')
+        user_id = g.user_id
         
-        if not user_id:
+        try:
+            limit = min(max(int(request.args.get('limit', DEFAULT_LIST_LIMIT)), 1), MAX_LIST_LIMIT)
+            cursor = request.args.get('cursor')
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
             return jsonify({
                 "success": False,
-                "error": "Missing user_id parameter"
+                "error": str(e)
             }), 400
         
-        print(f"📥 Loading chats for user_id: {user_id}")
+        chats, next_after = database.list_user_chats(user_id, limit, after, include_archived=wants_archived())
+        
+        return jsonify({
+            "success": True,
+            "chats": chats,
+            "next_cursor": encode_cursor(next_after) if next_after else None
+        })
+        
+    except Exception as e:
+        print(f"❌ Error in list_chats: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/chats/messages', methods=['GET'])
+@require_user
+@read_your_writes
+def chat_messages():
+    """Fetch the messages of one chat, optionally a range of them"""
+    try:
+        user_id = g.user_id
+        chat_id = request.args.get('chat_id')
+        
+        if not chat_id:
+            return jsonify({
+                "success": False,
+                "error": "Missing chat_id parameter"
+            }), 400
         
-        # Get chats from cloud
-        chats = database.get_user_chats_from_cloud(user_id)
-        print(f"📥 Found {len(chats)} chats in cloud")
+        try:
+            start = max(int(request.args.get('start', 0)), 0)
+            limit = request.args.get('limit')
+            limit = max(int(limit), 1) if limit is not None else None
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "error": "start and limit must be integers"
+            }), 400
         
-        # Debug: Print chat IDs
-        for chat_id, chat in chats.items():
-            print(f"  - Chat: {chat_id}, Title: {chat.get('title', 'No title')}, Messages: {len(chat.get('messages', []))}")
+        chat = database.get_chat_messages(user_id, chat_id, start, limit)
+        if chat is None:
+            return jsonify({
+                "success": False,
+                "error": "Chat not found"
+            }), 404
         
+        next_start = start + len(chat['messages'])
         return jsonify({
             "success": True,
-            "chats": chats
+            "chat": chat,
+            "start": start,
+            "next_start": next_start if next_start < chat['message_count'] else None
         })
         
     except Exception as e:
-        print(f"❌ Error in load_chats: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        print(f"❌ Error in chat_messages: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/chats/search', methods=['GET'])
+@require_user
+@read_your_writes
+def search_chats():
+    """Search a user's chat history and return ranked snippets"""
+    try:
+        user_id = g.user_id
+        query = request.args.get('q', '').strip()
+        
+        if not query:
+            return jsonify({
+                "success": False,
+                "error": "Missing q parameter"
+            }), 400
+        
+        try:
+            limit = min(max(int(request.args.get('limit', DEFAULT_SEARCH_LIMIT)), 1), MAX_SEARCH_LIMIT)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "error": "limit and offset must be integers"
+            }), 400
+        
+        results = database.search_user_chats(user_id, query, limit, offset)
+        
+        return jsonify({
+            "success": True,
+            "results": results,
+            "next_offset": offset + limit if len(results) == limit else None
+        })
+        
+    except Exception as e:
+        print(f"❌ Error in search_chats: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/chats/export', methods=['GET'])
+@require_user
+@read_your_writes
+def export_chats():
+    """Stream all of a user's chats as NDJSON (one chat or message per line)"""
+    try:
+        body = database.stream_user_chats_ndjson(g.user_id)
+        response = app.response_class(stream_with_context(body), mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = 'attachment; filename="chats.ndjson"'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+        
+    except Exception as e:
+        print(f"❌ Error in export_chats: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+def read_ndjson_lines(stream):
+    """Yield request body lines as they arrive, refusing overlong ones"""
+    if isinstance(stream, io.RawIOBase):
+        # werkzeug's LimitedStream would read each line a byte at a time
+        stream = io.BufferedReader(stream)
+    while True:
+        line = stream.readline(MAX_IMPORT_LINE_BYTES + 1)
+        if not line:
+            return
+        if len(line) > MAX_IMPORT_LINE_BYTES:
+            raise ValueError(f"Line longer than {MAX_IMPORT_LINE_BYTES} bytes")
+        yield line
+
+@app.route('/api/chats/import', methods=['POST'])
+@require_user
+@read_your_writes
+def import_chats():
+    """Import chats from an NDJSON body (the /api/chats/export format), streamed in batches"""
+    try:
+        if request.is_json:
+            return jsonify({
+                "success": False,
+                "error": "Send the chats as NDJSON with Content-Type: application/x-ndjson"
+            }), 415
+        
+        result = database.import_chats_ndjson(g.user_id, read_ndjson_lines(request.stream))
+        return jsonify(result), 200 if result['success'] else 400
+        
+    except Exception as e:
+        print(f"❌ Error in import_chats: {str(e)}")
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
 @app.route('/api/chats/delete', methods=['POST'])
+@require_user
+@read_your_writes
 def delete_chat():
     """Delete chat from cloud"""
     try:
         data = request.get_json()
         
-        if not data or 'user_id' not in data or 'chat_id' not in data:
+        if not data or 'chat_id' not in data:
             return jsonify({
                 "success": False,
-                "error": "Missing user_id or chat_id"
+                "error": "Missing chat_id"
             }), 400
         
         # Delete from cloud
         result = database.delete_chat_from_cloud(
-            user_id=data['user_id'],
+            user_id=g.user_id,
             chat_id=data['chat_id']
         )
         
@@ -407,27 +1006,56 @@ def delete_chat():
         }), 500
 
 @app.route('/api/upload', methods=['POST'])
+@rate_limited('upload')
 def upload_file():
-    """Dedicated file upload endpoint that returns processed document info"""
+    """
+    Dedicated file upload endpoint that returns processed document info.
+    Takes a multipart form (field "file") or a raw binary body with
+    ?filename=; a JSON body with a base64 "file" is still accepted.
+    """
     print("--- Incoming Request to /api/upload ---")
     try:
-        data = request.get_json()
-        if not data or 'file' not in data:
+        if upload_too_large():
             return jsonify({
                 "success": False,
-                "error": "No file data provided"
-            }), 400
-        
-        file_data = data.get('file', {})
+                "error": f"File is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+            }), 413
         
         # Import document processor
-        from document_processor import process_document_base64
+        from document_processor import process_document_base64, process_document_file
         
-        # Process the document
-        result = process_document_base64(
-            base64_data=file_data.get('data', ''),
-            filename=file_data.get('name', 'unknown')
-        )
+        if request.is_json:
+            data = request.get_json()
+            if not data or 'file' not in data:
+                return jsonify({
+                    "success": False,
+                    "error": "No file data provided"
+                }), 400
+            
+            file_data = data.get('file', {})
+            
+            # Process the document
+            result = process_document_base64(
+                base64_data=file_data.get('data', ''),
+                filename=file_data.get('name', 'unknown')
+            )
+        else:
+            try:
+                upload, filename = request_upload()
+            except ValueError as e:
+                return jsonify({
+                    "success": False,
+                    "error": str(e)
+                }), 413
+            if upload is None:
+                return jsonify({
+                    "success": False,
+                    "error": "No file data provided"
+                }), 400
+            
+            # Process the document straight from the spooled file
+            with upload:
+                result = process_document_file(upload, filename)
         
         if result.success:
             return jsonify({
@@ -447,6 +1075,11 @@ def upload_file():
                 "error": result.error or "Failed to process document"
             }), 400
             
+    except RequestEntityTooLarge:
+        return jsonify({
+            "success": False,
+            "error": f"File is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+        }), 413
     except Exception as e:
         print(f"❌ Error in upload_file: {str(e)}")
         traceback.print_exc()
@@ -488,27 +1121,59 @@ def supported_formats():
                 "features": ["full text extraction"]
             }
         },
-        "max_file_size_mb": 50,
+        "max_file_size_mb": MAX_UPLOAD_BYTES // (1024 * 1024),
         "max_text_length": 15000
     })
 
 
 @app.route('/api/analyze', methods=['POST'])
+@rate_limited('analyze')
+@idempotent
 def analyze_text():
     print("--- Incoming Request to /api/analyze ---")
     try:
-        data = request.get_json()
-        if not data:
-            print("Error: No JSON data received")
+        if upload_too_large():
             return jsonify({
-                "error": "No data received",
-                "response": "Please provide text to analyze",
+                "error": "File too large",
+                "response": f"Please attach a file smaller than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB",
                 "is_medical": False
-            }), 400
+            }), 413
+
+        if request.mimetype == 'multipart/form-data':
+            # The attachment arrives as a file part, spooled to disk by the
+            # form parser, instead of base64 inside the JSON body
+            text = request.form.get('text', '')
+            try:
+                conversation_history = json.loads(request.form.get('conversation_history') or '[]')
+            except ValueError:
+                conversation_history = None
+            if not isinstance(conversation_history, list):
+                return jsonify({
+                    "error": "Invalid conversation history",
+                    "response": "conversation_history must be a JSON array of messages",
+                    "is_medical": False
+                }), 400
+            upload = request.files.get('file')
+            attachment = None
+            if upload:
+                attachment = {
+                    'name': upload.filename or 'unknown',
+                    'type': upload.mimetype,
+                    'file': upload.stream
+                }
+        else:
+            data = request.get_json()
+            if not data:
+                print("Error: No JSON data received")
+                return jsonify({
+                    "error": "No data received",
+                    "response": "Please provide text to analyze",
+                    "is_medical": False
+                }), 400
 
-        text = data.get('text', '')
-        conversation_history = data.get('conversation_history', [])
-        attachment = data.get('attachment', None)
+            text = data.get('text', '')
+            conversation_history = data.get('conversation_history', [])
+            attachment = data.get('attachment', None)
         
         print(f"Processing text (length: {len(text)})")
         print(f"Conversation history: {len(conversation_history)} messages")
@@ -538,6 +1203,12 @@ def analyze_text():
         print(f"Analysis complete, returning result")
         return jsonify(result)
 
+    except RequestEntityTooLarge:
+        return jsonify({
+            "error": "File too large",
+            "response": f"Please attach a file smaller than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB",
+            "is_medical": False
+        }), 413
     except Exception as e:
         print(f"An error occurred when processing: {str(e)}")
         print(traceback.format_exc())
@@ -574,48 +1245,13 @@ def debug_ai():
 def debug_database():
     """Debug endpoint to check database status"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Check if tables exist
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = cursor.fetchall()
-        
-        # Check users table structure
-        users_count = 0
-        users_structure = []
-        table_names = [t[0] for t in tables]
-        
-        if 'users' in table_names:
-            cursor.execute("SELECT COUNT(*) FROM users")
-            users_count = cursor.fetchone()[0]
-            
-            cursor.execute("PRAGMA table_info(users)")
-            users_structure = cursor.fetchall()
-        
-        # Check user_chats table
-        user_chats_count = 0
-        if 'user_chats' in table_names:
-            cursor.execute("SELECT COUNT(*) FROM user_chats")
-            user_chats_count = cursor.fetchone()[0]
-        
-        # Check cloud_chats table
-        cloud_chats_count = 0
-        if 'cloud_chats' in table_names:
-            cursor.execute("SELECT COUNT(*) FROM cloud_chats")
-            cloud_chats_count = cursor.fetchone()[0]
-        
-        conn.close()
+        info = database.get_database_info()
         
         return jsonify({
             "success": True,
             "database_path": DATABASE_PATH,
             "database_exists": os.path.exists(DATABASE_PATH),
-            "tables": table_names,
-            "users_count": users_count,
-            "user_chats_count": user_chats_count,
-            "cloud_chats_count": cloud_chats_count,
-            "users_structure": [dict(zip(['cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'], row)) for row in users_structure]
+            **info
         })
         
     except Exception as e:
@@ -625,34 +1261,63 @@ def debug_database():
             "error": str(e)
         }), 500
 
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """Storage totals from the counter tables plus purge and archive progress; cheap enough for monitoring to poll"""
+    try:
+        return jsonify({
+            "success": True,
+            **database.get_stats(),
+            "recheck": database.get_recheck_status(),
+            "cleanup": database.get_cleanup_progress()
+        })
+        
+    except Exception as e:
+        print(f"❌ Error in stats: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/debug/auth', methods=['GET'])
+def debug_auth():
+    """Password hashing pool queue depth and latency"""
+    return jsonify({
+        "success": True,
+        "password_hashing": password_hasher.stats()
+    })
+
+@app.route('/api/debug/limits', methods=['GET'])
+def debug_limits():
+    """Rate limit budgets, this worker's admission counters and idempotent replays"""
+    return jsonify({
+        "success": True,
+        "rate_limits": rate_limiter.stats(),
+        "idempotency": idempotency_store.stats()
+    })
+
+@app.route('/api/debug/documents', methods=['GET'])
+def debug_documents():
+    """Document extraction cache counters (this worker) and tier sizes"""
+    return jsonify({
+        "success": True,
+        "extraction_cache": extraction_cache.stats()
+    })
+
 @app.route('/api/chats/status', methods=['GET'])
+@require_user
+@read_your_writes
 def chat_status():
     """Check chat sync status"""
     try:
-        user_id = request.args.get('user_id')
-        
-        if not user_id:
-            return jsonify({
-                "success": False,
-                "error": "Missing user_id parameter"
-            }), 400
-        
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
         # Get last sync time
-        cursor.execute('''
-            SELECT MAX(updated_at) FROM cloud_chats 
-            WHERE user_id = ?
-        ''', (user_id,))
-        
-        last_sync = cursor.fetchone()[0]
-        conn.close()
+        last_sync = database.get_last_sync(g.user_id)
         
         return jsonify({
             "success": True,
             "lastSync": last_sync,
-            "hasCloudData": last_sync is not None
+            "hasCloudData": last_sync is not None,
+            "totals": database.get_user_stats(g.user_id)
         })
         
     except Exception as e:
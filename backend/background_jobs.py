@@ -0,0 +1,124 @@
+"""
+Background Jobs Module
+Runs periodic maintenance work off the request path.
+
+Jobs run on a single daemon thread per process. When several gunicorn
+workers share a database, an advisory lock file makes sure only one of
+them runs the jobs at a time.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import time
+import threading
+import traceback
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+
+@dataclass
+class Job:
+    """A registered periodic job"""
+    name: str
+    func: Callable[[], bool]  # Returns True when there is more work to do right away
+    interval: float  # Seconds between runs when idle
+    next_run: float = 0.0
+    runs: int = 0
+    last_error: Optional[str] = None
+
+
+class JobRunner:
+    """
+    Runs registered jobs on one daemon thread.
+    A job that reports more pending work is rescheduled immediately,
+    so large backlogs drain in small batches without starving requests.
+    """
+
+    def __init__(self, lock_path: str, tick: float = 1.0):
+        self.lock_path = lock_path
+        self.tick = tick
+        self.jobs: Dict[str, Job] = {}
+        self._thread = None
+        self._thread_pid = None
+        self._stop = threading.Event()
+        self._lock_file = None
+        self._lock = threading.Lock()
+
+    def register(self, name: str, func: Callable[[], bool], interval: float):
+        """Register (or replace) a job that runs every interval seconds"""
+        with self._lock:
+            self.jobs[name] = Job(name=name, func=func, interval=interval)
+
+    def start(self):
+        """Start the job thread if it is not already running in this process"""
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._thread_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='background-jobs', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Ask the job thread to exit after the current job"""
+        self._stop.set()
+
+    def status(self) -> List[dict]:
+        """Snapshot of every job for stats endpoints"""
+        with self._lock:
+            return [{
+                'name': job.name,
+                'runs': job.runs,
+                'interval': job.interval,
+                'last_error': job.last_error,
+            } for job in self.jobs.values()]
+
+    def run_pending(self) -> bool:
+        """Run every job that is due. Returns True if any job has more work."""
+        busy = False
+        now = time.monotonic()
+        with self._lock:
+            due = [job for job in self.jobs.values() if job.next_run <= now]
+
+        for job in due:
+            try:
+                more = bool(job.func())
+                job.last_error = None
+            except Exception as e:
+                more = False
+                job.last_error = str(e)
+                print(f"❌ Background job {job.name} failed: {e}")
+                traceback.print_exc()
+            job.runs += 1
+            job.next_run = time.monotonic() + (0 if more else job.interval)
+            busy = busy or more
+        return busy
+
+    def _acquire_leadership(self) -> bool:
+        """Take the cross-process lock; only its holder runs jobs"""
+        if not FCNTL_AVAILABLE:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._acquire_leadership():
+                # Another worker runs the jobs; check again later in case it exits
+                self._stop.wait(self.tick * 30)
+                continue
+            busy = self.run_pending()
+            if not busy:
+                self._stop.wait(self.tick)
@@ -0,0 +1,119 @@
+"""
+Benchmark: full-text chat search latency and indexing cost on save.
+
+Loads a synthetic history of several thousand messages per user, then
+reports /api/chats/search query latency and how much the FTS5 index
+maintenance adds to chat saves (the same saves are timed with index
+maintenance switched off).
+
+Usage:
+    python benchmarks/bench_chat_search.py [--users 20] [--messages 5000]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_search_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'search.db')
+
+import database  # noqa: E402
+import chat_search  # noqa: E402
+
+MEDICAL_TERMS = (
+    "fever headache malaria typhoid paracetamol ibuprofen dosage blood pressure "
+    "hypertension diabetes insulin metformin cholesterol asthma inhaler allergy "
+    "antibiotic infection cough chest pain rash vaccine pregnancy nausea fatigue"
+).split()
+
+# Plain-language filler drawn from a large vocabulary, so medical terms are
+# as sparse as they are in real conversations
+FILLER = [f"w{n}" for n in range(20000)]
+
+
+def make_words(rng, count):
+    return ' '.join(
+        rng.choice(MEDICAL_TERMS) if rng.random() < 0.05 else FILLER[int(rng.paretovariate(1.1)) % len(FILLER)]
+        for _ in range(count)
+    )
+
+
+QUERIES = ["malaria", "blood pressure", "metformin dosage", "chest pain", "vacc", "insulin diabetes"]
+
+
+def make_chats(rng, messages_per_user, chats_per_user=50):
+    per_chat = messages_per_user // chats_per_user
+    return [{
+        'id': f'chat_{c}',
+        'title': f'Consultation {c}',
+        'messages': [{
+            'role': 'user' if m % 2 == 0 else 'ai',
+            'content': make_words(rng, rng.randint(10, 80))
+        } for m in range(per_chat)]
+    } for c in range(chats_per_user)]
+
+
+def time_saves(user_ids, corpora):
+    start = time.perf_counter()
+    messages = 0
+    for user_id, chats in zip(user_ids, corpora):
+        database.sync_chats_to_cloud(user_id, chats)
+        messages += sum(len(chat['messages']) for chat in chats)
+    return messages / (time.perf_counter() - start)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(len(values) * fraction) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5000, help='messages per user')
+    parser.add_argument('--searches', type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    corpora = [make_chats(rng, args.messages) for _ in range(args.users)]
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        # Same saves without index maintenance, into separate user ids
+        real_index = chat_search.index_messages
+        chat_search.index_messages = lambda *a, **k: None
+        try:
+            plain_rate = time_saves(range(10001, 10001 + args.users), corpora)
+        finally:
+            chat_search.index_messages = real_index
+        indexed_rate = time_saves(range(1, args.users + 1), corpora)
+    finally:
+        sys.stdout = real_stdout
+
+    timings = []
+    for i in range(args.searches):
+        user_id = rng.randint(1, args.users)
+        query = QUERIES[i % len(QUERIES)]
+        start = time.perf_counter()
+        database.search_user_chats(user_id, query, limit=20)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    print(f"corpus: {args.users} users x {args.messages} messages")
+    print(f"save throughput without index: {plain_rate:>10.0f} messages/s")
+    print(f"save throughput with index:    {indexed_rate:>10.0f} messages/s "
+          f"({(plain_rate / indexed_rate - 1) * 100:.0f}% indexing overhead)")
+    print(f"search latency: p50 {percentile(timings, 0.5):.2f} ms, "
+          f"p95 {percentile(timings, 0.95):.2f} ms, max {max(timings):.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark: shared WAL connections vs. connect-per-call SQLite access.
+
+Measures requests/sec for the login lookup and chat save paths, once with the
+legacy behaviour (open, query, commit, close on every call in rollback-journal
+mode) and once through database.py's shared connection layer.
+
+Usage:
+    python benchmarks/bench_db_connections.py [--ops 2000] [--threads 1 4]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A one-iteration hash keeps the KDF from drowning out the database cost
+CHEAP_METHOD = 'pbkdf2:sha256:1'
+
+# Point database.py at a scratch file before it initializes. Logins must not
+# upgrade the cheap hash, and saves must commit instead of being buffered
+_tmpdir = tempfile.mkdtemp(prefix='bench_db_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'pooled.db')
+os.environ['PASSWORD_HASH_METHOD'] = CHEAP_METHOD
+os.environ['WRITE_BEHIND'] = 'off'
+
+import database  # noqa: E402
+from werkzeug.security import generate_password_hash, check_password_hash  # noqa: E402
+
+LEGACY_PATH = os.path.join(_tmpdir, 'legacy.db')
+
+CHEAP_HASH = generate_password_hash('secret123', method=CHEAP_METHOD)
+
+
+def legacy_setup():
+    conn = sqlite3.connect(LEGACY_PATH)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cloud_chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id TEXT UNIQUE NOT NULL,
+            title TEXT NOT NULL,
+            messages TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute(
+        'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+        ('bench', 'bench@example.com', CHEAP_HASH)
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_login(email, password):
+    conn = sqlite3.connect(LEGACY_PATH, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, username, email, password_hash FROM users WHERE email = ?', (email,))
+    user = cursor.fetchone()
+    conn.close()
+    return check_password_hash(user[3], password)
+
+
+def legacy_save(user_id, chat):
+    conn = sqlite3.connect(LEGACY_PATH, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM cloud_chats WHERE user_id = ? AND chat_id = ?', (user_id, chat['id']))
+    existing = cursor.fetchone()
+    if existing:
+        cursor.execute(
+            'UPDATE cloud_chats SET title = ?, messages = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (chat['title'], json.dumps(chat['messages']), existing[0])
+        )
+    else:
+        cursor.execute(
+            'INSERT INTO cloud_chats (user_id, chat_id, title, messages) VALUES (?, ?, ?, ?)',
+            (user_id, chat['id'], chat['title'], json.dumps(chat['messages']))
+        )
+    conn.commit()
+    conn.close()
+
+
+def pooled_setup():
+    with database.transaction() as conn:
+        conn.execute(
+            'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+            ('bench', 'bench@example.com', CHEAP_HASH)
+        )
+
+
+def make_chat(i):
+    return {
+        'id': f'chat_{i % 50}',
+        'title': f'Chat {i % 50}',
+        'messages': [{'role': 'user', 'content': 'What is a normal resting heart rate?'}] * 4
+    }
+
+
+def run(fn, ops, threads):
+    per_thread = ops // threads
+
+    def worker(offset):
+        for i in range(per_thread):
+            fn(offset + i)
+
+    pool = [threading.Thread(target=worker, args=(t * per_thread,)) for t in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return (per_thread * threads) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--ops', type=int, default=2000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    legacy_setup()
+    pooled_setup()
+
+    # Silence the per-call logging in database.py while timing
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+
+    results = []
+    for threads in args.threads:
+        cases = [
+            ('login (connect-per-call)', lambda i: legacy_login('bench@example.com', 'secret123')),
+            ('login (shared WAL)', lambda i: database.verify_user('bench@example.com', 'secret123')),
+            ('save (connect-per-call)', lambda i: legacy_save(1, make_chat(i))),
+            ('save (shared WAL)', lambda i: database.save_chat_to_cloud(1, make_chat(i))),
+        ]
+        for label, fn in cases:
+            sys.stdout = devnull
+            try:
+                rate = run(fn, args.ops, threads)
+            finally:
+                sys.stdout = real_stdout
+            results.append((label, threads, rate))
+
+    print(f"\nops per case: {args.ops}")
+    for label, threads, rate in results:
+        print(f"  {label:<28} {threads:>2} thread(s)  {rate:>10.0f} req/s")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(_tmpdir, ignore_errors=True)
@@ -0,0 +1,96 @@
+"""
+Benchmark: NDJSON export/import vs. loading and re-saving chats.
+
+Builds an account with --messages messages spread over --chats chats and
+compares wall time and peak Python memory (tracemalloc) of:
+  - get_user_chats_from_cloud vs. stream_user_chats_ndjson (export)
+  - one sync_chats_to_cloud per chat vs. import_chats_ndjson (import)
+
+The re-save peak leaves out the loaded chats it starts from, and
+tracemalloc slows every row down, so compare times with each other only.
+
+Usage:
+    python benchmarks/bench_export_import.py [--messages 100000] [--chats 50]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_export_import_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'users.db')
+os.environ['WRITE_BEHIND'] = 'off'
+
+import database  # noqa: E402
+
+
+def measure(func):
+    """Run func, returning (result, seconds, peak MB)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+        return result, time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=50)
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        per_chat = args.messages // args.chats
+        for n in range(args.chats):
+            messages = [{'role': 'user' if i % 2 == 0 else 'ai',
+                         'content': f'Message {i} about my blood pressure readings and medication schedule'}
+                        for i in range(per_chat)]
+            database.sync_chats_to_cloud(1, [{'id': f'chat_{n}', 'title': f'Consultation {n}', 'messages': messages}])
+
+        export_path = os.path.join(_tmpdir, 'export.ndjson')
+
+        def export():
+            with open(export_path, 'w') as f:
+                for chunk in database.stream_user_chats_ndjson(1):
+                    f.write(chunk)
+
+        loaded, load_time, load_peak = measure(lambda: database.get_user_chats_from_cloud(1))
+        _, export_time, export_peak = measure(export)
+
+        def resave():
+            for chat in loaded.values():
+                database.sync_chats_to_cloud(2, [chat])
+
+        def ndjson_import():
+            with open(export_path, 'rb') as f:
+                return database.import_chats_ndjson(3, f)
+
+        _, resave_time, resave_peak = measure(resave)
+        loaded = None
+        result, import_time, import_peak = measure(ndjson_import)
+    finally:
+        sys.stdout = real_stdout
+
+    print(f"{args.messages} messages in {args.chats} chats, export {os.path.getsize(export_path) / 1e6:.1f} MB\n")
+    print(f"{'':<30}{'seconds':>10}{'peak MB':>10}")
+    print(f"{'load all chats (dict)':<30}{load_time:>10.2f}{load_peak:>10.1f}")
+    print(f"{'export NDJSON':<30}{export_time:>10.2f}{export_peak:>10.1f}")
+    print(f"{'re-save chat by chat':<30}{resave_time:>10.2f}{resave_peak:>10.1f}")
+    print(f"{'import NDJSON':<30}{import_time:>10.2f}{import_peak:>10.1f}")
+    print(f"\nimported {result['chats']} chats, {result['messages']} messages")
+
+
+if __name__ == '__main__':
+    main()
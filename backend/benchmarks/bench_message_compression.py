@@ -0,0 +1,143 @@
+"""
+Benchmark: raw vs. zlib-compressed chat message storage.
+
+Builds the same synthetic corpus of medical conversations twice - once with
+MESSAGE_COMPRESSION='none' and once with 'zlib' - and reports database size,
+chat_messages page count, how much of the table fits in a fixed page cache,
+and /api/chats/load latency per user.
+
+SQLite does not expose page-cache hit counters through the Python module,
+so the cache figure is the fraction of chat_messages pages that fit in the
+configured cache - the steady-state hit rate for uniformly random loads.
+
+Usage:
+    python benchmarks/bench_message_compression.py [--users 50] [--chats 20] [--messages 30]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_compress_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'none.db')
+
+import database  # noqa: E402
+
+CACHE_KIB = 8 * 1024  # Page cache given to each load connection
+
+SENTENCES = [
+    "**Hypertension** is usually defined as a blood pressure of 140/90 mmHg or higher on repeated readings.",
+    "Common first-line options include ACE inhibitors, calcium channel blockers and thiazide diuretics.",
+    "A normal resting heart rate for adults ranges from 60 to 100 beats per minute.",
+    "If you experience chest pain, shortness of breath or fainting, seek emergency care immediately.",
+    "Metformin is typically started at 500 mg once or twice daily with meals to limit stomach upset.",
+    "| Test | Result | Reference range |\n|------|--------|-----------------|\n| HbA1c | {n}% | 4.0-5.6% |",
+    "- Drink plenty of fluids\n- Rest as needed\n- Monitor your temperature every {n} hours",
+    "### When to see a doctor\nSymptoms lasting longer than {n} days should be evaluated by a clinician.",
+    "Paracetamol can be taken every 4-6 hours, but do not exceed {n} g in 24 hours.",
+    "Malaria symptoms such as fever, chills and headache usually appear 10-15 days after the bite.",
+]
+
+
+def make_message(rng, role):
+    count = rng.randint(1, 3) if role == 'user' else rng.randint(6, 25)
+    content = "\n\n".join(rng.choice(SENTENCES).format(n=rng.randint(2, 9)) for _ in range(count))
+    return {'id': f"{rng.random():.12f}", 'role': role, 'content': content, 'timestamp': '2026-10-17T10:00:00Z'}
+
+
+def build_corpus(path, compression, args):
+    database.DATABASE_PATH = path
+    database.MESSAGE_COMPRESSION = compression
+    database.init_db()
+
+    rng = random.Random(42)
+    for user_id in range(1, args.users + 1):
+        chats = []
+        for c in range(args.chats):
+            messages = [make_message(rng, 'user' if m % 2 == 0 else 'ai') for m in range(args.messages)]
+            chats.append({'id': f'chat_{c}', 'title': f'Consultation {c}', 'messages': messages})
+        database.sync_chats_to_cloud(user_id, chats)
+
+    conn = database.get_connection(path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.execute('VACUUM')
+
+
+def measure(path, args):
+    conn = database.get_connection(path)
+    size = os.path.getsize(path)
+    pages, table_bytes = conn.execute(
+        "SELECT COUNT(*), SUM(pgsize) FROM dbstat WHERE name = 'chat_messages'"
+    ).fetchone()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    cache_pages = CACHE_KIB * 1024 // page_size
+
+    database.DATABASE_PATH = path
+    rng = random.Random(7)
+    timings = []
+    for _ in range(args.loads):
+        user_id = rng.randint(1, args.users)
+        start = time.perf_counter()
+        for _chunk in database.stream_user_chats_json(user_id):
+            pass
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {
+        'db_size_mb': size / 1e6,
+        'table_pages': pages,
+        'table_mb': table_bytes / 1e6,
+        'cache_coverage': min(1.0, cache_pages / pages) if pages else 1.0,
+        'load_p50_ms': statistics.median(timings),
+        'load_p95_ms': timings[int(len(timings) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=30)
+    parser.add_argument('--loads', type=int, default=200)
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    results = {}
+    for compression in ('none', 'zlib'):
+        path = os.path.join(_tmpdir, f'{compression}.db')
+        sys.stdout = devnull
+        try:
+            build_corpus(path, compression, args)
+            # Load through a connection with a fixed, small page cache
+            database.get_connection(path).execute(f'PRAGMA cache_size = -{CACHE_KIB}')
+            results[compression] = measure(path, args)
+        finally:
+            sys.stdout = real_stdout
+
+    total = args.users * args.chats * args.messages
+    print(f"corpus: {args.users} users x {args.chats} chats x {args.messages} messages = {total} messages")
+    print(f"page cache: {CACHE_KIB // 1024} MiB\n")
+    print(f"{'':<22}{'none':>12}{'zlib':>12}")
+    rows = [
+        ('database size (MB)', 'db_size_mb', '{:.1f}'),
+        ('chat_messages (MB)', 'table_mb', '{:.1f}'),
+        ('chat_messages pages', 'table_pages', '{:d}'),
+        ('cache coverage', 'cache_coverage', '{:.0%}'),
+        ('load p50 (ms)', 'load_p50_ms', '{:.2f}'),
+        ('load p95 (ms)', 'load_p95_ms', '{:.2f}'),
+    ]
+    for label, key, fmt in rows:
+        print(f"{label:<22}{fmt.format(results['none'][key]):>12}{fmt.format(results['zlib'][key]):>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark: OCR throughput of scanned PDF pages against the number of tesseract workers.
+
+Writes a --pages page "scanned" PDF (each page a full-page image of a
+typed lab report) and extracts it with OCR_WORKERS set to each value of
+--workers, reporting pages per second and pages per second per core in
+use. A text-layer PDF of the same length is also extracted with OCR on
+and off, to show text pages pay nothing for scanned-page detection.
+
+Requires tesseract and pytesseract.
+
+Usage:
+    python benchmarks/bench_ocr.py [--pages 24] [--workers 1,2,4]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_ocr_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'users.db')
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+import document_processor  # noqa: E402
+from document_processor import DocumentProcessor  # noqa: E402
+from bench_pdf_pages import make_pdf  # noqa: E402
+
+
+def make_scanned_pdf(path: str, pages: int):
+    """Write a PDF of full-page 200 DPI images of typed report lines"""
+    images = []
+    for number in range(pages):
+        image = Image.new('L', (1700, 2200), 255)
+        draw = ImageDraw.Draw(image)
+        for line in range(40):
+            draw.text((120, 120 + line * 48),
+                      f"Page {number + 1} line {line}: haemoglobin 13.{line % 10} g/dL, "
+                      f"white cells {4 + line % 7}.2, platelets {150 + line}", fill=0)
+        images.append(image)
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=200)
+
+
+def extract(path: str, filename: str, enable_ocr: bool = True):
+    """Extract a file without the cache, returning (seconds, result)"""
+    processor = DocumentProcessor(enable_ocr=enable_ocr, cache=None)
+    start = time.perf_counter()
+    result = processor.process_file(path, filename)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pages', type=int, default=24)
+    parser.add_argument('--workers', default='1,2,4')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    if not document_processor.TESSERACT_AVAILABLE:
+        print("pytesseract is not installed; nothing to measure")
+        return
+
+    scanned_path = os.path.join(_tmpdir, 'scanned.pdf')
+    make_scanned_pdf(scanned_path, args.pages)
+    text_path = os.path.join(_tmpdir, 'report.pdf')
+    make_pdf(text_path, args.pages)
+
+    # Page extraction in-process, so only the OCR pool varies
+    document_processor.PDF_WORKERS = 1
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        results = []
+        for workers in [int(n) for n in args.workers.split(',')]:
+            document_processor.OCR_WORKERS = workers
+            if document_processor._ocr_pool is not None:
+                document_processor._ocr_pool.shutdown()
+                document_processor._ocr_pool = None
+            results.append((workers, *extract(scanned_path, 'scanned.pdf')))
+        text_off = extract(text_path, 'report.pdf', enable_ocr=False)
+        text_on = extract(text_path, 'report.pdf', enable_ocr=True)
+    finally:
+        sys.stdout = real_stdout
+
+    cores = os.cpu_count() or 1
+    print(f"{args.pages}-page scanned PDF, {cores} CPU core(s), "
+          f"up to {document_processor.OCR_DPI} DPI / {document_processor.OCR_MAX_PIXELS / 1e6:.0f} MP per page\n")
+    print(f"{'workers':>8}{'seconds':>10}{'pages/s':>10}{'pages/s/core':>14}{'ok':>6}")
+    for workers, seconds, result in results:
+        rate = args.pages / seconds
+        ok = result.success and not result.metadata.get('ocr_failed_pages')
+        print(f"{workers:>8}{seconds:>10.2f}{rate:>10.2f}{rate / min(workers, cores):>14.2f}{str(ok):>6}")
+
+    same = text_on[1].text == text_off[1].text and 'ocr_pages' not in text_on[1].metadata
+    print(f"\n{args.pages}-page text PDF: OCR off {text_off[0]:.2f} s, OCR on {text_on[0]:.2f} s, "
+          f"same text and nothing OCR'd: {same}")
+
+
+if __name__ == '__main__':
+    main()
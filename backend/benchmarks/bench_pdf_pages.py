@@ -0,0 +1,119 @@
+"""
+Benchmark: PDF extraction wall time against the number of pool workers.
+
+Writes a synthetic lab report of --pages pages (lines of text plus a
+ruled results table on each page, so both extract_text and
+extract_tables do real work) and extracts it with PDF_WORKERS set to
+each value of --workers. Pool start-up is excluded by warming each pool
+first. Every run must produce the same text as the serial run.
+
+Usage:
+    python benchmarks/bench_pdf_pages.py [--pages 120] [--workers 1,2,4]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_pdf_pages_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'users.db')
+
+import document_processor  # noqa: E402
+from document_processor import DocumentProcessor  # noqa: E402
+
+
+def page_content(number: int) -> bytes:
+    """Content stream of one report page: 40 text lines and a 4x6 table"""
+    ops = ['BT /F1 9 Tf 50 790 Td 11 TL']
+    for line in range(40):
+        ops.append(f"(Page {number} line {line}: haemoglobin 13.{line % 10} g/dL, "
+                   f"white cells {4 + line % 7}.2, platelets {150 + line}) '")
+    ops.append('ET')
+    top, left, row_h, col_w = 300, 50, 20, 120
+    for row in range(7):
+        ops.append(f"{left} {top - row * row_h} m {left + 4 * col_w} {top - row * row_h} l S")
+    for col in range(5):
+        ops.append(f"{left + col * col_w} {top} m {left + col * col_w} {top - 6 * row_h} l S")
+    for row in range(6):
+        for col in range(4):
+            x, y = left + col * col_w + 5, top - (row + 1) * row_h + 6
+            ops.append(f"BT /F1 9 Tf {x} {y} Td (R{row}C{col} {number}) Tj ET")
+    return '\n'.join(ops).encode('latin-1')
+
+
+def make_pdf(path: str, pages: int):
+    """Write a minimal PDF with the given number of report pages"""
+    objects = {1: b'<< /Type /Catalog /Pages 2 0 R >>',
+               3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'}
+    kids = []
+    for n in range(pages):
+        page_id, content_id = 4 + 2 * n, 5 + 2 * n
+        content = page_content(n + 1)
+        objects[content_id] = b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream'
+        objects[page_id] = (b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] '
+                            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % content_id)
+        kids.append(b'%d 0 R' % page_id)
+    objects[2] = b'<< /Type /Pages /Kids [' + b' '.join(kids) + b'] /Count %d >>' % pages
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(out)
+        out += b'%d 0 obj\n' % number + objects[number] + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for number in sorted(objects):
+        out += b'%010d 00000 n \n' % offsets[number]
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pages', type=int, default=120)
+    parser.add_argument('--workers', default='1,2,4')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    pdf_path = os.path.join(_tmpdir, 'report.pdf')
+    make_pdf(pdf_path, args.pages)
+    warmup_path = os.path.join(_tmpdir, 'warmup.pdf')
+    make_pdf(warmup_path, document_processor.PDF_PARALLEL_MIN_PAGES)
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        processor = DocumentProcessor(enable_ocr=False, cache=None)
+        results = []
+        for workers in [int(n) for n in args.workers.split(',')]:
+            document_processor.PDF_WORKERS = workers
+            if document_processor._pdf_pool is not None:
+                document_processor._discard_pdf_pool(document_processor._pdf_pool)
+            if workers > 1:
+                for _ in range(workers):
+                    processor.process_file(warmup_path, 'warmup.pdf')
+            start = time.perf_counter()
+            result = processor.process_file(pdf_path, 'report.pdf')
+            results.append((workers, time.perf_counter() - start, result))
+    finally:
+        sys.stdout = real_stdout
+
+    baseline = results[0][2]
+    print(f"{args.pages}-page PDF, {os.cpu_count()} CPU core(s)\n")
+    print(f"{'workers':>8}{'seconds':>10}{'speedup':>10}{'same text':>11}")
+    for workers, seconds, result in results:
+        same = result.success and result.text == baseline.text and result.has_tables == baseline.has_tables
+        print(f"{workers:>8}{seconds:>10.2f}{results[0][1] / seconds:>10.2f}{str(same):>11}")
+
+
+if __name__ == '__main__':
+    main()
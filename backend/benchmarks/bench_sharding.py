@@ -0,0 +1,92 @@
+"""
+Benchmark: chat save throughput vs. number of chat shards.
+
+Starts several worker processes (like gunicorn workers) that save chats
+for random users as fast as they can, and reports total saves per second
+for each shard count. Every save is its own transaction, so with one
+shard all workers queue on a single SQLite write lock.
+
+Usage:
+    python benchmarks/bench_sharding.py [--workers 8] [--shards 1,2,4,8] [--seconds 3]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker(database_path, shard_count, seed, users, seconds, start_at, results):
+    os.environ['DATABASE_PATH'] = database_path
+    os.environ['CHAT_SHARDS'] = str(shard_count)
+    sys.path.insert(0, BACKEND_DIR)
+    sys.stdout = open(os.devnull, 'w')
+    import database
+
+    rng = random.Random(seed)
+    histories = {}
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.time() + seconds
+    saves = 0
+    while time.time() < deadline:
+        user_id = rng.randint(1, users)
+        # Each save adds a message to the user's conversation, as a chat turn does
+        messages = histories.setdefault(user_id, [])
+        messages.append({'role': 'user' if len(messages) % 2 == 0 else 'ai',
+                         'content': f'Question {len(messages)} about my blood pressure medication'})
+        result = database.sync_chats_to_cloud(user_id, [{'id': f'chat_{seed}', 'title': 'Consultation', 'messages': messages}])
+        if result['success']:
+            saves += 1
+    results.put(saves)
+
+
+def run(shard_count, args):
+    database_path = os.path.join(tempfile.mkdtemp(prefix='bench_shards_'), 'users.db')
+
+    # Create the schema and shard files once before the workers race for them
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    setup = context.Process(target=worker, args=(database_path, shard_count, 0, args.users, 0, 0, results))
+    setup.start()
+    setup.join()
+    results.get()
+
+    start_at = time.time() + 2.0  # let every worker finish importing first
+    processes = [
+        context.Process(target=worker, args=(database_path, shard_count, n + 1, args.users, args.seconds, start_at, results))
+        for n in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total / args.seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--shards', default='1,2,4,8')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    print(f"{args.workers} worker processes, {args.users} users, {args.seconds}s per run\n")
+    print(f"{'shards':>8}{'saves/s':>12}{'speedup':>10}")
+    baseline = None
+    for shard_count in (int(value) for value in args.shards.split(',')):
+        rate = run(shard_count, args)
+        baseline = baseline or rate
+        print(f"{shard_count:>8}{rate:>12.0f}{rate / baseline:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
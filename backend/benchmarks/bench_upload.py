@@ -0,0 +1,103 @@
+"""
+Benchmark: memory of /api/upload for base64 JSON vs. multipart vs. raw bodies.
+
+Builds a PDF of about --mb megabytes (pages of incompressible image data,
+so extraction itself is cheap) and sends it to /api/upload three ways,
+measuring wall time and peak Python memory (tracemalloc) of the server
+side of each request. Request bodies are built before measuring.
+
+Usage:
+    python benchmarks/bench_upload.py [--mb 20]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_upload_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'users.db')
+os.environ['RATE_LIMIT_UPLOAD'] = '0'
+# Every run extracts the same PDF; measure extraction, not cache hits
+os.environ['EXTRACTION_CACHE_MEMORY_MB'] = '0'
+os.environ['EXTRACTION_CACHE_DISK_MB'] = '0'
+
+from PIL import Image  # noqa: E402
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+
+def make_pdf(path: str, megabytes: int):
+    """Write a PDF of random-noise pages totalling roughly megabytes"""
+    pages = []
+    while len(pages) * 0.3 < megabytes:  # a noise page is ~0.3 MB as JPEG
+        pages.append(Image.frombytes('RGB', (512, 512), os.urandom(512 * 512 * 3)))
+    pages[0].save(path, save_all=True, append_images=pages[1:], quality=95)
+
+
+def measure(app, builder):
+    """Run one request through the app, returning (status, seconds, peak MB)"""
+    environ = builder.get_environ()
+    status = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        body = b''.join(app.wsgi_app(environ, lambda s, h, e=None: status.append(s)))
+        return status[0], json.loads(body).get('success'), time.perf_counter() - start, \
+            tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+        builder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mb', type=int, default=20)
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        import app as app_module
+        app = app_module.app
+        logging.disable(logging.INFO)  # app.py logs at DEBUG; pdfminer is very chatty
+
+        pdf_path = os.path.join(_tmpdir, 'scan.pdf')
+        make_pdf(pdf_path, args.mb)
+        size = os.path.getsize(pdf_path)
+
+        with open(pdf_path, 'rb') as f:
+            data_url = 'data:application/pdf;base64,' + base64.b64encode(f.read()).decode('ascii')
+        json_builder = EnvironBuilder(path='/api/upload', method='POST',
+                                      json={'file': {'name': 'scan.pdf', 'data': data_url}})
+        data_url = None
+        results = [('base64 JSON', measure(app, json_builder))]
+
+        with open(pdf_path, 'rb') as f:
+            results.append(('multipart', measure(app, EnvironBuilder(
+                path='/api/upload', method='POST', data={'file': (f, 'scan.pdf')}))))
+
+        with open(pdf_path, 'rb') as f:
+            results.append(('raw body', measure(app, EnvironBuilder(
+                path='/api/upload?filename=scan.pdf', method='POST', input_stream=f,
+                content_length=size, content_type='application/pdf'))))
+    finally:
+        sys.stdout = real_stdout
+
+    print(f"PDF of {size / 1e6:.1f} MB\n")
+    print(f"{'':<16}{'status':>16}{'seconds':>10}{'peak MB':>10}")
+    for label, (status, success, seconds, peak) in results:
+        print(f"{label:<16}{status + (' ok' if success else ' failed'):>16}{seconds:>10.2f}{peak:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark: direct vs. write-behind chat saves.
+
+Simulates users with an open conversation that the client re-saves on a
+debounce while it grows, as the frontend does, and reports how many
+transactions each mode commits and how long saves keep a writer busy.
+Time is compressed: --interval is the (scaled) debounce between saves.
+
+With journal_mode=WAL and synchronous=NORMAL, SQLite syncs at checkpoints
+rather than at every commit, so committed transactions (each one a WAL
+append plus a write lock) are the figure reported here.
+
+Usage:
+    python benchmarks/bench_write_behind.py [--users 50] [--seconds 3] [--interval 0.2]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmpdir = tempfile.mkdtemp(prefix='bench_write_behind_')
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'direct.db')
+
+import database  # noqa: E402
+from write_behind import WriteBehindBuffer  # noqa: E402
+
+
+def simulate(args, user_offset):
+    """Each user re-saves a growing chat every interval; returns saves issued"""
+    saves = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def user(user_id):
+        messages = []
+        while time.monotonic() < deadline:
+            messages.append({'role': 'user' if len(messages) % 2 == 0 else 'ai',
+                             'content': f'Message {len(messages)} about blood pressure readings'})
+            database.save_chat_to_cloud(user_id, {'id': 'chat_1', 'title': 'Consultation', 'messages': list(messages)})
+            with lock:
+                saves[0] += 1
+            time.sleep(args.interval)
+
+    threads = [threading.Thread(target=user, args=(user_offset + n,)) for n in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return saves[0]
+
+
+def timed(func):
+    """Wrap a write function to count calls and time spent in it"""
+    def wrapper(*a, **k):
+        start = time.perf_counter()
+        try:
+            return func(*a, **k)
+        finally:
+            wrapper.calls += 1
+            wrapper.busy += time.perf_counter() - start
+    wrapper.calls = 0
+    wrapper.busy = 0.0
+    return wrapper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between saves of one chat')
+    parser.add_argument('--delay', type=float, default=0.1, help='write-behind max delay')
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        # Direct: every save is its own transaction
+        database.WRITE_BEHIND_ENABLED = False
+        real_sync = database.sync_chats_to_cloud
+        direct_sync = database.sync_chats_to_cloud = timed(real_sync)
+        direct_saves = simulate(args, 1)
+        database.sync_chats_to_cloud = real_sync
+
+        # Write-behind: saves coalesce and flush together
+        database.WRITE_BEHIND_ENABLED = True
+        flush = timed(database._flush_buffered_chats)
+        database.chat_writer = WriteBehindBuffer(flush, database.WRITE_BEHIND_MAX_ITEMS, args.delay)
+        buffered_saves = simulate(args, 100001)
+        database.chat_writer.flush()
+        stats = database.chat_writer.stats()
+    finally:
+        sys.stdout = real_stdout
+
+    print(f"{args.users} users, one save every {args.interval}s for {args.seconds}s, flush delay {args.delay}s\n")
+    print(f"{'':<26}{'direct':>12}{'write-behind':>14}")
+    print(f"{'saves received':<26}{direct_saves:>12}{buffered_saves:>14}")
+    print(f"{'transactions committed':<26}{direct_sync.calls:>12}{flush.calls:>14}")
+    print(f"{'saves per transaction':<26}{direct_saves / max(direct_sync.calls, 1):>12.1f}"
+          f"{buffered_saves / max(flush.calls, 1):>14.1f}")
+    print(f"{'chats written':<26}{direct_sync.calls:>12}{stats['chats_written']:>14}")
+    print(f"{'writer busy (s)':<26}{direct_sync.busy:>12.2f}{flush.busy:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+Chat Search Module
+Full-text search over cloud chat messages using an SQLite FTS5 table.
+
+Message payloads are stored compressed, so the index is maintained from
+the save path (which has the plain text) rather than by triggers. The
+FTS5 table is contentless: it keeps only the token index, not a second
+copy of every message. chat_search_rows maps each index rowid to its
+message (user_id, chat_id, seq); snippets are cut from the stored
+messages, and removing a row needs the text that was indexed, which the
+caller reads from the stored message before deleting it. Every indexed
+row carries a per-user key token, so a MATCH can be scoped to one
+user's history.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import re
+import hashlib
+import unicodedata
+
+# Highlight markers and context size for result snippets
+SNIPPET_OPEN = '<mark>'
+SNIPPET_CLOSE = '</mark>'
+SNIPPET_TOKENS = 12
+
+CREATE_INDEX_SQL = (
+    '''
+    CREATE VIRTUAL TABLE chat_search USING fts5(
+        body,
+        user_key,
+        content = '',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    ''',
+    '''
+    CREATE TABLE chat_search_rows (
+        id INTEGER PRIMARY KEY,  -- rowid in chat_search
+        user_id INTEGER NOT NULL,
+        chat_id TEXT NOT NULL,
+        seq INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX idx_chat_search_rows_chat ON chat_search_rows(user_id, chat_id, seq)',
+)
+
+
+def _key(*parts) -> str:
+    """Stable single-token key (tokenizers would split raw ids on punctuation)"""
+    return hashlib.sha1('\x00'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:20]
+
+
+def user_key(user_id) -> str:
+    return 'u' + _key(user_id)
+
+
+def message_text(message) -> str:
+    """The searchable text of a message (its content field)"""
+    content = message.get('content') if isinstance(message, dict) else None
+    return content if isinstance(content, str) else ''
+
+
+def create_index(conn):
+    """Create the index tables (migrations only)"""
+    for sql in CREATE_INDEX_SQL:
+        conn.execute(sql)
+
+
+def clear(conn):
+    """Empty the index; a contentless table cannot be emptied with DELETE"""
+    conn.execute("INSERT INTO chat_search (chat_search) VALUES ('delete-all')")
+    conn.execute('DELETE FROM chat_search_rows')
+
+
+def index_messages(conn, user_id, chat_id, messages, start_seq):
+    """Add messages of one chat to the index, starting at start_seq"""
+    u_key = user_key(user_id)
+    rows = []
+    for offset, message in enumerate(messages):
+        text = message_text(message)
+        if text:
+            rowid = conn.execute(
+                'INSERT INTO chat_search_rows (user_id, chat_id, seq) VALUES (?, ?, ?)',
+                (user_id, chat_id, start_seq + offset)
+            ).lastrowid
+            rows.append((rowid, text, u_key))
+    conn.executemany('INSERT INTO chat_search (rowid, body, user_key) VALUES (?, ?, ?)', rows)
+
+
+def indexed_chats(conn, user_id) -> list:
+    """Ids of a user's chats that have indexed messages"""
+    return [row[0] for row in conn.execute(
+        'SELECT DISTINCT chat_id FROM chat_search_rows WHERE user_id = ?', (user_id,)
+    )]
+
+
+def indexed_messages(conn, user_id, chat_id, limit=-1) -> list:
+    """(rowid, seq) of up to limit indexed messages of one chat, in seq order"""
+    return conn.execute(
+        'SELECT id, seq FROM chat_search_rows WHERE user_id = ? AND chat_id = ? ORDER BY seq LIMIT ?',
+        (user_id, chat_id, limit)
+    ).fetchall()
+
+
+def remove_messages(conn, user_id, rows):
+    """
+    Remove indexed messages given as (rowid, text) pairs. text must be the
+    text that was indexed (message_text of the stored message): a
+    contentless index drops a row by deleting exactly its tokens.
+    """
+    u_key = user_key(user_id)
+    conn.executemany(
+        "INSERT INTO chat_search (chat_search, rowid, body, user_key) VALUES ('delete', ?, ?, ?)",
+        [(rowid, text, u_key) for rowid, text in rows]
+    )
+    conn.executemany('DELETE FROM chat_search_rows WHERE id = ?', [(rowid,) for rowid, _text in rows])
+
+
+def _fold(word: str) -> str:
+    """Lowercase a word and strip its diacritics, like the unicode61 tokenizer"""
+    decomposed = unicodedata.normalize('NFKD', word.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def query_words(query: str) -> list:
+    """The searchable words of a query"""
+    return re.findall(r'\w+', query, flags=re.UNICODE)
+
+
+def make_snippet(text: str, words: list) -> str:
+    """
+    Up to SNIPPET_TOKENS words of text around the first match, matches
+    highlighted, the way FTS5's snippet() would. The last query word also
+    matches as a prefix.
+    """
+    terms = [_fold(word) for word in words]
+
+    def matches(token):
+        token = _fold(token)
+        return bool(terms) and (token in terms[:-1] or token.startswith(terms[-1]))
+
+    tokens = list(re.finditer(r'\w+', text, flags=re.UNICODE))
+    if not tokens:
+        return ''
+    first = next((index for index, token in enumerate(tokens) if matches(token.group())), 0)
+    # A little leading context, but keep the window full near the end
+    start = max(0, min(first - 2, len(tokens) - SNIPPET_TOKENS))
+    end = min(len(tokens), start + SNIPPET_TOKENS)
+
+    parts = ['…' if start > 0 else '']
+    position = tokens[start].start()
+    for token in tokens[start:end]:
+        parts.append(text[position:token.start()])
+        if matches(token.group()):
+            parts.append(f'{SNIPPET_OPEN}{token.group()}{SNIPPET_CLOSE}')
+        else:
+            parts.append(token.group())
+        position = token.end()
+    parts.append('…' if end < len(tokens) else '')
+    return ''.join(parts)
+
+
+def build_match_query(user_id, query: str):
+    """
+    Turn free text into a safe FTS5 query scoped to one user.
+    Every word must match; the last word also matches as a prefix so
+    results appear while the user is still typing.
+
+    Returns None if the query has no searchable words.
+    """
+    words = query_words(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return f'user_key:{user_key(user_id)} AND body:({" ".join(terms)})'
+
+
+def search(conn, user_id, query: str, limit: int, offset: int = 0, load_texts=None) -> list:
+    """
+    Search one user's messages, best matches first.
+
+    load_texts(conn, user_id, [(chat_id, seq), ...]) returns the text of
+    those stored messages keyed by (chat_id, seq), for the snippets.
+
+    Returns:
+        List of dicts with chat_id, seq and a highlighted snippet
+    """
+    match = build_match_query(user_id, query)
+    if match is None:
+        return []
+
+    # bm25 weights: only the body column contributes to relevance.
+    # Deleted chats stay indexed until the purger reaches them, so only
+    # live chats are joined in; the title comes along for free.
+    rows = conn.execute('''
+        SELECT r.chat_id, r.seq, c.title
+        FROM chat_search s
+        JOIN chat_search_rows r ON r.id = s.rowid
+        JOIN cloud_chats c ON c.user_id = r.user_id AND c.chat_id = r.chat_id AND c.deleted_at IS NULL
+        WHERE chat_search MATCH ?
+        ORDER BY bm25(chat_search, 1.0, 0.0)
+        LIMIT ? OFFSET ?
+    ''', (match, limit, offset)).fetchall()
+
+    texts = load_texts(conn, user_id, [(chat_id, seq) for chat_id, seq, _title in rows]) if rows else {}
+    words = query_words(query)
+    return [
+        {'chat_id': chat_id, 'seq': seq, 'snippet': make_snippet(texts.get((chat_id, seq), ''), words), 'title': title}
+        for chat_id, seq, title in rows
+    ]
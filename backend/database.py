@@ -1,28 +1,207 @@
 import sqlite3
 import os
 import json  # Added missing import
-from werkzeug.security import generate_password_hash, check_password_hash
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from password_hasher import password_hasher, HashingBusy
 
-DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'users.db')
+import migrations
+import chat_search
+from background_jobs import JobRunner
+from user_directory import UserDirectory
+from write_behind import WriteBehindBuffer, PendingMarkers, FlushFailed
+from shards import ShardRouter
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(__file__), 'users.db'))
+
+# Number of SQLite files chat tables are spread over (see shards.py);
+# changing it for an existing database requires running reshard.py
+CHAT_SHARDS = int(os.environ.get('CHAT_SHARDS', 1))
+
+# Connection settings shared by every data-access function
+BUSY_TIMEOUT_SECONDS = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5.0))
+STATEMENT_CACHE_SIZE = 256  # Compiled statements kept per connection
+STATS_RECHECK_BATCH_SIZE = 200  # users recounted per transaction by recheck_stats()
+SYNC_LOOKUP_CHUNK = 500  # chat ids per IN (...) lookup during batch sync
+
+STREAM_CHUNK_SIZE = 64 * 1024  # characters buffered per streamed response chunk
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))  # NDJSON lines per import transaction
+IMPORT_BATCH_BYTES = int(os.environ.get('IMPORT_BATCH_BYTES', 8 * 1024 * 1024))  # NDJSON bytes per import transaction
+
+# Stored message payloads are one format byte followed by the data, so the
+# compression algorithm can change without rewriting existing rows
+MESSAGE_FORMAT_RAW = 0   # UTF-8 JSON
+MESSAGE_FORMAT_ZLIB = 1  # zlib-compressed UTF-8 JSON
+MESSAGE_COMPRESSION = os.environ.get('MESSAGE_COMPRESSION', 'zlib')  # 'zlib' or 'none'
+COMPRESS_MIN_BYTES = 256  # Short messages do not shrink enough to be worth it
+RECOMPRESS_BATCH_SIZE = 500
+
+# Chats untouched for this many days move their messages to the compressed
+# chat_archive tier and are rehydrated on first access (0 disables archiving)
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 30))
+ARCHIVE_BATCH_SIZE = 50  # chats archived per transaction
+
+# Deleted chats and accounts become tombstones at once; their rows are
+# removed later by the purge job, a batch per transaction
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+
+# How long /api/stats reuses the purge backlog and free space it last read
+CLEANUP_STATS_MAX_AGE = float(os.environ.get('CLEANUP_STATS_MAX_AGE', 10))
+
+# Freed pages are returned to the filesystem by incremental_vacuum, a few at a time.
+# Files created before auto_vacuum was enabled need one full VACUUM to switch
+# over, which blocks writers while it runs - opt in with VACUUM_CONVERT=on
+VACUUM_PAGES = int(os.environ.get('VACUUM_PAGES', 1000))
+VACUUM_MIN_FREE_PAGES = int(os.environ.get('VACUUM_MIN_FREE_PAGES', 256))
+VACUUM_CONVERT = os.environ.get('VACUUM_CONVERT', 'off').lower() in ('1', 'on', 'true', 'yes')
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+# Write-behind buffering for /api/chats/save (see write_behind.py)
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND', 'on').lower() not in ('0', 'off', 'false', 'no')
+WRITE_BEHIND_MAX_ITEMS = int(os.environ.get('WRITE_BEHIND_MAX_ITEMS', 500))
+WRITE_BEHIND_MAX_DELAY = float(os.environ.get('WRITE_BEHIND_MAX_DELAY', 1.0))
+# Longest a read waits for the user's saves buffered in another worker process
+WRITE_BEHIND_READ_WAIT = float(os.environ.get('WRITE_BEHIND_READ_WAIT', 5 * WRITE_BEHIND_MAX_DELAY))
+
+# Millisecond timestamps for updated_at, so sync watermarks rarely collide
+NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+_local = threading.local()
+
+_schema_info = {'tables': [], 'users_structure': []}  # Filled in by init_db()
+
+# users stay in DATABASE_PATH; each user's chats live in one shard
+shards = ShardRouter(DATABASE_PATH, CHAT_SHARDS)
+
+def _open_connection(path):
+    """Open a connection configured for concurrent access"""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_SECONDS,
+        isolation_level=None,  # Transactions are managed by transaction()
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    # Only takes effect in a new file; existing files are converted by vacuum_free_pages()
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets readers run while a writer commits; NORMAL sync is durable in WAL mode
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def get_connection(path=None):
+    """
+    Return this thread's shared connection to the database.
+    Connections stay open between requests so compiled statements are reused.
+    """
+    path = path or DATABASE_PATH
+    
+    # Never share connections with a parent process (gunicorn forks workers)
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    
+    conn = _local.connections.get(path)
+    if conn is None:
+        conn = _open_connection(path)
+        _local.connections[path] = conn
+    return conn
+
+@contextmanager
+def transaction(path=None, immediate=True):
+    """
+    Run a block of statements in one transaction on the shared connection.
+    Commits on success, rolls back on any exception. Nested use runs in a
+    savepoint of the outer transaction, so a failed inner block is undone
+    without losing the outer one's work.
+    """
+    conn = get_connection(path)
+    if conn.in_transaction:
+        conn.execute('SAVEPOINT nested')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK TO nested')
+            conn.execute('RELEASE nested')
+            raise
+        else:
+            conn.execute('RELEASE nested')
+        return
+    
+    # IMMEDIATE takes the write lock up front so the busy timeout applies
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def close_connections():
+    """Close every connection opened by the current thread"""
+    for conn in getattr(_local, 'connections', {}).values():
+        conn.close()
+    _local.connections = {}
+
+def encode_message(message_json):
+    """Encode a message's JSON text for storage in chat_messages.message"""
+    data = message_json.encode('utf-8')
+    if MESSAGE_COMPRESSION == 'zlib' and len(data) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return bytes([MESSAGE_FORMAT_ZLIB]) + compressed
+    return bytes([MESSAGE_FORMAT_RAW]) + data
+
+def decode_message(stored):
+    """Return the JSON text of a stored message"""
+    if isinstance(stored, str):
+        # Written before payloads carried a format byte
+        return stored
+    if stored[0] == MESSAGE_FORMAT_RAW:
+        return stored[1:].decode('utf-8')
+    if stored[0] == MESSAGE_FORMAT_ZLIB:
+        return zlib.decompress(stored[1:]).decode('utf-8')
+    raise ValueError(f"Unknown message format byte: {stored[0]}")
 
 def init_db():
-    """Initialize the database with users table"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    """Bring the main database and every chat shard up to date (runs once at startup)"""
+    with transaction() as conn:
+        applied = migrations.apply_migrations(conn)
+        stored_shards = int(conn.execute("SELECT value FROM settings WHERE name = 'chat_shards'").fetchone()[0])
+        if stored_shards == 1 and stored_shards != shards.count and not conn.execute(
+            'SELECT EXISTS (SELECT 1 FROM cloud_chats) OR EXISTS (SELECT 1 FROM user_chats)'
+        ).fetchone()[0]:
+            # No chats stored yet, so the configured layout can be adopted without moving data
+            conn.execute("UPDATE settings SET value = ? WHERE name = 'chat_shards'", (str(shards.count),))
+            stored_shards = shards.count
+
+    for version, description in applied:
+        print(f"🛠️ Applied migration {version}: {description}")
+    
+    if stored_shards != shards.count:
+        raise RuntimeError(
+            f"Chats are stored in {stored_shards} shard(s) but CHAT_SHARDS={shards.count}; "
+            f"run reshard.py --shards {shards.count} first"
         )
-    ''')
     
-    conn.commit()
-    conn.close()
-    print("Database initialized successfully")
+    if shards.count > 1:
+        for path in shards.paths():
+            with transaction(path) as conn:
+                applied = migrations.apply_migrations(conn, scopes=(migrations.SCOPE_CHATS,))
+            if applied:
+                print(f"🛠️ Migrated chat shard {os.path.basename(path)} to schema version {migrations.SCHEMA_VERSION}")
+    
+    # The schema only changes here, so debug info describes it from memory
+    conn = get_connection()
+    _schema_info['tables'] = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    _schema_info['users_structure'] = [
+        dict(zip(['cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'], row))
+        for row in conn.execute("PRAGMA table_info(users)")
+    ]
+    
+    print(f"Database initialized successfully (schema version {migrations.SCHEMA_VERSION}, {shards.count} chat shard(s))")
 
 def create_user(username, email, password):
     """Create a new user"""
@@ -31,36 +210,30 @@ def create_user(username, email, password):
         email = email.lower().strip()
         username = username.strip()
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
         print(f"🔍 Creating user: {username} with email: {email}")
         
-        # Check if email already exists
-        cursor.execute('SELECT id, username FROM users WHERE email = ?', (email,))
-        existing = cursor.fetchone()
+        # Cheap in-memory checks first, so duplicates never pay for hashing
+        existing = user_directory.lookup_email(email)
         if existing:
-            conn.close()
             print(f"❌ Email already exists: {email} (user: {existing[1]})")
             return {'success': False, 'error': 'Email already registered'}
         
-        # Check if username already exists
-        cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
-        if cursor.fetchone():
-            conn.close()
+        if user_directory.lookup_username(username) is not None:
             return {'success': False, 'error': 'Username already exists'}
         
         # Hash the password
-        password_hash = generate_password_hash(password)
-        
-        cursor.execute(
-            'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
-            (username, email, password_hash)
-        )
-        
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
+        password_hash = password_hasher.hash(password)
+        
+        # The UNIQUE constraints catch anyone who registered in the meantime
+        with transaction() as conn:
+            before = user_directory.version(conn)
+            cursor = conn.execute(
+                'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+                (username, email, password_hash)
+            )
+            user_id = cursor.lastrowid
+            after = user_directory.version(conn)
+        user_directory.apply(before, after, added=(user_id, email, username))
         
         print(f"✅ User created successfully: {username} (id: {user_id})")
         
@@ -75,7 +248,13 @@ def create_user(username, email, password):
         }
     except sqlite3.IntegrityError as e:
         print(f"❌ Database integrity error: {e}")
+        if 'users.email' in str(e):
+            return {'success': False, 'error': 'Email already registered'}
+        if 'users.username' in str(e):
+            return {'success': False, 'error': 'Username already exists'}
         return {'success': False, 'error': 'Registration failed - user already exists'}
+    except HashingBusy:
+        raise
     except Exception as e:
         print(f"❌ Error in create_user: {e}")
         return {'success': False, 'error': str(e)}
@@ -86,18 +265,14 @@ def verify_user(email, password):
         # Normalize email to lowercase for consistent matching
         email = email.lower().strip()
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
+        conn = get_connection()
         
         print(f"🔍 Looking for user with email: {email}")
         
-        cursor.execute(
+        user = conn.execute(
             'SELECT id, username, email, password_hash FROM users WHERE email = ?',
             (email,)
-        )
-        
-        user = cursor.fetchone()
-        conn.close()
+        ).fetchone()
         
         if not user:
             print(f"❌ User not found with email: {email}")
@@ -106,8 +281,10 @@ def verify_user(email, password):
         print(f"✅ User found: {user[1]} (id: {user[0]})")
         
         # Verify password
-        if check_password_hash(user[3], password):
+        if password_hasher.verify(user[3], password):
             print(f"✅ Password verified for: {email}")
+            if password_hasher.needs_rehash(user[3]):
+                _rehash_password(user[0], user[3], password)
             return {
                 'success': True,
                 'user': {
@@ -120,23 +297,35 @@ def verify_user(email, password):
         else:
             print(f"❌ Wrong password for: {email}")
             return {'success': False, 'error': 'Incorrect password. Please try again.'}
+    except HashingBusy:
+        raise
     except Exception as e:
         print(f"❌ Error in verify_user: {str(e)}")
         return {'success': False, 'error': f'Login error: {str(e)}'}
 
+def _rehash_password(user_id, old_hash, password):
+    """Upgrade a stored hash to the configured parameters after a successful login"""
+    try:
+        new_hash = password_hasher.hash(password)
+        with transaction() as conn:
+            # Skip if the password changed while we were hashing
+            conn.execute(
+                'UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                (new_hash, user_id, old_hash)
+            )
+        password_hasher.record_rehash()
+        print(f"🔐 Password hash upgraded for user {user_id}")
+    except HashingBusy:
+        # The login already succeeded; upgrade on a later, quieter login
+        pass
+
 def get_user_by_id(user_id):
     """Get user by ID"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        user = get_connection().execute(
             'SELECT id, username, email FROM users WHERE id = ?',
             (user_id,)
-        )
-        
-        user = cursor.fetchone()
-        conn.close()
+        ).fetchone()
         
         if user:
             return {
@@ -149,22 +338,23 @@ def get_user_by_id(user_id):
         print(f"Error getting user: {e}")
         return None
 
-def update_user_profile(original_email, name=None, new_email=None, current_password=None, new_password=None):
+def update_user_profile(original_email, name=None, new_email=None, current_password=None, new_password=None,
+                        session_user_id=None):
     """
-    Update user profile information using original email to identify user
+    Update user profile information using original email to identify user.
+    session_user_id is the user of a recently authenticated session; it
+    stands in for current_password when changing the password.
     """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
+        conn = get_connection()
         
         print(f"🔍 Looking for user with email: {original_email}")
         
         # Get the current user by original email
-        cursor.execute(
+        user = conn.execute(
             'SELECT id, username, email, password_hash FROM users WHERE email = ?',
             (original_email,)
-        )
-        user = cursor.fetchone()
+        ).fetchone()
         
         if not user:
             print("❌ User not found")
@@ -173,59 +363,66 @@ def update_user_profile(original_email, name=None, new_email=None, current_passw
         print(f"✅ User found: {user[1]}")
         
         # If changing password, verify current password
+        new_password_hash = None
         if new_password:
             print("🔐 Password change requested")
-            if not current_password:
+            if session_user_id == user[0] and not current_password:
+                # A fresh session already proved the password
+                print("🔑 Password change authorized by session")
+            elif not current_password:
                 return {"success": False, "error": "Current password is required to change password"}
-            
-            # Verify current password
-            if not check_password_hash(user[3], current_password):
+            elif not password_hasher.verify(user[3], current_password):
                 print("❌ Current password incorrect")
                 return {"success": False, "error": "Current password is incorrect"}
             
             # Hash new password
-            new_password_hash = generate_password_hash(new_password)
-            cursor.execute(
-                "UPDATE users SET password_hash = ? WHERE email = ?",
-                (new_password_hash, original_email)
-            )
-            print("✅ Password updated")
-        
-        # Update name if provided
-        if name:
-            print(f"📝 Updating name to: {name}")
-            cursor.execute(
-                "UPDATE users SET username = ? WHERE email = ?",
-                (name, original_email)
-            )
+            new_password_hash = password_hasher.hash(new_password)
         
-        # Update email if provided
-        final_email = original_email  # Start with original email
-        if new_email and new_email != original_email:
-            print(f"📧 Changing email from {original_email} to {new_email}")
+        # Check if new email already exists
+        changing_email = new_email and new_email != original_email
+        if changing_email and user_directory.lookup_email(new_email):
+            return {"success": False, "error": "Email already exists"}
+        
+        with transaction() as conn:
+            before = user_directory.version(conn)
+            if new_password_hash:
+                # Bumping the generation signs out every other session
+                conn.execute(
+                    "UPDATE users SET password_hash = ?, token_generation = token_generation + 1 WHERE email = ?",
+                    (new_password_hash, original_email)
+                )
+                print("✅ Password updated")
             
-            # Check if new email already exists
-            cursor.execute("SELECT id FROM users WHERE email = ?", (new_email,))
-            if cursor.fetchone():
-                return {"success": False, "error": "Email already exists"}
+            # Update name if provided
+            if name:
+                print(f"📝 Updating name to: {name}")
+                conn.execute(
+                    "UPDATE users SET username = ? WHERE email = ?",
+                    (name, original_email)
+                )
             
-            cursor.execute(
-                "UPDATE users SET email = ? WHERE email = ?",
-                (new_email, original_email)
-            )
-            final_email = new_email  # Use new email for the response
-            print("✅ Email updated")
-        
-        conn.commit()
-        
-        # Get updated user data
-        cursor.execute(
-            "SELECT id, username, email FROM users WHERE email = ?", 
-            (final_email,)
+            # Update email if provided
+            final_email = original_email  # Start with original email
+            if changing_email:
+                print(f"📧 Changing email from {original_email} to {new_email}")
+                conn.execute(
+                    "UPDATE users SET email = ? WHERE email = ?",
+                    (new_email, original_email)
+                )
+                final_email = new_email  # Use new email for the response
+                print("✅ Email updated")
+            
+            # Get updated user data
+            updated_user = conn.execute(
+                "SELECT id, username, email FROM users WHERE email = ?", 
+                (final_email,)
+            ).fetchone()
+            after = user_directory.version(conn)
+        user_directory.apply(
+            before, after,
+            removed=(user[2], user[1]),
+            added=(updated_user[0], updated_user[2], updated_user[1])
         )
-        updated_user = cursor.fetchone()
-        
-        conn.close()
         
         print(f"🎉 Profile update successful for: {updated_user[1]}")
         
@@ -245,6 +442,8 @@ def update_user_profile(original_email, name=None, new_email=None, current_passw
             return {"success": False, "error": "Email already exists"}
         else:
             return {"success": False, "error": "Database integrity error"}
+    except HashingBusy:
+        raise
     except Exception as e:
         print(f"❌ Database error: {str(e)}")
         return {"success": False, "error": str(e)}
@@ -252,30 +451,13 @@ def update_user_profile(original_email, name=None, new_email=None, current_passw
 def save_user_chat(user_id, chat_data):
     """Save user chat to cloud database"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Create chats table if not exists
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                chat_id TEXT NOT NULL,
-                chat_data TEXT NOT NULL,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Save each chat
-        for chat_id, chat in chat_data.items():
-            cursor.execute('''
+        with transaction(shards.path_for(user_id)) as conn:
+            # Save each chat
+            conn.executemany('''
                 INSERT OR REPLACE INTO user_chats (user_id, chat_id, chat_data)
                 VALUES (?, ?, ?)
-            ''', (user_id, chat_id, json.dumps(chat)))
+            ''', [(user_id, chat_id, json.dumps(chat)) for chat_id, chat in chat_data.items()])
         
-        conn.commit()
-        conn.close()
         return {"success": True}
         
     except Exception as e:
@@ -284,123 +466,471 @@ def save_user_chat(user_id, chat_data):
 def get_user_chats(user_id):
     """Get all chats for a user"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        rows = get_connection(shards.path_for(user_id)).execute(
             'SELECT chat_id, chat_data FROM user_chats WHERE user_id = ?',
             (user_id,)
-        )
+        ).fetchall()
         
         chats = {}
-        for row in cursor.fetchall():
+        for row in rows:
             chats[row[0]] = json.loads(row[1])
         
-        conn.close()
         return chats
         
     except Exception as e:
         return {}
 
-def save_chat_to_cloud(user_id, chat_data):
-    """Save a complete chat to cloud database"""
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Create chats table if not exists
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cloud_chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                chat_id TEXT UNIQUE NOT NULL,
-                title TEXT NOT NULL,
-                messages TEXT NOT NULL,  -- JSON string of messages array
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Create index for faster queries
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_user_chats 
-            ON cloud_chats(user_id, created_at)
-        ''')
-        
-        # Check if chat already exists
-        cursor.execute(
-            'SELECT id FROM cloud_chats WHERE user_id = ? AND chat_id = ?',
-            (user_id, chat_data.get('id', ''))
+def _write_chat_messages(conn, user_id, chat_id, messages, message_jsons, start_seq):
+    """Insert message rows for a chat starting at the given sequence number, and index them"""
+    conn.executemany(
+        'INSERT INTO chat_messages (user_id, chat_id, seq, message) VALUES (?, ?, ?, ?)',
+        [(user_id, chat_id, start_seq + offset, encode_message(message)) for offset, message in enumerate(message_jsons)]
+    )
+    chat_search.index_messages(conn, user_id, chat_id, messages, start_seq)
+
+def _indexed_texts(conn, user_id, chat_id, seqs):
+    """
+    Searchable text of some stored messages of one chat, archived or not,
+    by seq: what the search index needs to drop them and snippets are cut from
+    """
+    archived = conn.execute(
+        'SELECT message_count, messages FROM chat_archive WHERE user_id = ? AND chat_id = ?',
+        (user_id, chat_id)
+    ).fetchone()
+    if archived is not None:
+        message_jsons = _archived_message_jsons(archived[1], archived[0])
+        return {seq: chat_search.message_text(json.loads(message_jsons[seq])) for seq in seqs if seq < len(message_jsons)}
+    
+    texts = {}
+    for seq in seqs:
+        row = conn.execute(
+            'SELECT message FROM chat_messages WHERE user_id = ? AND chat_id = ? AND seq = ?',
+            (user_id, chat_id, seq)
+        ).fetchone()
+        if row is not None:
+            texts[seq] = chat_search.message_text(json.loads(decode_message(row[0])))
+    return texts
+
+def _unindex_chat(conn, user_id, chat_id, limit=-1):
+    """
+    Remove up to limit of a chat's messages from the search index; returns
+    rows removed. Must run before the message rows are deleted, as the
+    contentless index needs their text.
+    """
+    rows = chat_search.indexed_messages(conn, user_id, chat_id, limit)
+    if rows:
+        texts = _indexed_texts(conn, user_id, chat_id, [seq for _rowid, seq in rows])
+        chat_search.remove_messages(conn, user_id, [(rowid, texts.get(seq, '')) for rowid, seq in rows])
+    return len(rows)
+
+def _search_texts(conn, user_id, keys):
+    """Text of the messages behind search results, keyed by (chat_id, seq)"""
+    seqs_by_chat = {}
+    for chat_id, seq in keys:
+        seqs_by_chat.setdefault(chat_id, []).append(seq)
+    return {
+        (chat_id, seq): text
+        for chat_id, seqs in seqs_by_chat.items()
+        for seq, text in _indexed_texts(conn, user_id, chat_id, seqs).items()
+    }
+
+def _delete_chat_messages(conn, user_id, chat_id):
+    """Remove every message row of a chat, archived or not, and its search index entries"""
+    _unindex_chat(conn, user_id, chat_id)
+    conn.execute(
+        'DELETE FROM chat_messages WHERE user_id = ? AND chat_id = ?',
+        (user_id, chat_id)
+    )
+    conn.execute('DELETE FROM chat_archive WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+
+def _archived_message_jsons(stored, message_count):
+    """Message JSON texts of an archived chat, in order"""
+    return decode_message(stored).split('\n') if message_count else []
+
+def _load_archived_messages(conn, user_id, chat_ids=None):
+    """Read archived chats' messages grouped by chat, without rehydrating them"""
+    if chat_ids is None:
+        rows = conn.execute(
+            'SELECT chat_id, message_count, messages FROM chat_archive WHERE user_id = ?',
+            (user_id,)
+        ).fetchall()
+    else:
+        rows = [row for chat_id in chat_ids for row in conn.execute(
+            'SELECT chat_id, message_count, messages FROM chat_archive WHERE user_id = ? AND chat_id = ?',
+            (user_id, chat_id)
+        )]
+    return {
+        chat_id: [json.loads(message_json) for message_json in _archived_message_jsons(stored, message_count)]
+        for chat_id, message_count, stored in rows
+    }
+
+def _archive_chat(conn, user_id, chat_id):
+    """Pack one chat's message rows into a single compressed chat_archive row"""
+    message_jsons = [decode_message(stored) for (stored,) in conn.execute(
+        'SELECT message FROM chat_messages WHERE user_id = ? AND chat_id = ? ORDER BY seq',
+        (user_id, chat_id)
+    )]
+    # json.dumps never emits a raw newline, so the messages are stored as JSON lines;
+    # search index entries stay, so archived chats are still found by search
+    conn.execute(
+        'INSERT OR REPLACE INTO chat_archive (user_id, chat_id, message_count, messages) VALUES (?, ?, ?, ?)',
+        (user_id, chat_id, len(message_jsons), encode_message('\n'.join(message_jsons)))
+    )
+    conn.execute('DELETE FROM chat_messages WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+    conn.execute(f'UPDATE cloud_chats SET archived_at = {NOW_MS} WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+
+def _rehydrate_chat(conn, user_id, chat_id):
+    """Move an archived chat's messages back to chat_messages (first access after archiving)"""
+    row = conn.execute(
+        'SELECT message_count, messages FROM chat_archive WHERE user_id = ? AND chat_id = ?',
+        (user_id, chat_id)
+    ).fetchone()
+    if row is not None:
+        conn.executemany(
+            'INSERT INTO chat_messages (user_id, chat_id, seq, message) VALUES (?, ?, ?, ?)',
+            [(user_id, chat_id, seq, encode_message(message_json))
+             for seq, message_json in enumerate(_archived_message_jsons(row[1], row[0]))]
         )
+        conn.execute('DELETE FROM chat_archive WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+    # accessed_at keeps the archive job from moving it straight back
+    conn.execute(
+        f'UPDATE cloud_chats SET archived_at = NULL, accessed_at = {NOW_MS} WHERE user_id = ? AND chat_id = ?',
+        (user_id, chat_id)
+    )
+    _archive_stats['rehydrated'] += 1
+
+def _reclaim_deleted_chat(conn, user_id, chat_id):
+    """
+    A deleted chat id is being saved again: drop what the purger has not
+    removed yet, so old messages never reappear under the new chat
+    """
+    if conn.execute(
+        'DELETE FROM purge_queue WHERE user_id = ? AND chat_id = ?',
+        (user_id, chat_id)
+    ).rowcount:
+        _delete_chat_messages(conn, user_id, chat_id)
+
+def _chat_error(chat):
+    """Why a chat from a client cannot be saved, or None if it can"""
+    if not isinstance(chat, dict) or not chat.get('id'):
+        return "Missing chat id"
+    if not isinstance(chat['id'], (str, int)) or isinstance(chat['id'], bool):
+        return "Chat id must be a string or number"
+    if not isinstance(chat.get('title', 'Untitled'), str):
+        return "Chat title must be a string"
+    if not isinstance(chat.get('messages', []), list):
+        return "Chat messages must be a list"
+    return None
+
+def sync_chats_to_cloud(user_id, chats, raise_errors=False):
+    """
+    Save many chats in a single transaction.
+    Unchanged chats are skipped, and chats that only gained messages
+    have just the new messages appended.
+    
+    Returns a dict with a per-chat status: 'created', 'updated', 'unchanged' or 'error'.
+    Database errors are returned as a failed result, or raised with raise_errors.
+    """
+    try:
+        results = {}
+        pending = {}
+        
+        # Validate, serialize and fingerprint outside the transaction; a bad
+        # chat is reported on its own and the rest of the batch is saved
+        for index, chat in enumerate(chats):
+            error = _chat_error(chat)
+            if error == "Missing chat id":
+                # No id to report against, so key the error by position in the batch
+                results[f"#{index}"] = {"status": "error", "error": error}
+                continue
+            # Stored ids are TEXT; the frontend may send numeric ones
+            chat_id = str(chat['id'])
+            if error is None:
+                messages = chat.get('messages', [])
+                try:
+                    message_jsons = [json.dumps(message) for message in messages]
+                except (TypeError, ValueError) as e:
+                    error = f"Chat messages are not valid JSON: {e}"
+            if error is not None:
+                results[chat_id] = {"status": "error", "error": error}
+                pending.pop(chat_id, None)
+                continue
+            pending[chat_id] = (chat.get('title', 'Untitled'), messages, message_jsons, migrations.chain_message_hashes(message_jsons))
+        
+        with transaction(shards.path_for(user_id)) as conn:
+            # Look up stored state, in chunks to stay under SQLite's variable limit
+            stored = {}
+            chat_ids = list(pending)
+            for start in range(0, len(chat_ids), SYNC_LOOKUP_CHUNK):
+                chunk = chat_ids[start:start + SYNC_LOOKUP_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                for chat_id, title, content_hash, message_count, archived_at in conn.execute(
+                    f'''SELECT chat_id, title, content_hash, message_count, archived_at FROM cloud_chats
+                        WHERE user_id = ? AND chat_id IN ({placeholders}) AND deleted_at IS NULL''',
+                    (user_id, *chunk)
+                ):
+                    stored[chat_id] = (title, content_hash, message_count, archived_at)
+            
+            rows = []
+            appended = 0
+            for chat_id, (title, messages, message_jsons, hashes) in pending.items():
+                if chat_id not in stored:
+                    results[chat_id] = {"status": "created"}
+                    _reclaim_deleted_chat(conn, user_id, chat_id)
+                    _write_chat_messages(conn, user_id, chat_id, messages, message_jsons, 0)
+                    appended += len(message_jsons)
+                else:
+                    stored_title, stored_hash, stored_count, archived_at = stored[chat_id]
+                    if stored_hash == hashes[-1] and stored_title == title:
+                        results[chat_id] = {"status": "unchanged"}
+                        continue
+                    
+                    results[chat_id] = {"status": "updated"}
+                    if archived_at is not None:
+                        _rehydrate_chat(conn, user_id, chat_id)
+                    if stored_count <= len(message_jsons) and hashes[stored_count] == stored_hash:
+                        # Conversation only grew - append the new tail
+                        _write_chat_messages(
+                            conn, user_id, chat_id,
+                            messages[stored_count:], message_jsons[stored_count:], stored_count
+                        )
+                        appended += len(message_jsons) - stored_count
+                    else:
+                        # History was edited or truncated - rewrite it
+                        _delete_chat_messages(conn, user_id, chat_id)
+                        _write_chat_messages(conn, user_id, chat_id, messages, message_jsons, 0)
+                        appended += len(message_jsons)
+                
+                rows.append((user_id, chat_id, title, hashes[-1], len(message_jsons)))
+            
+            # cloud_chats.messages is a legacy column, message rows live in chat_messages
+            # Re-saving a deleted chat id clears its tombstone
+            conn.executemany(f'''
+                INSERT INTO cloud_chats (user_id, chat_id, title, messages, content_hash, message_count, updated_at)
+                VALUES (?, ?, ?, '[]', ?, ?, {NOW_MS})
+                ON CONFLICT (user_id, chat_id) DO UPDATE SET
+                    title = excluded.title,
+                    content_hash = excluded.content_hash,
+                    message_count = excluded.message_count,
+                    updated_at = excluded.updated_at,
+                    deleted_at = NULL,
+                    archived_at = NULL
+            ''', rows)
+        
+        print(f"✅ Synced {len(rows)} of {len(pending)} chats for user {user_id} ({appended} message rows written)")
+        return {"success": True, "saved": len(rows), "results": results}
         
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Update existing chat
-            cursor.execute('''
-                UPDATE cloud_chats 
-                SET title = ?, messages = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (chat_data.get('title', 'Untitled'), json.dumps(chat_data.get('messages', [])), existing[0]))
-            print(f"✅ Updated chat {chat_data.get('id')} for user {user_id}")
-        else:
-            # Insert new chat
-            cursor.execute('''
-                INSERT INTO cloud_chats (user_id, chat_id, title, messages)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, chat_data.get('id', ''), chat_data.get('title', 'Untitled'), json.dumps(chat_data.get('messages', []))))
-            print(f"✅ Saved new chat {chat_data.get('id')} for user {user_id}")
-        
-        conn.commit()
-        conn.close()
-        
-        return {"success": True, "message": "Chat saved to cloud"}
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"❌ Error syncing chats to cloud: {str(e)}")
+        return {"success": False, "error": str(e)}
+
+def append_chat_messages(user_id, chat_id, messages, expected_count=None, title=None):
+    """
+    Append new messages to a cloud chat without rewriting earlier ones.
+    Creates the chat if it does not exist yet.
+    
+    If expected_count is given and the stored chat has a different number of
+    messages, nothing is written and the result is marked as a conflict.
+    """
+    try:
+        message_jsons = [json.dumps(message) for message in messages]
+        
+        with transaction(shards.path_for(user_id)) as conn:
+            existing = conn.execute(
+                'SELECT content_hash, message_count, deleted_at, archived_at FROM cloud_chats WHERE user_id = ? AND chat_id = ?',
+                (user_id, chat_id)
+            ).fetchone()
+            stored_hash, stored_count, deleted_at, archived_at = existing if existing else (migrations.EMPTY_CHAIN_HASH, 0, None, None)
+            
+            if expected_count is not None and int(expected_count) != stored_count:
+                return {
+                    "success": False,
+                    "conflict": True,
+                    "error": f"Chat has {stored_count} messages, expected {expected_count}",
+                    "message_count": stored_count
+                }
+            
+            # Continue the running hash from the stored one
+            content_hash = migrations.chain_message_hashes(message_jsons, stored_hash or migrations.EMPTY_CHAIN_HASH)[-1]
+            
+            if deleted_at is not None:
+                _reclaim_deleted_chat(conn, user_id, chat_id)
+            elif archived_at is not None:
+                _rehydrate_chat(conn, user_id, chat_id)
+            _write_chat_messages(conn, user_id, chat_id, messages, message_jsons, stored_count)
+            message_count = stored_count + len(message_jsons)
+            
+            if existing:
+                conn.execute(f'''
+                    UPDATE cloud_chats
+                    SET title = COALESCE(?, title), content_hash = ?, message_count = ?,
+                        updated_at = {NOW_MS}, deleted_at = NULL, archived_at = NULL
+                    WHERE user_id = ? AND chat_id = ?
+                ''', (title, content_hash, message_count, user_id, chat_id))
+            else:
+                conn.execute(f'''
+                    INSERT INTO cloud_chats (user_id, chat_id, title, messages, content_hash, message_count, updated_at)
+                    VALUES (?, ?, ?, '[]', ?, ?, {NOW_MS})
+                ''', (user_id, chat_id, title or 'Untitled', content_hash, message_count))
+        
+        print(f"✅ Appended {len(message_jsons)} messages to chat {chat_id} for user {user_id}")
+        return {"success": True, "message_count": message_count}
         
     except Exception as e:
-        print(f"❌ Error saving chat to cloud: {str(e)}")
+        print(f"❌ Error appending chat messages: {str(e)}")
         return {"success": False, "error": str(e)}
 
-def get_user_chats_from_cloud(user_id):
-    """Get all chats for a user from cloud"""
+def save_chat_to_cloud(user_id, chat_data):
+    """
+    Save a complete chat to cloud database.
+    With write-behind enabled the save is buffered and committed shortly
+    after, together with other saves; later saves of the same chat replace it.
+    """
+    if WRITE_BEHIND_ENABLED:
+        # Checked now: a chat the flush would reject must not be reported as queued
+        error = _chat_error(chat_data)
+        if error is None:
+            try:
+                json.dumps(chat_data.get('messages', []))
+            except (TypeError, ValueError) as e:
+                error = f"Chat messages are not valid JSON: {e}"
+        if error is not None:
+            return {"success": False, "error": error}
+        chat_writer.put(user_id, chat_data)
+        return {"success": True, "message": "Chat saved to cloud", "queued": True}
+    
+    result = sync_chats_to_cloud(user_id, [chat_data])
+    if not result['success']:
+        return result
+    
+    status = next(iter(result['results'].values()))
+    if status['status'] == 'error':
+        return {"success": False, "error": status['error']}
+    return {"success": True, "message": "Chat saved to cloud"}
+
+def _is_transient(error):
+    """Whether a database error clears up by itself, so the same write can be retried later"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def _flush_user_chats(user_id, chats):
+    """
+    Sync one user's buffered chats inside the flush transaction; if the
+    batch fails, retry it chat by chat. Chats that still fail are dropped
+    with a log line: they would fail on every retry and hold up the user's
+    later saves. Lock and busy errors are raised so the saves stay queued.
+    
+    Returns the number of chats dropped
+    """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Check if table exists
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='cloud_chats'")
-        if not cursor.fetchone():
-            print("❌ cloud_chats table doesn't exist")
-            conn.close()
-            return {}
-        
-        cursor.execute('''
-            SELECT chat_id, title, messages, created_at, updated_at 
-            FROM cloud_chats 
-            WHERE user_id = ? 
-            ORDER BY updated_at DESC
+        # Runs in a savepoint, so a failure undoes only this user's writes
+        results = sync_chats_to_cloud(user_id, chats, raise_errors=True)['results']
+    except Exception as e:
+        if _is_transient(e):
+            raise
+        print(f"⚠️ Buffered saves of user {user_id} failed ({e}), retrying chat by chat")
+        results = {}
+        for chat in chats:
+            try:
+                results.update(sync_chats_to_cloud(user_id, [chat], raise_errors=True)['results'])
+            except Exception as chat_error:
+                if _is_transient(chat_error):
+                    raise
+                results[str(chat['id'])] = {"status": "error", "error": str(chat_error)}
+    
+    rejected = {chat_id: status['error'] for chat_id, status in results.items() if status['status'] == 'error'}
+    if rejected:
+        print(f"❌ Dropped buffered chats of user {user_id} that cannot be saved: {rejected}")
+    return len(rejected)
+
+def _flush_buffered_chats(batch):
+    """
+    Commit buffered chat saves ({user_id: [chat, ...]}) in one transaction per shard.
+    Raises FlushFailed naming the users whose saves hit a locked or busy
+    database, so the buffer keeps them for a retry; everyone else's saves
+    stay committed.
+    
+    Returns the number of chats dropped because they cannot be saved
+    """
+    failed = []
+    errors = []
+    dropped = 0
+    for path, user_ids in shards.group_by_shard(batch).items():
+        shard_dropped = 0
+        try:
+            with transaction(path):
+                for user_id in user_ids:
+                    shard_dropped += _flush_user_chats(user_id, batch[user_id])
+            dropped += shard_dropped
+        except Exception as e:
+            # The shard's transaction was rolled back, including users that had succeeded
+            if _is_transient(e):
+                failed.extend(user_ids)
+                errors.append(str(e))
+                continue
+            count = sum(len(batch[user_id]) for user_id in user_ids)
+            dropped += count
+            print(f"❌ Dropped {count} buffered chats of user(s) {list(user_ids)}, shard {path} failed: {e}")
+    if failed:
+        raise FlushFailed(f"Saves of {len(failed)} user(s) not committed: {errors[0]}", failed, dropped)
+    return dropped
+
+def flush_pending_saves(user_id):
+    """Commit a user's buffered chat saves so reads see them"""
+    chat_writer.flush_user(user_id)
+
+def _load_chat_messages(conn, user_id, chat_ids=None):
+    """
+    Read messages grouped by chat.
+    Without chat_ids this is one range scan over the user's (user_id, chat_id, seq) keys,
+    skipping deleted chats whose messages have not been purged yet.
+    """
+    messages_by_chat = {}
+    if chat_ids is None:
+        rows = conn.execute('''
+            SELECT m.chat_id, m.message FROM chat_messages m
+            JOIN cloud_chats c ON c.user_id = m.user_id AND c.chat_id = m.chat_id AND c.deleted_at IS NULL
+            WHERE m.user_id = ?
+            ORDER BY m.chat_id, m.seq
         ''', (user_id,))
+        for chat_id, message_json in rows:
+            messages_by_chat.setdefault(chat_id, []).append(json.loads(decode_message(message_json)))
+        return messages_by_chat
+    
+    for chat_id in chat_ids:
+        messages_by_chat[chat_id] = [json.loads(decode_message(message_json)) for (message_json,) in conn.execute(
+            'SELECT message FROM chat_messages WHERE user_id = ? AND chat_id = ? ORDER BY seq',
+            (user_id, chat_id)
+        )]
+    return messages_by_chat
+
+def get_user_chats_from_cloud(user_id, include_archived=False):
+    """
+    Get all chats for a user from cloud.
+    Archived chats are only read when include_archived is set.
+    """
+    try:
+        # Read chats and their messages from one snapshot
+        with transaction(shards.path_for(user_id), immediate=False) as conn:
+            rows = conn.execute(f'''
+                SELECT chat_id, title, created_at, updated_at 
+                FROM cloud_chats 
+                WHERE user_id = ? AND deleted_at IS NULL{'' if include_archived else ' AND archived_at IS NULL'}
+                ORDER BY updated_at DESC
+            ''', (user_id,)).fetchall()
+            
+            messages_by_chat = _load_chat_messages(conn, user_id)
+            if include_archived:
+                messages_by_chat.update(_load_archived_messages(conn, user_id))
         
         chats = {}
-        rows = cursor.fetchall()
         
         print(f"📊 Database query returned {len(rows)} rows for user {user_id}")
         
-        for row in rows:
-            chat_id = row[0]
-            title = row[1]
-            messages_json = row[2]
-            created_at = row[3]
-            updated_at = row[4]
-            
-            try:
-                # Try to parse messages JSON
-                messages = json.loads(messages_json) if messages_json else []
-                if not isinstance(messages, list):
-                    messages = []
-            except json.JSONDecodeError as e:
-                print(f"❌ Error parsing JSON for chat {chat_id}: {e}")
-                messages = []
+        for chat_id, title, created_at, updated_at in rows:
+            messages = messages_by_chat.get(chat_id, [])
             
             chats[chat_id] = {
                 'id': chat_id,
@@ -409,10 +939,7 @@ def get_user_chats_from_cloud(user_id):
                 'date': created_at,
                 'updated': updated_at
             }
-            
-            print(f"  ✅ Loaded chat: {chat_id} with {len(messages)} messages")
         
-        conn.close()
         print(f"📥 Total loaded {len(chats)} chats from cloud for user {user_id}")
         return chats
         
@@ -421,19 +948,431 @@ def get_user_chats_from_cloud(user_id):
         import traceback
         traceback.print_exc()
         return {}
-def delete_chat_from_cloud(user_id, chat_id):
-    """Delete a chat from cloud"""
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
+
+def get_chat_changes_from_cloud(user_id, since):
+    """
+    Get chats created, updated or deleted at or after the since watermark.
+    
+    The comparison is inclusive so a write landing in the same millisecond
+    as the watermark is never missed; clients may see a boundary chat twice.
+    
+    Returns (chats, deleted_chat_ids)
+    """
+    with transaction(shards.path_for(user_id), immediate=False) as conn:
+        rows = conn.execute('''
+            SELECT chat_id, title, created_at, updated_at, deleted_at
+            FROM cloud_chats
+            WHERE user_id = ? AND updated_at >= ?
+            ORDER BY updated_at DESC
+        ''', (user_id, since)).fetchall()
         
-        cursor.execute(
-            'DELETE FROM cloud_chats WHERE user_id = ? AND chat_id = ?',
-            (user_id, chat_id)
-        )
+        live_ids = [row[0] for row in rows if row[4] is None]
+        messages_by_chat = _load_chat_messages(conn, user_id, live_ids)
+        messages_by_chat.update(_load_archived_messages(conn, user_id, live_ids))
+    
+    chats = {}
+    deleted = []
+    for chat_id, title, created_at, updated_at, deleted_at in rows:
+        if deleted_at is not None:
+            deleted.append(chat_id)
+            continue
+        chats[chat_id] = {
+            'id': chat_id,
+            'title': title,
+            'messages': messages_by_chat.get(chat_id, []),
+            'date': created_at,
+            'updated': updated_at
+        }
+    
+    print(f"📥 Delta sync for user {user_id} since {since}: {len(chats)} changed, {len(deleted)} deleted")
+    return chats, deleted
+
+def stream_user_chats_json(user_id, since=None, watermark=None, include_archived=False):
+    """
+    Generate the /api/chats/load response body as JSON text fragments.
+    
+    Stored messages are already valid JSON (they are written with json.dumps),
+    so after decompression they are spliced into the output as-is instead of
+    being parsed and re-encoded. Memory use is bounded by STREAM_CHUNK_SIZE, not history size.
+    
+    Args:
+        user_id: Owner of the chats
+        since: Optional watermark; only chats changed at or after it are included,
+               and deleted chats are reported in "deleted"
+        watermark: Value to report as the new sync watermark
+        include_archived: Also include archived chats in a full load; changes
+               since a watermark always include them
+    """
+    if since:
+        where = 'c.user_id = ? AND c.updated_at >= ?'
+        params = (user_id, since)
+    else:
+        where = 'c.user_id = ? AND c.deleted_at IS NULL'
+        params = (user_id,)
+        if not include_archived:
+            where += ' AND c.archived_at IS NULL'
+    
+    parts = ['{"success": true, "chats": {']
+    size = 0
+    deleted = []
+    current_chat = None
+    first_message = True
+    
+    # One snapshot for the whole response; the read ends if the client goes away
+    with transaction(shards.path_for(user_id), immediate=False) as conn:
+        rows = conn.execute(f'''
+            SELECT c.chat_id, c.title, c.created_at, c.updated_at, c.deleted_at,
+                   a.message_count, a.messages, m.message
+            FROM cloud_chats c
+            LEFT JOIN chat_archive a
+                ON a.user_id = c.user_id AND a.chat_id = c.chat_id AND c.deleted_at IS NULL
+            LEFT JOIN chat_messages m
+                ON m.user_id = c.user_id AND m.chat_id = c.chat_id AND c.deleted_at IS NULL
+            WHERE {where}
+            ORDER BY c.updated_at DESC, c.chat_id DESC, m.seq
+        ''', params)
+        
+        for chat_id, title, created_at, updated_at, deleted_at, archived_count, archived, stored_message in rows:
+            if deleted_at is not None:
+                deleted.append(chat_id)
+                continue
+            
+            if chat_id != current_chat:
+                header = json.dumps(chat_id) + ': ' + json.dumps({
+                    'id': chat_id,
+                    'title': title,
+                    'date': created_at,
+                    'updated': updated_at
+                })[:-1] + ', "messages": ['
+                parts.append(header if current_chat is None else ']}, ' + header)
+                current_chat = chat_id
+                first_message = True
+            
+            if stored_message is not None:
+                # Decompression only - the JSON itself is never parsed
+                message_json = decode_message(stored_message)
+                parts.append(message_json if first_message else ', ' + message_json)
+                first_message = False
+                size += len(message_json)
+            elif archived is not None and archived_count:
+                # An archived chat has no message rows, its messages are one JSON-lines blob
+                message_json = ', '.join(_archived_message_jsons(archived, archived_count))
+                parts.append(message_json)
+                size += len(message_json)
+            
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(parts)
+                parts = []
+                size = 0
+    
+    if current_chat is not None:
+        parts.append(']}')
+    parts.append('}, "deleted": ' + json.dumps(deleted))
+    parts.append(', "full": ' + json.dumps(not since))
+    parts.append(', "watermark": ' + json.dumps(watermark) + '}')
+    yield ''.join(parts)
+
+def stream_user_chats_ndjson(user_id):
+    """
+    Generate a user's chats as NDJSON for /api/chats/export.
+    
+    Each chat (archived ones included) is a "chat" line followed by one
+    "message" line per message, and a final "end" line carries the totals
+    so truncated exports can be detected. Rows come from one cursor in (chat_id, seq) key order, which
+    needs no sort, and stored message JSON is spliced in without parsing,
+    so memory use is bounded by STREAM_CHUNK_SIZE however large the account is.
+    """
+    parts = []
+    size = 0
+    chats = messages = 0
+    current_chat = None
+    
+    with transaction(shards.path_for(user_id), immediate=False) as conn:
+        rows = conn.execute('''
+            SELECT c.chat_id, c.title, c.created_at, c.updated_at, c.message_count,
+                   a.message_count, a.messages, m.message
+            FROM cloud_chats c
+            LEFT JOIN chat_archive a ON a.user_id = c.user_id AND a.chat_id = c.chat_id
+            LEFT JOIN chat_messages m ON m.user_id = c.user_id AND m.chat_id = c.chat_id
+            WHERE c.user_id = ? AND c.deleted_at IS NULL
+            ORDER BY c.chat_id, m.seq
+        ''', (user_id,))
         
-        conn.commit()
-        conn.close()
+        for chat_id, title, created_at, updated_at, message_count, archived_count, archived, stored_message in rows:
+            if chat_id != current_chat:
+                line = json.dumps({
+                    'type': 'chat',
+                    'id': chat_id,
+                    'title': title,
+                    'date': created_at,
+                    'updated': updated_at,
+                    'message_count': message_count
+                }) + '\n'
+                parts.append(line)
+                size += len(line)
+                current_chat = chat_id
+                chats += 1
+            
+            if stored_message is not None:
+                message_jsons = [decode_message(stored_message)]
+            elif archived is not None:
+                # Archived chats are exported as they are, without rehydrating them
+                message_jsons = _archived_message_jsons(archived, archived_count)
+            else:
+                message_jsons = []
+            
+            for message_json in message_jsons:
+                line = '{"type": "message", "chat_id": ' + json.dumps(chat_id) + ', "message": ' + message_json + '}\n'
+                parts.append(line)
+                size += len(line)
+                messages += 1
+            
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(parts)
+                parts = []
+                size = 0
+    
+    parts.append(json.dumps({'type': 'end', 'chats': chats, 'messages': messages}) + '\n')
+    yield ''.join(parts)
+
+def _ndjson_records(lines):
+    """Parse NDJSON lines into (line number, object, line length), skipping blank lines"""
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON ({e})")
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {line_number}: expected a JSON object")
+        yield line_number, record, len(line)
+
+def _import_batches(records):
+    """
+    Group parsed NDJSON lines into batches of at most IMPORT_BATCH_SIZE
+    lines and IMPORT_BATCH_BYTES bytes; a longer line is a batch by itself
+    """
+    batch = []
+    size = 0
+    for line_number, record, length in records:
+        if batch and (len(batch) >= IMPORT_BATCH_SIZE or size + length > IMPORT_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append((line_number, record))
+        size += length
+    if batch:
+        yield batch
+
+def import_chats_ndjson(user_id, lines):
+    """
+    Import chats from NDJSON lines: the /api/chats/export format, or one
+    whole chat ({"id", "title", "messages": [...]}) per line.
+    
+    Lines are consumed as they arrive and written in transactions of at
+    most IMPORT_BATCH_SIZE lines and IMPORT_BATCH_BYTES bytes, so neither
+    memory nor the write lock grows with the size of the import. An imported chat replaces a stored chat
+    with the same id. If a line is invalid, the batches before it stay
+    imported and the counts say how far the import got.
+    """
+    path = shards.path_for(user_id)
+    batches = _import_batches(_ndjson_records(lines))
+    imported = {'chats': 0, 'messages': 0}
+    current = None  # [chat_id, messages written, content hash] of the chat being imported
+    pending = []  # (message, message_json) of the current chat, not written yet
+    
+    def write_pending(conn):
+        if not pending:
+            return
+        chat_id, count, content_hash = current
+        messages = [message for message, _ in pending]
+        message_jsons = [message_json for _, message_json in pending]
+        _write_chat_messages(conn, user_id, chat_id, messages, message_jsons, count)
+        current[1] = count + len(pending)
+        current[2] = migrations.chain_message_hashes(message_jsons, content_hash)[-1]
+        conn.execute(f'''
+            UPDATE cloud_chats SET message_count = ?, content_hash = ?, updated_at = {NOW_MS}
+            WHERE user_id = ? AND chat_id = ?
+        ''', (current[1], current[2], user_id, chat_id))
+        batch['messages'] += len(pending)
+        pending.clear()
+    
+    def start_chat(conn, line_number, record):
+        nonlocal current
+        chat_id = record.get('id')
+        if not isinstance(chat_id, str) or not chat_id:
+            raise ValueError(f"Line {line_number}: chat without an id")
+        write_pending(conn)
+        
+        # Replace whatever is stored under this id, including leftovers of a deleted chat
+        conn.execute('DELETE FROM purge_queue WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+        _delete_chat_messages(conn, user_id, chat_id)
+        conn.execute(f'''
+            INSERT INTO cloud_chats (user_id, chat_id, title, messages, content_hash, message_count, created_at, updated_at)
+            VALUES (?, ?, ?, '[]', ?, 0, COALESCE(?, CURRENT_TIMESTAMP), {NOW_MS})
+            ON CONFLICT (user_id, chat_id) DO UPDATE SET
+                title = excluded.title,
+                content_hash = excluded.content_hash,
+                message_count = 0,
+                updated_at = excluded.updated_at,
+                deleted_at = NULL,
+                archived_at = NULL
+        ''', (user_id, chat_id, record.get('title') or 'Untitled', migrations.EMPTY_CHAIN_HASH, record.get('date')))
+        current = [chat_id, 0, migrations.EMPTY_CHAIN_HASH]
+        batch['chats'] += 1
+    
+    def add_message(line_number, message):
+        if current is None:
+            raise ValueError(f"Line {line_number}: message before any chat")
+        if not isinstance(message, dict):
+            raise ValueError(f"Line {line_number}: message must be a JSON object")
+        pending.append((message, json.dumps(message)))
+    
+    try:
+        # Each batch is read and parsed before taking the write lock,
+        # so a slow upload never holds up other writers
+        for items in batches:
+            batch = {'chats': 0, 'messages': 0}
+            with transaction(path) as conn:
+                for line_number, record in items:
+                    kind = record.get('type')
+                    if kind == 'chat':
+                        start_chat(conn, line_number, record)
+                    elif kind == 'message':
+                        if current is None or record.get('chat_id', current[0]) != current[0]:
+                            raise ValueError(f"Line {line_number}: message does not follow its chat line")
+                        add_message(line_number, record.get('message'))
+                    elif kind is None and isinstance(record.get('messages'), list):
+                        start_chat(conn, line_number, record)
+                        for message in record['messages']:
+                            add_message(line_number, message)
+                    elif kind != 'end':
+                        raise ValueError(f"Line {line_number}: unknown record type {kind!r}")
+                write_pending(conn)
+            imported['chats'] += batch['chats']
+            imported['messages'] += batch['messages']
+        
+        print(f"✅ Imported {imported['chats']} chats ({imported['messages']} messages) for user {user_id}")
+        return {"success": True, **imported}
+        
+    except Exception as e:
+        print(f"❌ Error importing chats after {imported['chats']} chats: {str(e)}")
+        return {"success": False, "error": str(e), **imported}
+
+def search_user_chats(user_id, query, limit, offset=0):
+    """
+    Full-text search across a user's chat messages.
+    
+    Returns:
+        List of results (chat_id, chat title, message seq, highlighted snippet), best first
+    """
+    return chat_search.search(get_connection(shards.path_for(user_id)), user_id, query, limit, offset, _search_texts)
+
+def list_user_chats(user_id, limit, after=None, include_archived=False):
+    """
+    List a page of a user's chats, newest first, without reading messages.
+    
+    Args:
+        user_id: Owner of the chats
+        limit: Maximum number of chats to return
+        after: (updated_at, chat_id) of the last chat on the previous page
+        include_archived: Also list archived chats (flagged "archived")
+        
+    Returns:
+        (chats, next_after) where next_after is None on the last page
+    """
+    conn = get_connection(shards.path_for(user_id))
+    
+    # Keyset pagination served entirely from idx_cloud_chats_listing
+    hot_only = '' if include_archived else ' AND archived_at IS NULL'
+    if after:
+        rows = conn.execute(f'''
+            SELECT chat_id, title, created_at, updated_at, message_count, archived_at
+            FROM cloud_chats
+            WHERE user_id = ? AND deleted_at IS NULL{hot_only} AND (updated_at, chat_id) < (?, ?)
+            ORDER BY updated_at DESC, chat_id DESC
+            LIMIT ?
+        ''', (user_id, after[0], after[1], limit + 1)).fetchall()
+    else:
+        rows = conn.execute(f'''
+            SELECT chat_id, title, created_at, updated_at, message_count, archived_at
+            FROM cloud_chats
+            WHERE user_id = ? AND deleted_at IS NULL{hot_only}
+            ORDER BY updated_at DESC, chat_id DESC
+            LIMIT ?
+        ''', (user_id, limit + 1)).fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    chats = [{
+        'id': chat_id,
+        'title': title,
+        'date': created_at,
+        'updated': updated_at,
+        'message_count': message_count,
+        'archived': archived_at is not None
+    } for chat_id, title, created_at, updated_at, message_count, archived_at in rows]
+    
+    next_after = (rows[-1][3], rows[-1][0]) if has_more else None
+    return chats, next_after
+
+def get_chat_messages(user_id, chat_id, start=0, limit=None):
+    """
+    Fetch one chat's messages, optionally a range of them.
+    
+    An archived chat is rehydrated first, so later reads page through rows.
+    
+    Returns:
+        Dict with messages and message_count, or None if the chat does not exist
+    """
+    conn = get_connection(shards.path_for(user_id))
+    
+    chat = conn.execute(
+        'SELECT title, message_count, archived_at FROM cloud_chats WHERE user_id = ? AND chat_id = ? AND deleted_at IS NULL',
+        (user_id, chat_id)
+    ).fetchone()
+    if not chat:
+        return None
+    
+    if chat[2] is not None:
+        with transaction(shards.path_for(user_id)) as conn:
+            # Re-check inside the write lock, another request may have rehydrated it
+            if conn.execute(
+                'SELECT archived_at FROM cloud_chats WHERE user_id = ? AND chat_id = ?', (user_id, chat_id)
+            ).fetchone()[0] is not None:
+                _rehydrate_chat(conn, user_id, chat_id)
+    
+    # A negative LIMIT means no limit in SQLite
+    rows = conn.execute('''
+        SELECT message FROM chat_messages
+        WHERE user_id = ? AND chat_id = ? AND seq >= ?
+        ORDER BY seq
+        LIMIT ?
+    ''', (user_id, chat_id, start, -1 if limit is None else limit)).fetchall()
+    
+    return {
+        'id': chat_id,
+        'title': chat[0],
+        'message_count': chat[1],
+        'messages': [json.loads(decode_message(row[0])) for row in rows]
+    }
+
+def delete_chat_from_cloud(user_id, chat_id):
+    """
+    Delete a chat from cloud.
+    Only the tombstone is written here; purge_deleted() removes the messages later.
+    """
+    try:
+        with transaction(shards.path_for(user_id)) as conn:
+            # Keep a tombstone so other devices learn about the deletion
+            if conn.execute(f'''
+                UPDATE cloud_chats
+                SET deleted_at = {NOW_MS}, updated_at = {NOW_MS}, content_hash = ?, message_count = 0
+                WHERE user_id = ? AND chat_id = ? AND deleted_at IS NULL
+            ''', (migrations.EMPTY_CHAIN_HASH, user_id, chat_id)).rowcount:
+                conn.execute('INSERT INTO purge_queue (user_id, chat_id) VALUES (?, ?)', (user_id, chat_id))
         
         return {"success": True, "message": "Chat deleted from cloud"}
         
@@ -441,75 +1380,79 @@ def delete_chat_from_cloud(user_id, chat_id):
         print(f"❌ Error deleting chat from cloud: {str(e)}")
         return {"success": False, "error": str(e)}
 
-def delete_user_account(email, password):
-    """Delete a user account and all associated data"""
+def delete_user_account(email, password, session_user_id=None):
+    """
+    Delete a user account and all associated data.
+    The password check is skipped for the user of a recently authenticated session.
+    """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
         # First verify the user exists and password is correct
-        cursor.execute(
+        user = get_connection().execute(
             'SELECT id, password_hash FROM users WHERE email = ?',
             (email,)
-        )
-        user = cursor.fetchone()
+        ).fetchone()
         
         if not user:
-            conn.close()
             return {"success": False, "error": "User not found"}
         
         user_id = user[0]
         password_hash = user[1]
         
         # Verify password
-        if not check_password_hash(password_hash, password):
-            conn.close()
+        if session_user_id != user_id and not password_hasher.verify(password_hash, password or ''):
             return {"success": False, "error": "Incorrect password"}
         
-        # Delete all user's chats first
-        cursor.execute('DELETE FROM cloud_chats WHERE user_id = ?', (user_id,))
-        cursor.execute('DELETE FROM user_chats WHERE user_id = ?', (user_id,))
+        # Buffered saves must not recreate chats after the account is gone
+        chat_writer.discard_user(user_id)
         
-        # Delete the user account
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        # Queue the user's chats for the purge job first, in their shard; if
+        # deleting the account then fails, retrying finds the user and finishes
+        # the job. User ids are AUTOINCREMENT, so no new account inherits the rows.
+        with transaction(shards.path_for(user_id)) as conn:
+            conn.execute('INSERT INTO purge_queue (user_id, chat_id) VALUES (?, NULL)', (user_id,))
         
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            before = user_directory.version(conn)
+            # Delete the user account
+            removed = conn.execute('SELECT email, username FROM users WHERE id = ?', (user_id,)).fetchone()
+            conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            after = user_directory.version(conn)
+        user_directory.apply(before, after, removed=removed)
         
         print(f"✅ Account deleted for user: {email}")
         return {"success": True, "message": "Account deleted successfully"}
         
+    except HashingBusy:
+        raise
     except Exception as e:
         print(f"❌ Error deleting account: {str(e)}")
         return {"success": False, "error": str(e)}
 
+def get_token_generation(user_id):
+    """A user's session token generation, or None if the account no longer exists (see session_tokens.py)"""
+    row = get_connection().execute('SELECT token_generation FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
 def reset_password(email, new_password):
     """Reset user password (called after email verification)"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
         # Check if user exists
-        cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-        user = cursor.fetchone()
-        
-        if not user:
-            conn.close()
+        if not get_connection().execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone():
             return {"success": False, "error": "User not found"}
         
         # Hash new password and update
-        new_password_hash = generate_password_hash(new_password)
-        cursor.execute(
-            "UPDATE users SET password_hash = ? WHERE email = ?",
-            (new_password_hash, email)
-        )
-        
-        conn.commit()
-        conn.close()
+        new_password_hash = password_hasher.hash(new_password)
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE users SET password_hash = ?, token_generation = token_generation + 1 WHERE email = ?",
+                (new_password_hash, email)
+            )
         
         print(f"✅ Password reset for user: {email}")
         return {"success": True, "message": "Password reset successfully"}
         
+    except HashingBusy:
+        raise
     except Exception as e:
         print(f"❌ Error resetting password: {str(e)}")
         return {"success": False, "error": str(e)}
@@ -520,16 +1463,11 @@ def check_email_exists(email):
         # Normalize email to lowercase for consistent matching
         email = email.lower().strip()
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT username FROM users WHERE email = ?', (email,))
-        user = cursor.fetchone()
-        conn.close()
+        user = user_directory.lookup_email(email)
         
         if user:
-            print(f"✅ Email found: {email} (user: {user[0]})")
-            return {"success": True, "exists": True, "username": user[0]}
+            print(f"✅ Email found: {email} (user: {user[1]})")
+            return {"success": True, "exists": True, "username": user[1]}
         else:
             print(f"❌ Email not found: {email}")
             return {"success": True, "exists": False}
@@ -538,5 +1476,398 @@ def check_email_exists(email):
         print(f"❌ Error in check_email_exists: {str(e)}")
         return {"success": False, "error": str(e)}
 
+def find_user_id(email=None, username=None):
+    """Return the id of the user with this email or username, or None"""
+    if email is not None:
+        user = user_directory.lookup_email(email)
+        return user[0] if user else None
+    return user_directory.lookup_username(username)
+
+def get_last_sync(user_id):
+    """
+    Get the most recent cloud update time for a user's chats.
+    Includes deletions, so it doubles as the delta sync watermark.
+    """
+    return get_connection(shards.path_for(user_id)).execute('''
+        SELECT MAX(updated_at) FROM cloud_chats 
+        WHERE user_id = ?
+    ''', (user_id,)).fetchone()[0]
+
+def get_chat_totals(path=None):
+    """Counter row of one chat database, as {column: value}"""
+    columns = migrations.CHAT_STAT_COLUMNS
+    row = get_connection(path).execute(f"SELECT {', '.join(columns)} FROM chat_totals WHERE id = 0").fetchone()
+    return dict(zip(columns, row))
+
+def get_stats():
+    """
+    Users, chats, messages and bytes stored, read from the trigger-maintained
+    counters - a handful of point reads however large the database grows
+    """
+    totals = dict.fromkeys(migrations.CHAT_STAT_COLUMNS, 0)
+    for path in shards.paths():
+        for column, value in get_chat_totals(path).items():
+            totals[column] += value
+    users = get_connection().execute('SELECT users FROM user_totals WHERE id = 0').fetchone()[0]
+    return {"users": users, **totals}
+
+def get_user_stats(user_id):
+    """One user's stored chat, message and byte counts"""
+    columns = migrations.CHAT_STAT_COLUMNS
+    row = get_connection(shards.path_for(user_id)).execute(
+        f"SELECT {', '.join(columns)} FROM user_chat_stats WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    return dict(zip(columns, row or (0,) * len(columns)))
+
+def get_database_info():
+    """Collect table names, row counts and users table structure for debugging"""
+    # Chat tables are counted across every shard
+    shard_counts = []
+    for path in shards.paths():
+        totals = get_chat_totals(path)
+        shard_counts.append({
+            "path": path or DATABASE_PATH,
+            "user_chats": totals['legacy_chats'],
+            "cloud_chats": totals['chats'] + totals['deleted_chats'],
+        })
+    
+    return {
+        "schema_version": migrations.get_schema_version(get_connection()),
+        "tables": _schema_info['tables'],
+        "users_count": get_stats()['users'],
+        "user_chats_count": sum(shard['user_chats'] for shard in shard_counts),
+        "cloud_chats_count": sum(shard['cloud_chats'] for shard in shard_counts),
+        "chat_shards": shard_counts,
+        "user_directory": user_directory.stats(),
+        "write_behind": chat_writer.stats(),
+        "storage": get_storage_stats(),
+        "users_structure": _schema_info['users_structure']
+    }
+
+_recompress_state = {'shard': 0, 'position': (-1, '', -1), 'done': False, 'rows_rewritten': 0}
+
+def recompress_messages(batch_size=RECOMPRESS_BATCH_SIZE):
+    """
+    Re-encode one batch of stored messages in the current storage format.
+    Walks each shard's chat_messages in key order; returns True while rows remain.
+    """
+    if _recompress_state['done']:
+        return False
+    
+    with transaction(shards.path(_recompress_state['shard'])) as conn:
+        rows = conn.execute('''
+            SELECT user_id, chat_id, seq, message FROM chat_messages
+            WHERE (user_id, chat_id, seq) > (?, ?, ?)
+            ORDER BY user_id, chat_id, seq
+            LIMIT ?
+        ''', (*_recompress_state['position'], batch_size)).fetchall()
+        
+        updates = []
+        for user_id, chat_id, seq, stored in rows:
+            encoded = encode_message(decode_message(stored))
+            if encoded != stored:
+                updates.append((encoded, user_id, chat_id, seq))
+        
+        conn.executemany(
+            'UPDATE chat_messages SET message = ? WHERE user_id = ? AND chat_id = ? AND seq = ?',
+            updates
+        )
+    
+    _recompress_state['rows_rewritten'] += len(updates)
+    if len(rows) < batch_size and _recompress_state['shard'] + 1 < shards.count:
+        # This shard is done, continue with the next one
+        _recompress_state['shard'] += 1
+        _recompress_state['position'] = (-1, '', -1)
+        return True
+    if len(rows) < batch_size:
+        _recompress_state['done'] = True
+        if _recompress_state['rows_rewritten']:
+            print(f"🗜️ Recompressed {_recompress_state['rows_rewritten']} stored messages")
+        return False
+    
+    _recompress_state['position'] = rows[-1][:3]
+    return True
+
+_recheck_state = {'shard': 0, 'after': -1, 'passes': 0, 'corrections': 0, 'last_pass_at': None}
+
+def _recount_user(conn, user_id):
+    """Actual counters of one user, in CHAT_STAT_COLUMNS order"""
+    chats, deleted_chats = conn.execute(
+        'SELECT COALESCE(SUM(deleted_at IS NULL), 0), COALESCE(SUM(deleted_at IS NOT NULL), 0) FROM cloud_chats WHERE user_id = ?',
+        (user_id,)
+    ).fetchone()
+    messages, message_bytes = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(length(CAST(message AS BLOB))), 0) FROM chat_messages WHERE user_id = ?',
+        (user_id,)
+    ).fetchone()
+    archived_messages, archived_bytes = conn.execute(
+        'SELECT COALESCE(SUM(message_count), 0), COALESCE(SUM(length(messages)), 0) FROM chat_archive WHERE user_id = ?',
+        (user_id,)
+    ).fetchone()
+    messages += archived_messages
+    message_bytes += archived_bytes
+    legacy_chats = conn.execute('SELECT COUNT(*) FROM user_chats WHERE user_id = ?', (user_id,)).fetchone()[0]
+    return (chats, deleted_chats, messages, message_bytes, legacy_chats)
+
+def recheck_stats(batch_size=STATS_RECHECK_BATCH_SIZE):
+    """
+    Recount one batch of users in one shard and correct counters that drifted.
+    Walks every shard in user order; at the end of a shard the totals row is
+    checked against the per-user rows, and at the end of a pass the users count.
+    Returns True while the pass is unfinished.
+    """
+    columns = migrations.CHAT_STAT_COLUMNS
+    corrections = 0
+    with transaction(shards.path(_recheck_state['shard'])) as conn:
+        # Next users by id from every table that has counters
+        user_ids = set()
+        for table in ('user_chat_stats', 'cloud_chats', 'chat_messages', 'chat_archive', 'user_chats'):
+            user_ids.update(row[0] for row in conn.execute(
+                f'SELECT DISTINCT user_id FROM {table} WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                (_recheck_state['after'], batch_size)
+            ))
+        # Same order as SQLite: numbers before text
+        batch = sorted(user_ids, key=lambda user_id: (isinstance(user_id, str), user_id))[:batch_size]
+        
+        placeholders = ','.join('?' * len(batch))
+        stored = {row[0]: tuple(row[1:]) for row in conn.execute(
+            f"SELECT user_id, {', '.join(columns)} FROM user_chat_stats WHERE user_id IN ({placeholders})", batch
+        )}
+        for user_id in batch:
+            actual = _recount_user(conn, user_id)
+            if stored.get(user_id, (0,) * len(columns)) == actual:
+                continue
+            corrections += 1
+            print(f"⚠️ Chat stats of user {user_id} drifted: stored {stored.get(user_id)}, actual {actual}")
+            conn.execute(f'''
+                INSERT OR REPLACE INTO user_chat_stats (user_id, {', '.join(columns)})
+                VALUES (?, {', '.join('?' * len(columns))})
+            ''', (user_id, *actual))
+        
+        shard_done = len(user_ids) < batch_size
+        if shard_done:
+            sums = conn.execute(
+                f"SELECT {', '.join(f'COALESCE(SUM({column}), 0)' for column in columns)} FROM user_chat_stats"
+            ).fetchone()
+            if tuple(get_chat_totals(shards.path(_recheck_state['shard'])).values()) != tuple(sums):
+                corrections += 1
+                print(f"⚠️ Chat totals drifted, resetting to {dict(zip(columns, sums))}")
+                conn.execute(
+                    f"UPDATE chat_totals SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = 0", sums
+                )
+    
+    _recheck_state['corrections'] += corrections
+    if not shard_done:
+        _recheck_state['after'] = batch[-1]
+        return True
+    
+    _recheck_state['after'] = -1
+    if _recheck_state['shard'] + 1 < shards.count:
+        _recheck_state['shard'] += 1
+        return True
+    
+    with transaction() as conn:
+        users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        if conn.execute('UPDATE user_totals SET users = ? WHERE id = 0 AND users != ?', (users, users)).rowcount:
+            _recheck_state['corrections'] += 1
+            print(f"⚠️ Users count drifted, reset to {users}")
+    _recheck_state['shard'] = 0
+    _recheck_state['passes'] += 1
+    _recheck_state['last_pass_at'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    return False
+
+def get_recheck_status():
+    """Progress and findings of the stats consistency job in this process"""
+    return {key: _recheck_state[key] for key in ('passes', 'corrections', 'last_pass_at')}
+
+def _database_paths():
+    """The main database and every chat shard (None is the main database)"""
+    return list(dict.fromkeys([None, *shards.paths()]))
+
+def _purge_batch(conn, user_id, chat_id, limit):
+    """
+    Delete up to limit leftover rows of one deleted chat, or of every chat
+    of a deleted account when chat_id is None. Returns rows deleted.
+    """
+    if chat_id is None:
+        scope, params = 'user_id = ?', (user_id,)
+    else:
+        scope, params = 'user_id = ? AND chat_id = ?', (user_id, chat_id)
+    
+    # Index entries go first, while the messages they were built from are still stored
+    deleted = 0
+    for indexed_chat_id in chat_search.indexed_chats(conn, user_id) if chat_id is None else [chat_id]:
+        if deleted < limit:
+            deleted += _unindex_chat(conn, user_id, indexed_chat_id, limit - deleted)
+    if deleted < limit:
+        deleted += conn.execute(f'''
+            DELETE FROM chat_messages WHERE (user_id, chat_id, seq) IN (
+                SELECT user_id, chat_id, seq FROM chat_messages WHERE {scope} LIMIT ?
+            )
+        ''', (*params, limit - deleted)).rowcount
+    if deleted < limit:
+        # Archived messages are one row per chat
+        deleted += conn.execute(f'''
+            DELETE FROM chat_archive WHERE (user_id, chat_id) IN (
+                SELECT user_id, chat_id FROM chat_archive WHERE {scope} LIMIT ?
+            )
+        ''', (*params, limit - deleted)).rowcount
+    
+    # A deleted account also loses its chat rows, tombstones included
+    for table in ('cloud_chats', 'user_chats') if chat_id is None else ():
+        if deleted < limit:
+            deleted += conn.execute(
+                f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE user_id = ? LIMIT ?)',
+                (user_id, limit - deleted)
+            ).rowcount
+    return deleted
+
+def purge_deleted(batch_size=PURGE_BATCH_SIZE):
+    """
+    Remove one batch of rows left behind by deleted chats and accounts in
+    each shard, oldest deletion first. Returns True while work remains.
+    """
+    more = False
+    for path in shards.paths():
+        with transaction(path) as conn:
+            item = conn.execute('SELECT id, user_id, chat_id FROM purge_queue ORDER BY id LIMIT 1').fetchone()
+            if item is None:
+                continue
+            queue_id, user_id, chat_id = item
+            
+            deleted = _purge_batch(conn, user_id, chat_id, batch_size)
+            if deleted < batch_size:
+                conn.execute('DELETE FROM purge_queue WHERE id = ?', (queue_id,))
+                if chat_id is None:
+                    # Every counter of the account is zero now
+                    conn.execute('DELETE FROM user_chat_stats WHERE user_id = ?', (user_id,))
+            else:
+                conn.execute('UPDATE purge_queue SET rows_purged = rows_purged + ? WHERE id = ?', (deleted, queue_id))
+            more = more or conn.execute('SELECT EXISTS (SELECT 1 FROM purge_queue)').fetchone()[0]
+    return bool(more)
+
+_archive_stats = {'archived': 0, 'rehydrated': 0}  # chats moved by this process
+
+def archive_cold_chats(batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move chats untouched (not written or rehydrated) for ARCHIVE_AFTER_DAYS
+    into chat_archive, one batch per shard. Returns True while more remain.
+    """
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return False
+    
+    age = f'-{ARCHIVE_AFTER_DAYS} days'
+    more = False
+    for path in shards.paths():
+        with transaction(path) as conn:
+            rows = conn.execute('''
+                SELECT user_id, chat_id FROM cloud_chats
+                WHERE deleted_at IS NULL AND archived_at IS NULL
+                  AND updated_at < strftime('%Y-%m-%d %H:%M:%f', 'now', ?)
+                  AND (accessed_at IS NULL OR accessed_at < strftime('%Y-%m-%d %H:%M:%f', 'now', ?))
+                LIMIT ?
+            ''', (age, age, batch_size)).fetchall()
+            for user_id, chat_id in rows:
+                _archive_chat(conn, user_id, chat_id)
+        _archive_stats['archived'] += len(rows)
+        more = more or len(rows) == batch_size
+    return more
+
+def vacuum_free_pages(pages=VACUUM_PAGES):
+    """
+    Return free pages of each database file to the filesystem with
+    incremental_vacuum, at most `pages` per file per run. Returns True
+    while files still have more free pages than that.
+    """
+    more = False
+    for path in _database_paths():
+        conn = get_connection(path)
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if AUTO_VACUUM_MODES[mode] == 'none':
+            if VACUUM_CONVERT:
+                # auto_vacuum can only be switched on by rebuilding the file
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('VACUUM')
+                print(f"🧹 Enabled incremental auto_vacuum on {os.path.basename(path or DATABASE_PATH)}")
+            continue
+        if AUTO_VACUUM_MODES[mode] != 'incremental':
+            continue
+        
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if free_pages < VACUUM_MIN_FREE_PAGES:
+            continue
+        # execute() steps this pragma only once (one page); executescript runs it to completion
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        more = more or free_pages > pages
+    return more
+
+def get_storage_stats():
+    """Deletion backlog and file space of every database file"""
+    queue = {'chats': 0, 'accounts': 0, 'rows_purged': 0, 'oldest_queued_at': None}
+    for path in shards.paths():
+        # Trigger-maintained counters and an indexed MIN, so the backlog size costs nothing
+        chats, accounts, rows_purged, oldest = get_connection(path).execute('''
+            SELECT chats, accounts, rows_purged, (SELECT MIN(queued_at) FROM purge_queue)
+            FROM purge_totals WHERE id = 0
+        ''').fetchone()
+        queue['chats'] += chats
+        queue['accounts'] += accounts
+        queue['rows_purged'] += rows_purged
+        if oldest is not None and (queue['oldest_queued_at'] is None or oldest < queue['oldest_queued_at']):
+            queue['oldest_queued_at'] = oldest
+    
+    files = []
+    for path in _database_paths():
+        conn = get_connection(path)
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        files.append({
+            "path": path or DATABASE_PATH,
+            "size_bytes": page_size * conn.execute('PRAGMA page_count').fetchone()[0],
+            "free_bytes": page_size * conn.execute('PRAGMA freelist_count').fetchone()[0],
+            "auto_vacuum": AUTO_VACUUM_MODES[conn.execute('PRAGMA auto_vacuum').fetchone()[0]],
+        })
+    
+    return {"purge_queue": queue, "archive": dict(_archive_stats), "files": files, "jobs": jobs.status()}
+
+_cleanup_progress = {'checked': None, 'value': None}  # last get_cleanup_progress result of this process
+
+def get_cleanup_progress():
+    """
+    Summary of get_storage_stats for /api/stats: the purge backlog, chats
+    archived and rehydrated by this process, and free space incremental
+    vacuum has yet to return to the filesystem.
+    Reused for CLEANUP_STATS_MAX_AGE seconds, since /api/stats is polled.
+    """
+    now = time.monotonic()
+    checked = _cleanup_progress['checked']
+    if checked is not None and now - checked < CLEANUP_STATS_MAX_AGE:
+        return _cleanup_progress['value']
+    
+    storage = get_storage_stats()
+    value = {
+        "purge_queue": storage["purge_queue"],
+        "archive": storage["archive"],
+        "reclaimable_bytes": sum(file["free_bytes"] for file in storage["files"]),
+    }
+    _cleanup_progress.update(checked=now, value=value)
+    return value
+
 # Initialize database when module is imported
 init_db()
+
+# Email/username lookups answered from memory, loaded once at startup
+user_directory = UserDirectory(get_connection)
+user_directory.refresh(force=True)
+
+# Buffered /api/chats/save writes, flushed by a background thread and at shutdown
+chat_writer = WriteBehindBuffer(_flush_buffered_chats, WRITE_BEHIND_MAX_ITEMS, WRITE_BEHIND_MAX_DELAY,
+                                markers=PendingMarkers(DATABASE_PATH + '.pending', WRITE_BEHIND_READ_WAIT))
+chat_writer.install_shutdown_hooks()
+
+# Maintenance jobs; app.py starts the runner, one worker at a time runs them
+jobs = JobRunner(lock_path=DATABASE_PATH + '.jobs.lock')
+jobs.register('recompress_messages', recompress_messages, interval=60)
+jobs.register('purge_deleted', purge_deleted, interval=5)
+jobs.register('archive_cold_chats', archive_cold_chats, interval=600)
+jobs.register('vacuum_free_pages', vacuum_free_pages, interval=300)
+jobs.register('recheck_stats', recheck_stats, interval=int(os.environ.get('STATS_RECHECK_INTERVAL', 3600)))
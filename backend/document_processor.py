@@ -8,9 +8,24 @@ Author: Annor Prince & Collins Yeboah
 import os
 import io
 import base64
+import codecs
 import re
-from dataclasses import dataclass, field
-from typing import Optional, Dict, List, Any
+import shutil
+import tempfile
+import threading
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict, replace
+from typing import Optional, Dict, List, Any, BinaryIO, Union
+
+from extraction_cache import extraction_cache, file_digest, ExtractionCache
+
+# A file path or a seekable binary file object
+FileSource = Union[str, BinaryIO]
 
 # PDF Processing
 try:
@@ -21,6 +36,9 @@ except ImportError:
 
 try:
     import pdfplumber
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
     PDFPLUMBER_AVAILABLE = True
 except ImportError:
     PDFPLUMBER_AVAILABLE = False
@@ -46,6 +64,220 @@ try:
 except ImportError:
     TESSERACT_AVAILABLE = False
 
+# Processes extracting PDF pages in parallel; 1 extracts in the request's process
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+
+# Shorter PDFs are extracted in-process; handing them to the pool costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 16))
+
+# Pages sent to a pool worker per task
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', 8))
+
+# Tesseract processes running at once; each uses one core
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 1))
+
+# A page taking longer is given up on and reported in ocr_failed_pages
+OCR_PAGE_TIMEOUT = float(os.environ.get('OCR_PAGE_TIMEOUT', 60))
+
+# Scanned pages are rasterized at OCR_DPI, lowered so no page image exceeds
+# OCR_MAX_PIXELS (a grayscale page holds one byte per pixel)
+OCR_DPI = int(os.environ.get('OCR_DPI', 300))
+OCR_MAX_PIXELS = int(os.environ.get('OCR_MAX_PIXELS', 12_000_000))
+
+OCR_LANG = os.environ.get('OCR_LANG', 'eng')
+
+# A page with less text than this and an image covering OCR_MIN_IMAGE_COVERAGE
+# of it is treated as scanned
+OCR_MIN_TEXT_CHARS = 20
+OCR_MIN_IMAGE_COVERAGE = 0.5
+
+
+def clean_text(text: str) -> str:
+    """Clean and normalize extracted text"""
+    # Remove excessive whitespace
+    text = re.sub(r'\s+', ' ', text)
+    
+    # Remove control characters
+    text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]', '', text)
+    
+    # Fix broken sentences (common in PDF extraction)
+    text = re.sub(r'(\w)-\s+(\w)', r'\1\2', text)
+    
+    return text.strip()
+
+
+def join_page_texts(page_texts) -> tuple:
+    """
+    Clean each page's text and join the pages with a space. Also returns
+    where each page's text ends in the joined text, so a result can later
+    be cut back to its first pages.
+    """
+    parts = []
+    page_ends = []
+    length = 0
+    for page_text in page_texts:
+        cleaned = clean_text(page_text)
+        if cleaned:
+            length += len(cleaned) + (1 if parts else 0)
+            parts.append(cleaned)
+        page_ends.append(length)
+    return ' '.join(parts), page_ends
+
+
+def format_table(table_data: List[List[str]]) -> str:
+    """Format table data as text"""
+    if not table_data:
+        return ""
+    
+    lines = []
+    for row in table_data:
+        # Clean row data
+        clean_row = [str(cell).strip() if cell else '' for cell in row]
+        lines.append(' | '.join(clean_row))
+    
+    return '\n'.join(lines)
+
+
+def is_scanned_page(page, text: str) -> bool:
+    """A page with (almost) no text layer whose content is a page-sized image"""
+    if len(text.strip()) >= OCR_MIN_TEXT_CHARS:
+        return False
+    page_area = float(page.width * page.height) or 1.0
+    return any(
+        float((image['x1'] - image['x0']) * (image['bottom'] - image['top'])) >= OCR_MIN_IMAGE_COVERAGE * page_area
+        for image in page.images
+    )
+
+
+def extract_pdf_pages(pdf, max_chars: Optional[int] = None) -> List[tuple]:
+    """
+    Extract the pages of an open pdfplumber PDF as
+    (page_number, text, has_tables, error, scanned). A page that fails gets
+    empty text and its error instead of failing the document. With
+    max_chars, stops after the page that brings the cleaned text to that
+    length.
+    """
+    results = []
+    chars = 0
+    for page in pdf.pages:
+        if max_chars is not None and chars >= max_chars:
+            break
+        try:
+            page_text = page.extract_text() or ""
+            if is_scanned_page(page, page_text):
+                results.append((page.page_number, page_text, False, None, True))
+                continue
+            parts = [page_text + "\n\n"]
+            tables = page.extract_tables()
+            for table in tables:
+                parts.append(format_table(table) + "\n")
+            results.append((page.page_number, ''.join(parts), bool(tables), None, False))
+            chars += len(clean_text(results[-1][1]))
+        except Exception as e:
+            results.append((page.page_number, "", False, str(e), False))
+        finally:
+            # Drop this page's parsed objects; pdfminer otherwise keeps
+            # every stream it has read (images included) until the file
+            # is closed
+            page.flush_cache()
+            doc_cache = getattr(pdf.doc, '_cached_objs', None)
+            if doc_cache:
+                doc_cache.clear()
+    return results
+
+
+def extract_pdf_page_range(source: FileSource, page_numbers: List[int]) -> List[tuple]:
+    """Extract the given 1-based pages of a PDF; this is the pool task"""
+    if not isinstance(source, (str, os.PathLike)):
+        source.seek(0)
+    with pdfplumber.open(source, pages=page_numbers) as pdf:
+        return extract_pdf_pages(pdf)
+
+
+def extract_pdf_pages_one_by_one(source: FileSource, page_numbers: List[int],
+                                 max_chars: Optional[int] = None) -> List[tuple]:
+    """
+    Extract pages in-process one at a time, for PDFs where loading some
+    page fails outright (e.g. a malformed MediaBox) and takes the others
+    down with it.
+    """
+    results = []
+    chars = 0
+    for number in page_numbers:
+        if max_chars is not None and chars >= max_chars:
+            break
+        try:
+            results.extend(extract_pdf_page_range(source, [number]))
+            chars += len(clean_text(results[-1][1]))
+        except Exception as e:
+            results.append((number, "", False, str(e), False))
+    return results
+
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """The shared PDF extraction pool, started on first use"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn rather than fork: request and job threads may hold
+            # locks at the moment a worker would be forked
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _pdf_pool
+
+
+def _discard_pdf_pool(pool: ProcessPoolExecutor):
+    """Forget a pool whose worker died, so the next task starts a fresh one"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def ocr_resolution(width: float, height: float) -> float:
+    """DPI to rasterize a page of width x height points at, capped by OCR_MAX_PIXELS"""
+    square_inches = (width / 72.0) * (height / 72.0)
+    if square_inches <= 0:
+        return OCR_DPI
+    return min(OCR_DPI, math.sqrt(OCR_MAX_PIXELS / square_inches))
+
+
+def rasterize_pdf_page(page):
+    """Grayscale PIL image of a pdfplumber page for OCR"""
+    resolution = ocr_resolution(float(page.width), float(page.height))
+    return page.to_image(resolution=resolution).original.convert('L')
+
+
+def ocr_image(image) -> str:
+    """Run tesseract on an image; this is the OCR pool task"""
+    try:
+        return pytesseract.image_to_string(image, lang=OCR_LANG, timeout=OCR_PAGE_TIMEOUT)
+    finally:
+        image.close()
+
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+
+def _get_ocr_pool() -> ThreadPoolExecutor:
+    """
+    The shared OCR pool, started on first use. Threads are enough: each
+    task waits on its own tesseract process.
+    """
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            # Parallelism comes from the pool; one thread per tesseract process
+            os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+            _ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
+        return _ocr_pool
+
 
 @dataclass
 class ProcessedDocument:
@@ -59,6 +291,33 @@ class ProcessedDocument:
     metadata: Dict[str, Any] = field(default_factory=dict)
     chunks: List[str] = field(default_factory=list)
     error: Optional[str] = None
+    truncated: bool = False  # extraction stopped at the budget before the end
+    page_ends: List[int] = field(default_factory=list)  # PDF: end of each page read in text
+
+
+@dataclass
+class ExtractionBudget:
+    """How much of a document to extract; None means no limit"""
+    max_chars: Optional[int] = None
+    max_pages: Optional[int] = None
+    
+    def page_limit(self, page_count: int) -> int:
+        """Number of pages to read out of page_count"""
+        return page_count if self.max_pages is None else min(page_count, self.max_pages)
+    
+    def chars_reached(self, chars: int) -> bool:
+        return self.max_chars is not None and chars >= self.max_chars
+    
+    def cut(self, text: str) -> str:
+        """text shortened to max_chars"""
+        return text if self.max_chars is None else text[:self.max_chars]
+    
+    def covers(self, other: 'ExtractionBudget') -> bool:
+        """True if this budget reads at least everything other does"""
+        return all(
+            mine is None or (theirs is not None and theirs <= mine)
+            for mine, theirs in ((self.max_chars, other.max_chars), (self.max_pages, other.max_pages))
+        )
 
 
 class DocumentProcessor:
@@ -67,23 +326,26 @@ class DocumentProcessor:
     Supports: PDF, DOCX, Images (with OCR)
     """
     
-    def __init__(self, enable_ocr: bool = True):
-        """Initialize the document processor"""
+    def __init__(self, enable_ocr: bool = True, cache: Optional[ExtractionCache] = extraction_cache):
+        """Initialize the document processor; pass cache=None to always extract"""
         self.enable_ocr = enable_ocr and TESSERACT_AVAILABLE
         self.max_chunk_size = 2000
+        self.cache = cache
         
         print(f"📄 Document Processor initialized")
         print(f"   - PDF Support: {PDF_AVAILABLE or PDFPLUMBER_AVAILABLE}")
         print(f"   - DOCX Support: {DOCX_AVAILABLE}")
         print(f"   - OCR Support: {self.enable_ocr}")
     
-    def process_base64(self, base64_data: str, filename: str) -> ProcessedDocument:
+    def process_base64(self, base64_data: str, filename: str,
+                       max_chars: Optional[int] = None, max_pages: Optional[int] = None) -> ProcessedDocument:
         """
         Process a document from base64 encoded data.
         
         Args:
             base64_data: Base64 encoded file data
             filename: Original filename to determine type
+            max_chars, max_pages: Extraction budget, see process_file
             
         Returns:
             ProcessedDocument with extracted text and metadata
@@ -95,17 +357,118 @@ class DocumentProcessor:
                 base64_data = base64_data.split(',', 1)[1]
             
             file_bytes = base64.b64decode(base64_data)
+        except Exception as e:
+            return ProcessedDocument(
+                success=False,
+                error=f"Error processing document: {str(e)}"
+            )
+        return self.process_file(io.BytesIO(file_bytes), filename, max_chars=max_chars, max_pages=max_pages)
+    
+    def process_file(self, source: FileSource, filename: str,
+                     max_chars: Optional[int] = None, max_pages: Optional[int] = None) -> ProcessedDocument:
+        """
+        Process a document from a file path or an open binary file.
+        
+        The parsers read from the file as they go, so an upload spooled to
+        disk is never copied into memory as a whole.
+        
+        Args:
+            source: Path, or seekable binary file object (read from the start)
+            filename: Original filename to determine type
+            max_chars: Stop extracting once the cleaned text reaches this
+                length; the text is cut to it and truncated is set
+            max_pages: Read at most this many pages; page_count still
+                reports the whole document
+            
+        Returns:
+            ProcessedDocument with extracted text and metadata
+        """
+        try:
             file_ext = os.path.splitext(filename)[1].lower()
+            budget = ExtractionBudget(max_chars=max_chars, max_pages=max_pages)
             
+            # The same file with the same options extracts to the same result.
+            # The budget is not part of the key: an entry read under a budget
+            # that covers this one (or read to the end) is cut down to it.
+            cache_key = None
+            if self.cache is not None:
+                with self._open(source) as f:
+                    cache_key = self.cache.key_for(file_digest(f), self._cache_options(file_ext))
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    cached_budget = ExtractionBudget(**cached.pop('budget', {}))
+                    cached_result = ProcessedDocument(**cached)
+                    if not cached_result.truncated or cached_budget.covers(budget):
+                        return self._apply_budget(cached_result, budget)
+            
+            result = self._extract(source, filename, file_ext, budget)
+            if cache_key and result.success:
+                self.cache.put(cache_key, dict(asdict(result), budget=asdict(budget)))
+            return result
+                
+        except Exception as e:
+            return ProcessedDocument(
+                success=False,
+                error=f"Error processing document: {str(e)}"
+            )
+    
+    def _cache_options(self, file_ext: str) -> dict:
+        """Settings that change extraction output, part of the cache key"""
+        return {
+            'type': file_ext,
+            'ocr': self.enable_ocr,
+            'chunk_size': self.max_chunk_size,
+        }
+    
+    def _apply_budget(self, result: ProcessedDocument, budget: ExtractionBudget) -> ProcessedDocument:
+        """A cached result cut down to budget, as if it had been extracted under it"""
+        text = result.text
+        page_ends = result.page_ends
+        pages_kept = None
+        if page_ends:
+            pages_kept = budget.page_limit(len(page_ends))
+            if budget.max_chars is not None:
+                # Extraction stops after the page that reaches max_chars
+                pages_kept = next(
+                    (number for number, end in enumerate(page_ends[:pages_kept], 1) if end >= budget.max_chars),
+                    pages_kept
+                )
+            page_ends = page_ends[:pages_kept]
+            text = text[:page_ends[-1]] if page_ends else ''
+        text = budget.cut(text)
+        
+        cut_pages = pages_kept is not None and pages_kept < result.page_count
+        if len(text) == len(result.text) and not cut_pages:
+            return result
+        
+        metadata = dict(result.metadata)
+        if pages_kept is not None:
+            metadata['pages_extracted'] = pages_kept
+            for name in ('failed_pages', 'ocr_pages', 'ocr_failed_pages', 'scanned_pages'):
+                if name in metadata:
+                    metadata[name] = [number for number in metadata[name] if number <= pages_kept]
+        return replace(
+            result,
+            text=text,
+            chunks=self._create_chunks(text),
+            metadata=metadata,
+            truncated=True,
+            page_ends=[min(end, len(text)) for end in page_ends]
+        )
+    
+    def _extract(self, source: FileSource, filename: str, file_ext: str,
+                 budget: ExtractionBudget) -> ProcessedDocument:
+        """Run the extractor for file_ext"""
+        try:
             # Process based on file type
             if file_ext == '.pdf':
-                return self._process_pdf(file_bytes, filename)
+                return self._process_pdf(source, filename, budget)
             elif file_ext in ['.docx', '.doc']:
-                return self._process_docx(file_bytes, filename)
+                return self._process_docx(source, filename, budget)
             elif file_ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
-                return self._process_image(file_bytes, filename)
+                return self._process_image(source, filename)
             elif file_ext in ['.txt', '.md', '.csv']:
-                return self._process_text(file_bytes, filename)
+                return self._process_text(source, filename, budget)
             else:
                 return ProcessedDocument(
                     success=False,
@@ -118,10 +481,23 @@ class DocumentProcessor:
                 error=f"Error processing document: {str(e)}"
             )
     
-    def _process_pdf(self, file_bytes: bytes, filename: str) -> ProcessedDocument:
-        """Extract text from PDF file"""
+    @staticmethod
+    @contextmanager
+    def _open(source: FileSource):
+        """Yield a binary file positioned at the start, closing it only if opened here"""
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                yield f
+        else:
+            source.seek(0)
+            yield source
+    
+    def _process_pdf(self, source: FileSource, filename: str, budget: ExtractionBudget) -> ProcessedDocument:
+        """Extract text from PDF file, page by page until the budget is reached"""
         text = ""
+        page_ends = []
         page_count = 0
+        pages_read = 0
         has_images = False
         has_tables = False
         metadata = {}
@@ -129,38 +505,73 @@ class DocumentProcessor:
         try:
             # Try pdfplumber first (better table extraction)
             if PDFPLUMBER_AVAILABLE:
-                with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-                    page_count = len(pdf.pages)
-                    
-                    for page in pdf.pages:
-                        page_text = page.extract_text() or ""
-                        text += page_text + "\n\n"
-                        
-                        # Check for tables
-                        tables = page.extract_tables()
-                        if tables:
-                            has_tables = True
-                            for table in tables:
-                                # Format table as text
-                                table_text = self._format_table(table)
-                                text += table_text + "\n"
-        
-            # Fallback to PyPDF2 if pdfplumber failed
-            elif PDF_AVAILABLE:
-                reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-                page_count = len(reader.pages)
+                with self._open(source) as f:
+                    # Counted from the page tree with pdfminer, so one
+                    # malformed page cannot fail the count
+                    page_count = sum(1 for _ in PDFPage.create_pages(PDFDocument(PDFParser(f))))
+                page_numbers = list(range(1, budget.page_limit(page_count) + 1))
                 
-                for page in reader.pages:
-                    page_text = page.extract_text() or ""
-                    text += page_text + "\n\n"
+                if PDF_WORKERS > 1 and len(page_numbers) >= PDF_PARALLEL_MIN_PAGES:
+                    pages = self._extract_pdf_parallel(source, page_numbers, budget.max_chars)
+                else:
+                    with self._open(source) as f:
+                        try:
+                            with pdfplumber.open(f, pages=page_numbers) as pdf:
+                                pages = extract_pdf_pages(pdf, budget.max_chars)
+                        except Exception:
+                            pages = extract_pdf_pages_one_by_one(f, page_numbers, budget.max_chars)
                 
-                # Try to get metadata
-                if reader.metadata:
-                    metadata = {
-                        'title': reader.metadata.get('/Title', ''),
-                        'author': reader.metadata.get('/Author', ''),
-                        'subject': reader.metadata.get('/Subject', ''),
-                    }
+                scanned = [page[0] for page in pages if page[4]]
+                if scanned:
+                    has_images = True
+                    if self.enable_ocr:
+                        pages, ocr_failed = self._ocr_pdf_pages(source, pages, budget.max_chars)
+                        read = {page[0] for page in pages}
+                        scanned = [number for number in scanned if number in read]
+                        metadata['ocr_pages'] = scanned
+                        if ocr_failed:
+                            print(f"⚠️ {filename}: OCR failed on page(s) {ocr_failed}")
+                            metadata['ocr_failed_pages'] = ocr_failed
+                    else:
+                        metadata['scanned_pages'] = scanned
+                pages_read = len(pages)
+                
+                text, page_ends = join_page_texts(page[1] for page in pages)
+                has_tables = any(page[2] for page in pages)
+                failed = [page[0] for page in pages if page[3]]
+                if failed:
+                    if len(failed) == pages_read:
+                        return ProcessedDocument(
+                            success=False,
+                            error=f"Error processing PDF: {pages[0][3]}"
+                        )
+                    print(f"⚠️ {filename}: could not extract page(s) {failed}")
+                    metadata['failed_pages'] = failed
+
+            # Fallback to PyPDF2 if pdfplumber failed
+            elif PDF_AVAILABLE:
+                with self._open(source) as f:
+                    reader = PyPDF2.PdfReader(f)
+                    page_count = len(reader.pages)
+                    
+                    parts = []
+                    chars = 0
+                    for number in range(budget.page_limit(page_count)):
+                        if budget.chars_reached(chars):
+                            break
+                        page_text = reader.pages[number].extract_text() or ""
+                        parts.append(page_text)
+                        chars += len(clean_text(page_text))
+                    text, page_ends = join_page_texts(parts)
+                    pages_read = len(parts)
+                    
+                    # Try to get metadata
+                    if reader.metadata:
+                        metadata = {
+                            'title': reader.metadata.get('/Title', ''),
+                            'author': reader.metadata.get('/Author', ''),
+                            'subject': reader.metadata.get('/Subject', ''),
+                        }
             
             else:
                 return ProcessedDocument(
@@ -168,8 +579,12 @@ class DocumentProcessor:
                     error="No PDF library available"
                 )
             
-            # Clean up text
-            text = self._clean_text(text)
+            # Text is cleaned page by page
+            truncated = pages_read < page_count or len(text) > len(budget.cut(text))
+            if truncated:
+                text = budget.cut(text)
+                page_ends = [min(end, len(text)) for end in page_ends]
+                metadata['pages_extracted'] = pages_read
             
             # Create chunks
             chunks = self._create_chunks(text)
@@ -182,7 +597,9 @@ class DocumentProcessor:
                 has_images=has_images,
                 has_tables=has_tables,
                 metadata=metadata,
-                chunks=chunks
+                chunks=chunks,
+                truncated=truncated,
+                page_ends=page_ends
             )
             
         except Exception as e:
@@ -191,7 +608,132 @@ class DocumentProcessor:
                 error=f"Error processing PDF: {str(e)}"
             )
     
-    def _process_docx(self, file_bytes: bytes, filename: str) -> ProcessedDocument:
+    def _extract_pdf_parallel(self, source: FileSource, page_numbers: List[int],
+                              max_chars: Optional[int] = None) -> List[tuple]:
+        """
+        Extract PDF pages in the process pool, PDF_PAGES_PER_TASK at a time,
+        returning extract_pdf_pages results in page order. A range whose
+        worker failed or died is retried page by page, so only the pages
+        that fail on their own are reported as failed.
+        
+        Ranges are submitted in page order, a few per worker at a time, so
+        once the pages read so far reach max_chars the rest are cancelled
+        or never sent.
+        """
+        ranges = [page_numbers[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(page_numbers), PDF_PAGES_PER_TASK)]
+        window = PDF_WORKERS * 2
+        
+        with self._pdf_path(source) as path:
+            results = []
+            chars = 0
+            for attempt in range(2):
+                pool = _get_pdf_pool()
+                queued = deque(ranges)
+                in_flight = deque()
+                retry = []
+                while queued or in_flight:
+                    while queued and len(in_flight) < window:
+                        pages = queued.popleft()
+                        in_flight.append((pages, pool.submit(extract_pdf_page_range, path, pages)))
+                    pages, future = in_flight.popleft()
+                    try:
+                        done = future.result()
+                    except Exception as e:
+                        if isinstance(e, BrokenProcessPool):
+                            _discard_pdf_pool(pool)
+                        if attempt == 0:
+                            retry.extend([number] for number in pages)
+                        else:
+                            results.extend((number, "", False, str(e) or type(e).__name__, False) for number in pages)
+                        continue
+                    results.extend(done)
+                    chars += sum(len(clean_text(page[1])) for page in done)
+                    if max_chars is not None and chars >= max_chars:
+                        for _, pending in in_flight:
+                            pending.cancel()
+                        queued.clear()
+                        in_flight.clear()
+                if not retry:
+                    break
+                ranges = retry
+        
+        results.sort(key=lambda page: page[0])
+        if max_chars is not None:
+            # Pages retried after the budget was reached add nothing
+            kept, chars = [], 0
+            for page in results:
+                if chars >= max_chars:
+                    break
+                kept.append(page)
+                chars += len(clean_text(page[1]))
+            results = kept
+        return results
+    
+    def _ocr_pdf_pages(self, source: FileSource, pages: List[tuple],
+                       max_chars: Optional[int] = None) -> tuple:
+        """
+        Replace the text of scanned pages with their OCR text. Returns the
+        pages (cut where the text reaches max_chars) and the numbers of
+        pages whose OCR failed or timed out.
+        
+        Pages are rasterized here one at a time and OCR'd in the pool, at
+        most two per worker ahead of the page being read, which bounds
+        both the page images held in memory and the work thrown away
+        once the budget is reached.
+        """
+        scanned = deque(page[0] for page in pages if page[4])
+        window = OCR_WORKERS * 2
+        pool = _get_ocr_pool()
+        in_flight = {}  # page number -> future, or the exception rasterizing it
+        results = []
+        failed = []
+        chars = 0
+        
+        with self._open(source) as f, pdfplumber.open(f, pages=list(scanned)) as pdf:
+            scanned_pages = {page.page_number: page for page in pdf.pages}
+            try:
+                for number, page_text, has_tables, error, is_scanned in pages:
+                    if max_chars is not None and chars >= max_chars:
+                        break
+                    if is_scanned:
+                        while scanned and len(in_flight) < window:
+                            ahead = scanned.popleft()
+                            try:
+                                in_flight[ahead] = pool.submit(ocr_image, rasterize_pdf_page(scanned_pages[ahead]))
+                            except Exception as e:
+                                in_flight[ahead] = e
+                            finally:
+                                scanned_pages[ahead].close()
+                        task = in_flight.pop(number)
+                        try:
+                            if isinstance(task, Exception):
+                                raise task
+                            page_text = task.result() + "\n\n"
+                        except Exception as e:
+                            print(f"⚠️ OCR of page {number} failed: {e}")
+                            failed.append(number)
+                    results.append((number, page_text, has_tables, error, is_scanned))
+                    chars += len(clean_text(page_text))
+            finally:
+                for task in in_flight.values():
+                    if not isinstance(task, Exception):
+                        task.cancel()
+        
+        return results, failed
+    
+    @contextmanager
+    def _pdf_path(self, source: FileSource):
+        """Yield a path to the PDF for pool workers, copying an in-memory or unnamed upload to a temp file"""
+        if isinstance(source, (str, os.PathLike)):
+            yield source
+            return
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as copy:
+            source.seek(0)
+            shutil.copyfileobj(source, copy, 1024 * 1024)
+            copy.flush()
+            yield copy.name
+    
+    def _process_docx(self, source: FileSource, filename: str, budget: ExtractionBudget) -> ProcessedDocument:
         """Extract text from DOCX file"""
         if not DOCX_AVAILABLE:
             return ProcessedDocument(
@@ -200,28 +742,40 @@ class DocumentProcessor:
             )
         
         try:
-            doc = Document(io.BytesIO(file_bytes))
+            with self._open(source) as f:
+                doc = Document(f)
             
             text_parts = []
-            has_tables = False
+            has_tables = bool(doc.tables)
+            chars = 0
+            truncated = False
             
-            # Extract paragraphs
+            # Extract paragraphs, then tables, until the budget is reached
             for para in doc.paragraphs:
+                if budget.chars_reached(chars):
+                    truncated = True
+                    break
                 if para.text.strip():
                     text_parts.append(para.text)
+                    chars += len(self._clean_text(para.text)) + 1
             
-            # Extract tables
             for table in doc.tables:
-                has_tables = True
+                if budget.chars_reached(chars):
+                    truncated = True
+                    break
                 table_data = []
                 for row in table.rows:
                     row_data = [cell.text.strip() for cell in row.cells]
                     table_data.append(row_data)
                 table_text = self._format_table(table_data)
                 text_parts.append(table_text)
+                chars += len(self._clean_text(table_text)) + 1
             
             text = "\n\n".join(text_parts)
             text = self._clean_text(text)
+            if len(text) > len(budget.cut(text)):
+                truncated = True
+                text = budget.cut(text)
             
             chunks = self._create_chunks(text)
             
@@ -245,7 +799,8 @@ class DocumentProcessor:
                 has_images=False,
                 has_tables=has_tables,
                 metadata=metadata,
-                chunks=chunks
+                chunks=chunks,
+                truncated=truncated
             )
             
         except Exception as e:
@@ -254,7 +809,7 @@ class DocumentProcessor:
                 error=f"Error processing DOCX: {str(e)}"
             )
     
-    def _process_image(self, file_bytes: bytes, filename: str) -> ProcessedDocument:
+    def _process_image(self, source: FileSource, filename: str) -> ProcessedDocument:
         """Extract text from image using OCR"""
         if not PIL_AVAILABLE:
             return ProcessedDocument(
@@ -263,13 +818,14 @@ class DocumentProcessor:
             )
         
         try:
-            image = Image.open(io.BytesIO(file_bytes))
-            
-            # Perform OCR if enabled
-            if self.enable_ocr:
-                text = pytesseract.image_to_string(image)
-            else:
-                text = "[Image content - OCR not enabled]"
+            with self._open(source) as f:
+                image = Image.open(f)
+                
+                # Perform OCR if enabled
+                if self.enable_ocr:
+                    text = pytesseract.image_to_string(image, lang=OCR_LANG, timeout=OCR_PAGE_TIMEOUT)
+                else:
+                    text = "[Image content - OCR not enabled]"
             
             text = self._clean_text(text)
             chunks = self._create_chunks(text)
@@ -291,11 +847,30 @@ class DocumentProcessor:
                 error=f"Error processing image: {str(e)}"
             )
     
-    def _process_text(self, file_bytes: bytes, filename: str) -> ProcessedDocument:
-        """Process plain text files"""
+    def _process_text(self, source: FileSource, filename: str, budget: ExtractionBudget) -> ProcessedDocument:
+        """Process plain text files, reading only as far as the budget needs"""
         try:
-            text = file_bytes.decode('utf-8')
+            truncated = False
+            with self._open(source) as f:
+                if budget.max_chars is None:
+                    text = f.read().decode('utf-8')
+                else:
+                    decoder = codecs.getincrementaldecoder('utf-8')()
+                    parts = []
+                    chars = 0
+                    for block in iter(lambda: f.read(64 * 1024), b''):
+                        parts.append(decoder.decode(block))
+                        chars += len(parts[-1])
+                        if budget.chars_reached(chars) and budget.chars_reached(len(self._clean_text(''.join(parts)))):
+                            truncated = bool(f.read(1))
+                            break
+                    else:
+                        parts.append(decoder.decode(b'', final=True))
+                    text = ''.join(parts)
             text = self._clean_text(text)
+            if len(text) > len(budget.cut(text)):
+                truncated = True
+                text = budget.cut(text)
             chunks = self._create_chunks(text)
             
             file_ext = os.path.splitext(filename)[1].lower()
@@ -313,7 +888,8 @@ class DocumentProcessor:
                 has_images=False,
                 has_tables=False,
                 metadata={},
-                chunks=chunks
+                chunks=chunks,
+                truncated=truncated
             )
             
         except Exception as e:
@@ -324,29 +900,11 @@ class DocumentProcessor:
     
     def _format_table(self, table_data: List[List[str]]) -> str:
         """Format table data as text"""
-        if not table_data:
-            return ""
-        
-        lines = []
-        for row in table_data:
-            # Clean row data
-            clean_row = [str(cell).strip() if cell else '' for cell in row]
-            lines.append(' | '.join(clean_row))
-        
-        return '\n'.join(lines)
+        return format_table(table_data)
     
     def _clean_text(self, text: str) -> str:
         """Clean and normalize extracted text"""
-        # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Remove control characters
-        text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]', '', text)
-        
-        # Fix broken sentences (common in PDF extraction)
-        text = re.sub(r'(\w)-\s+(\w)', r'\1\2', text)
-        
-        return text.strip()
+        return clean_text(text)
     
     def _create_chunks(self, text: str) -> List[str]:
         """Split text into chunks for processing"""
@@ -374,8 +932,14 @@ class DocumentProcessor:
         return chunks
 
 
-# Convenience function for direct import
-def process_document_base64(base64_data: str, filename: str) -> ProcessedDocument:
-    """Process a document from base64 data"""
+# Convenience functions for direct import
+def process_document_base64(base64_data: str, filename: str, **budget) -> ProcessedDocument:
+    """Process a document from base64 data; budget is max_chars/max_pages"""
+    processor = DocumentProcessor(enable_ocr=True)
+    return processor.process_base64(base64_data, filename, **budget)
+
+
+def process_document_file(source: FileSource, filename: str, **budget) -> ProcessedDocument:
+    """Process a document from a file path or binary file object; budget is max_chars/max_pages"""
     processor = DocumentProcessor(enable_ocr=True)
-    return processor.process_base64(base64_data, filename)
+    return processor.process_file(source, filename, **budget)
@@ -0,0 +1,214 @@
+"""
+Extraction Cache Module
+Content-addressed cache of document extraction results.
+
+Users re-attach the same PDF for every question, and each time it was
+parsed (and OCR'd) from scratch. Results are keyed by the SHA-256 of the
+file bytes plus the processor options that affect the output, and kept
+in two tiers:
+- memory: an LRU of serialized results per worker, evicted by byte size;
+- disk: a SQLite file next to the main database, shared by all gunicorn
+  workers, zlib-compressed and trimmed least-recently-used first.
+
+Only successful extractions are cached. Disk errors are reported and
+treated as misses, so a broken cache never fails an upload.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Bump when extraction output changes, so old entries stop matching
+EXTRACTION_VERSION = 3
+
+# Tier budgets; 0 turns a tier off
+EXTRACTION_CACHE_MEMORY_MB = float(os.environ.get('EXTRACTION_CACHE_MEMORY_MB', 64))
+EXTRACTION_CACHE_DISK_MB = float(os.environ.get('EXTRACTION_CACHE_DISK_MB', 512))
+
+# Defaults to a file next to the users database (same default path as database.py)
+EXTRACTION_CACHE_PATH = os.environ.get('EXTRACTION_CACHE_PATH') or (
+    os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(__file__), 'users.db')) + '.extraction-cache'
+)
+
+# Check the disk tier against its budget every this many stores
+TRIM_EVERY = 20
+
+# A disk hit refreshes its last-used time at most this often
+TOUCH_INTERVAL = 3600
+
+
+def file_digest(f, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a binary file read in chunks from the start; the position is restored"""
+    digest = hashlib.sha256()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Two-tier cache of extraction results, stored as JSON dicts.
+    - memory_bytes: LRU budget of this process
+    - disk_bytes: budget of the shared SQLite file
+    """
+
+    def __init__(self, path: str, memory_bytes: int, disk_bytes: int):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> JSON text, most recently used last
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self._schema_pid = None  # process that created the disk tier's table
+        self._stores = 0
+        self._counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    @staticmethod
+    def key_for(digest: str, options: dict) -> str:
+        """Cache key of a file digest under the given processor options"""
+        options = dict(options, version=EXTRACTION_VERSION)
+        return f"{digest}:{hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()[:16]}"
+
+    def create_schema(self):
+        """Create the disk tier's table; app.py calls this at startup, scripts get it on first use"""
+        if self.disk_bytes <= 0:
+            return
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_extraction_cache_last_used ON extraction_cache(last_used)')
+        self._schema_pid = os.getpid()
+
+    def _connect(self):
+        # Imported here: PDF pool workers import this module but never use
+        # the disk tier, and must not run database.py's startup
+        import database
+        return database.get_connection(self.path)
+
+    def _connection(self):
+        if self._schema_pid is None:
+            self.create_schema()
+        return self._connect()
+
+    def get(self, key: str):
+        """The cached result dict for key, or None"""
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self._counts['memory_hits'] += 1
+        if text is not None:
+            return json.loads(text)
+
+        if self.disk_bytes > 0:
+            try:
+                conn = self._connection()
+                row = conn.execute(
+                    'SELECT value, last_used FROM extraction_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    now = time.time()
+                    if now - row[1] > TOUCH_INTERVAL:
+                        conn.execute('UPDATE extraction_cache SET last_used = ? WHERE key = ?', (now, key))
+                    text = zlib.decompress(row[0]).decode('utf-8')
+                    self._remember(key, text)
+                    with self._lock:
+                        self._counts['disk_hits'] += 1
+                    return json.loads(text)
+            except (sqlite3.Error, zlib.error) as e:
+                print(f"⚠️ Extraction cache read failed: {e}")
+
+        with self._lock:
+            self._counts['misses'] += 1
+        return None
+
+    def put(self, key: str, value: dict):
+        """Store a result dict in both tiers"""
+        text = json.dumps(value, separators=(',', ':'))
+        self._remember(key, text)
+        with self._lock:
+            self._counts['stores'] += 1
+            self._stores += 1
+            trim = self._stores % TRIM_EVERY == 0
+
+        if self.disk_bytes <= 0:
+            return
+        blob = zlib.compress(text.encode('utf-8'), 6)
+        if len(blob) > self.disk_bytes:
+            return
+        try:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO extraction_cache (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                         (key, blob, len(blob), time.time()))
+            if trim:
+                self._trim_disk(conn)
+        except sqlite3.Error as e:
+            print(f"⚠️ Extraction cache write failed: {e}")
+
+    def _remember(self, key: str, text: str):
+        """Add to the memory tier, evicting least recently used entries over budget"""
+        size = len(text)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_used -= len(previous)
+            self._memory[key] = text
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+                self._counts['evictions'] += 1
+
+    def _trim_disk(self, conn):
+        """Delete least recently used entries until the file's entries fit the disk budget"""
+        deleted = conn.execute('''
+            DELETE FROM extraction_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS kept
+                    FROM extraction_cache
+                ) WHERE kept > ?
+            )
+        ''', (self.disk_bytes,)).rowcount
+        if deleted:
+            with self._lock:
+                self._counts['evictions'] += deleted
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process and the size of both tiers"""
+        with self._lock:
+            stats = dict(self._counts, memory_entries=len(self._memory), memory_bytes=self._memory_used)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 3) if lookups else None
+        if self.disk_bytes > 0:
+            try:
+                entries, size = self._connection().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extraction_cache').fetchone()
+                stats.update(disk_entries=entries, disk_bytes=size)
+            except sqlite3.Error as e:
+                stats['disk_error'] = str(e)
+        return stats
+
+
+# Singleton instance for easy import
+extraction_cache = ExtractionCache(
+    EXTRACTION_CACHE_PATH,
+    memory_bytes=int(EXTRACTION_CACHE_MEMORY_MB * 1024 * 1024),
+    disk_bytes=int(EXTRACTION_CACHE_DISK_MB * 1024 * 1024),
+)
@@ -0,0 +1,199 @@
+"""
+Idempotency Module
+Replays the stored response when a request is retried with the same
+Idempotency-Key header.
+
+A retried /api/analyze would otherwise pay for a second AI completion and
+a retried save would write twice. The first request with a key claims it
+and runs; its response is kept for IDEMPOTENCY_TTL_SECONDS. Duplicates
+that arrive while it is still running wait for that result (threads in
+the same worker are woken directly, other workers poll), and later
+duplicates get the stored response immediately.
+
+Claims and responses live in a small SQLite file next to the main
+database so every gunicorn worker sees them. A claim whose worker died
+expires after IDEMPOTENCY_PENDING_SECONDS and can be taken over.
+
+Stored responses include analysis results, i.e. users' medical text, so
+they are kept only as long as a client plausibly retries:
+IDEMPOTENCY_TTL_SECONDS defaults to 15 minutes, and expired rows are
+deleted at least that often while requests keep arriving.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+import database
+
+# How long completed responses are replayed; short, since they hold medical text
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 15 * 60))
+
+# How long a running request holds its key before others may take over
+IDEMPOTENCY_PENDING_SECONDS = int(os.environ.get('IDEMPOTENCY_PENDING_SECONDS', 300))
+
+# Longest a duplicate waits for the original request to finish
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 120))
+
+# Interval at which duplicates in other workers re-check a running request
+POLL_INTERVAL = 0.05
+
+MAX_KEY_LENGTH = 255
+
+# Delete expired entries every this many claims, or once per TTL
+PRUNE_EVERY = 500
+
+
+class IdempotencyConflict(Exception):
+    """The key is in use by a different request, or its original is still running"""
+
+    def __init__(self, message: str, status: int = 409, retry_after: int = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def request_fingerprint(method: str, path: str, body_parts) -> str:
+    """
+    Hash of what was requested, so a reused key with a different body is
+    rejected. body_parts is an iterable of bytes, so large uploads can be
+    hashed in chunks.
+    """
+    digest = hashlib.sha256(f"{method} {path}\n".encode('utf-8'))
+    for part in body_parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """Claims keys and stores their responses in a shared SQLite file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = {}  # key -> Event set when this worker finishes it
+        self._claims = 0
+        self._pruned_at = time.time()
+        self._counts = {'executed': 0, 'replayed': 0, 'waited': 0, 'conflicts': 0}
+        self._create_schema()
+
+    def _create_schema(self):
+        """Create the store's table; runs once, when the store is created at startup"""
+        self._connection().execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+
+    def _connection(self):
+        return database.get_connection(self.path)
+
+    def begin(self, key: str, fingerprint: str):
+        """
+        Claim key for this request.
+        Returns None if the caller now owns it and should run the request,
+        or a stored (status, headers, body) to replay.
+        Raises IdempotencyConflict when the key belongs to a different
+        request or its original is still running after the wait.
+        """
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        waited = False
+        while True:
+            now = time.time()
+            conn = self._connection()
+            # Take the key if it is new or its previous holder expired
+            claimed = conn.execute('''
+                INSERT INTO idempotency_keys (key, fingerprint, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    status = NULL, headers = NULL, body = NULL,
+                    expires_at = excluded.expires_at
+                WHERE expires_at < ?
+                RETURNING key
+            ''', (key, fingerprint, now + IDEMPOTENCY_PENDING_SECONDS, now)).fetchone()
+
+            if claimed:
+                with self._lock:
+                    self._events[key] = threading.Event()
+                    self._claims += 1
+                    prune = self._claims % PRUNE_EVERY == 0 or now - self._pruned_at >= IDEMPOTENCY_TTL_SECONDS
+                    if prune:
+                        self._pruned_at = now
+                if prune:
+                    conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+                return None
+
+            row = conn.execute(
+                'SELECT fingerprint, status, headers, body FROM idempotency_keys WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                continue  # Expired and pruned between the two statements; claim again
+
+            if row[0] != fingerprint:
+                with self._lock:
+                    self._counts['conflicts'] += 1
+                raise IdempotencyConflict(
+                    "Idempotency-Key was already used for a different request", status=422)
+
+            if row[1] is not None:
+                with self._lock:
+                    self._counts['waited' if waited else 'replayed'] += 1
+                return row[1], json.loads(row[2]), row[3]
+
+            # The original is still running: wait for it
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    self._counts['conflicts'] += 1
+                raise IdempotencyConflict(
+                    "A request with this Idempotency-Key is still in progress", retry_after=1)
+            waited = True
+            with self._lock:
+                event = self._events.get(key)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
+
+    def finish(self, key: str, status: int, headers: dict, body: bytes):
+        """Store the response of a claimed key and wake waiting duplicates"""
+        try:
+            self._connection().execute('''
+                UPDATE idempotency_keys SET status = ?, headers = ?, body = ?, expires_at = ?
+                WHERE key = ?
+            ''', (status, json.dumps(headers), body, time.time() + IDEMPOTENCY_TTL_SECONDS, key))
+        finally:
+            self._wake(key, 'executed')
+
+    def abandon(self, key: str):
+        """Release a claimed key without storing a response, so a retry runs again"""
+        try:
+            self._connection().execute(
+                'DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL', (key,))
+        finally:
+            self._wake(key, 'executed')
+
+    def _wake(self, key: str, counter: str):
+        with self._lock:
+            event = self._events.pop(key, None)
+            self._counts[counter] += 1
+        if event is not None:
+            event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, in_flight=len(self._events))
+
+
+def create_idempotency_store(database_path: str) -> IdempotencyStore:
+    return IdempotencyStore(database_path + '.idempotency')
@@ -0,0 +1,489 @@
+"""
+Database Migrations Module
+Versioned schema changes for the users database, applied once at startup.
+
+Each migration is a function that receives an open connection inside a
+transaction. The schema version is tracked with PRAGMA user_version, so a
+migration never runs twice and request handlers never need to issue DDL.
+
+Migrations are scoped: 'global' ones touch the users database, 'chats'
+ones touch chat tables. With chat sharding (see shards.py) each shard file
+only receives the 'chats' migrations; the main database receives both.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import json
+import zlib
+import hashlib
+
+import chat_search
+
+# Migration scopes
+SCOPE_GLOBAL = 'global'  # users and settings, main database only
+SCOPE_CHATS = 'chats'  # chat tables, main database and every chat shard
+
+# Per-user and total counters kept by the chat_stats triggers, in column order
+CHAT_STAT_COLUMNS = ('chats', 'deleted_chats', 'messages', 'message_bytes', 'legacy_chats')
+
+# Chained hash of an empty conversation
+EMPTY_CHAIN_HASH = hashlib.sha256(b'').hexdigest()
+
+# Rows read per query by migrations that rewrite large tables
+MIGRATION_PAGE_SIZE = 200
+
+
+def chain_message_hashes(message_jsons, start=EMPTY_CHAIN_HASH) -> list:
+    """
+    Return the running hash after each message, starting with the empty chat.
+
+    hashes[n] fingerprints the first n messages, so comparing a stored hash
+    with hashes[stored_count] tells whether a conversation only grew.
+    Pass a stored hash as start to continue an existing chain.
+    """
+    hashes = [start]
+    for message_json in message_jsons:
+        hashes.append(hashlib.sha256((hashes[-1] + message_json).encode('utf-8')).hexdigest())
+    return hashes
+
+
+def _baseline_users(conn):
+    """users table as it was created before migrations existed"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _baseline_chats(conn):
+    """Chat tables as they were created before migrations existed"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            chat_data TEXT NOT NULL,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cloud_chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id TEXT UNIQUE NOT NULL,
+            title TEXT NOT NULL,
+            messages TEXT NOT NULL,  -- JSON string of messages array
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_chats
+        ON cloud_chats(user_id, created_at)
+    ''')
+
+
+def _per_user_chat_keys(conn):
+    """Key chats by (user_id, chat_id) and index them the way they are queried"""
+    # cloud_chats: chat_id was unique across all users, make it unique per user
+    conn.execute('''
+        CREATE TABLE cloud_chats_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            messages TEXT NOT NULL,  -- JSON string of messages array
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_id, chat_id),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO cloud_chats_new (id, user_id, chat_id, title, messages, created_at, updated_at)
+        SELECT id, user_id, chat_id, title, messages, created_at, updated_at FROM cloud_chats
+    ''')
+    conn.execute('DROP TABLE cloud_chats')
+    conn.execute('ALTER TABLE cloud_chats_new RENAME TO cloud_chats')
+
+    # Serves chat loading (ORDER BY updated_at) and the last-sync lookup
+    conn.execute('''
+        CREATE INDEX idx_cloud_chats_user_updated
+        ON cloud_chats(user_id, updated_at)
+    ''')
+
+    # user_chats: INSERT OR REPLACE had no key to replace on, keep the newest copy
+    conn.execute('''
+        CREATE TABLE user_chats_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            chat_data TEXT NOT NULL,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_id, chat_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO user_chats_new (id, user_id, chat_id, chat_data, last_updated)
+        SELECT id, user_id, chat_id, chat_data, last_updated FROM user_chats
+        WHERE id IN (SELECT MAX(id) FROM user_chats GROUP BY user_id, chat_id)
+    ''')
+    conn.execute('DROP TABLE user_chats')
+    conn.execute('ALTER TABLE user_chats_new RENAME TO user_chats')
+
+
+def _chat_content_hash(conn):
+    """Track a hash of each chat's content so unchanged chats can skip writes"""
+    conn.execute('ALTER TABLE cloud_chats ADD COLUMN content_hash TEXT')
+
+
+def _normalized_chat_messages(conn):
+    """Store one row per message instead of rewriting a JSON blob per chat"""
+    conn.execute('''
+        CREATE TABLE chat_messages (
+            user_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            message TEXT NOT NULL,  -- JSON of a single message
+            PRIMARY KEY (user_id, chat_id, seq)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('ALTER TABLE cloud_chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0')
+
+    # Move existing blobs into rows; cloud_chats.messages is no longer read.
+    # Paged by rowid so only MIGRATION_PAGE_SIZE blobs are in memory at once
+    # (iterating one cursor would read rows this loop is rewriting).
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            'SELECT id, user_id, chat_id, messages FROM cloud_chats WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, MIGRATION_PAGE_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        for row_id, user_id, chat_id, messages_json in rows:
+            try:
+                messages = json.loads(messages_json) if messages_json else []
+            except json.JSONDecodeError:
+                messages = []
+            if not isinstance(messages, list):
+                messages = []
+
+            message_jsons = [json.dumps(message) for message in messages]
+            conn.executemany(
+                'INSERT INTO chat_messages (user_id, chat_id, seq, message) VALUES (?, ?, ?, ?)',
+                [(user_id, chat_id, seq, message) for seq, message in enumerate(message_jsons)]
+            )
+            conn.execute(
+                "UPDATE cloud_chats SET messages = '[]', message_count = ?, content_hash = ? WHERE id = ?",
+                (len(message_jsons), chain_message_hashes(message_jsons)[-1], row_id)
+            )
+
+
+def _chat_tombstones(conn):
+    """Keep deleted chats as tombstones so clients can sync deletions"""
+    conn.execute('ALTER TABLE cloud_chats ADD COLUMN deleted_at TIMESTAMP')
+
+
+def _chat_listing_index(conn):
+    """Covering index so the sidebar listing never reads chat rows"""
+    conn.execute('''
+        CREATE INDEX idx_cloud_chats_listing
+        ON cloud_chats(user_id, updated_at, chat_id, title, created_at, message_count, deleted_at)
+        WHERE deleted_at IS NULL
+    ''')
+
+
+def _stored_message_json(stored) -> str:
+    """JSON text of a stored payload: raw text, or a format byte (0 raw, 1 zlib) and data"""
+    if isinstance(stored, bytes):
+        stored = zlib.decompress(stored[1:]) if stored[0] == 1 else stored[1:]
+        stored = stored.decode('utf-8')
+    return stored
+
+
+def _index_chat_messages(conn):
+    """Add the stored messages of every live chat to the search index"""
+    # Iterated, not fetched, so only one message is in memory at a time
+    rows = conn.execute('''
+        SELECT m.user_id, m.chat_id, m.seq, m.message
+        FROM chat_messages m
+        JOIN cloud_chats c ON c.user_id = m.user_id AND c.chat_id = m.chat_id
+        WHERE c.deleted_at IS NULL
+    ''')
+    for user_id, chat_id, seq, stored in rows:
+        chat_search.index_messages(conn, user_id, chat_id, [json.loads(_stored_message_json(stored))], seq)
+
+
+def _chat_search_index(conn):
+    """Contentless full-text index over message content, backfilled from stored messages"""
+    chat_search.create_index(conn)
+    _index_chat_messages(conn)
+
+
+def _users_version(conn):
+    """Counter bumped by every change to users, so cached user lookups know when to reload"""
+    conn.execute('CREATE TABLE users_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)')
+    conn.execute('INSERT INTO users_version (id, version) VALUES (0, 0)')
+    for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'), ('update', 'UPDATE OF email, username')):
+        conn.execute(f'''
+            CREATE TRIGGER users_version_{name} AFTER {event} ON users
+            BEGIN
+                UPDATE users_version SET version = version + 1 WHERE id = 0;
+            END
+        ''')
+
+
+def _settings(conn):
+    """Key/value settings of the deployment; records the chat shard count"""
+    conn.execute('CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    # Databases created before sharding keep every chat in the main file
+    conn.execute("INSERT INTO settings (name, value) VALUES ('chat_shards', '1')")
+
+
+def _purge_queue(conn):
+    """Deleted chats and accounts waiting for the background purger"""
+    conn.execute('''
+        CREATE TABLE purge_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id TEXT,  -- NULL purges every chat of the user (account deletion)
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            rows_purged INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_purge_queue_chat ON purge_queue(user_id, chat_id)')
+
+
+def _user_totals(conn):
+    """Trigger-maintained count of users, so stats never scan the table"""
+    conn.execute('CREATE TABLE user_totals (id INTEGER PRIMARY KEY CHECK (id = 0), users INTEGER NOT NULL)')
+    conn.execute('INSERT INTO user_totals (id, users) SELECT 0, COUNT(*) FROM users')
+    for name, event, delta in (('insert', 'INSERT', '+ 1'), ('delete', 'DELETE', '- 1')):
+        conn.execute(f'''
+            CREATE TRIGGER user_totals_{name} AFTER {event} ON users
+            BEGIN
+                UPDATE user_totals SET users = users {delta} WHERE id = 0;
+            END
+        ''')
+
+
+def _count_statements(user_id, deltas):
+    """Trigger body adding {column: SQL expression} deltas to one user's stats and to the totals"""
+    columns = ', '.join(deltas)
+    values = ', '.join(deltas.values())
+    user_updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in deltas)
+    total_updates = ', '.join(f'{column} = {column} + ({delta})' for column, delta in deltas.items())
+    return f'''
+        INSERT INTO user_chat_stats (user_id, {columns}) VALUES ({user_id}, {values})
+            ON CONFLICT (user_id) DO UPDATE SET {user_updates};
+        UPDATE chat_totals SET {total_updates} WHERE id = 0;
+    '''
+
+
+def _chat_stats(conn):
+    """Trigger-maintained chat, message and byte counts, per user and in total"""
+    counters = ', '.join(f'{column} INTEGER NOT NULL DEFAULT 0' for column in CHAT_STAT_COLUMNS)
+    # Not a rowid alias, so a non-numeric legacy user id cannot fail the triggers
+    conn.execute(f'CREATE TABLE user_chat_stats (user_id INTEGER NOT NULL PRIMARY KEY, {counters}) WITHOUT ROWID')
+    conn.execute(f'CREATE TABLE chat_totals (id INTEGER PRIMARY KEY CHECK (id = 0), {counters})')
+
+    # Backfill from the rows stored so far
+    conn.execute('''
+        INSERT INTO user_chat_stats (user_id, chats, deleted_chats)
+        SELECT user_id, SUM(deleted_at IS NULL), SUM(deleted_at IS NOT NULL) FROM cloud_chats GROUP BY user_id
+    ''')
+    conn.execute('''
+        INSERT INTO user_chat_stats (user_id, messages, message_bytes)
+        SELECT user_id, COUNT(*), SUM(length(CAST(message AS BLOB))) FROM chat_messages WHERE true GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET messages = excluded.messages, message_bytes = excluded.message_bytes
+    ''')
+    conn.execute('''
+        INSERT INTO user_chat_stats (user_id, legacy_chats)
+        SELECT user_id, COUNT(*) FROM user_chats WHERE true GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET legacy_chats = excluded.legacy_chats
+    ''')
+    columns = ', '.join(CHAT_STAT_COLUMNS)
+    sums = ', '.join(f'COALESCE(SUM({column}), 0)' for column in CHAT_STAT_COLUMNS)
+    conn.execute(f'INSERT INTO chat_totals (id, {columns}) SELECT 0, {sums} FROM user_chat_stats')
+
+    # Live and deleted chats; the UPDATE trigger covers tombstoning and re-saving a deleted chat
+    live_change = '(NEW.deleted_at IS NULL) - (OLD.deleted_at IS NULL)'
+    triggers = [
+        ('cloud_chats_insert', 'AFTER INSERT ON cloud_chats', 'NEW.user_id',
+         {'chats': 'NEW.deleted_at IS NULL', 'deleted_chats': 'NEW.deleted_at IS NOT NULL'}),
+        ('cloud_chats_delete', 'AFTER DELETE ON cloud_chats', 'OLD.user_id',
+         {'chats': '-(OLD.deleted_at IS NULL)', 'deleted_chats': '-(OLD.deleted_at IS NOT NULL)'}),
+        ('cloud_chats_tombstone',
+         'AFTER UPDATE OF deleted_at ON cloud_chats WHEN (OLD.deleted_at IS NULL) != (NEW.deleted_at IS NULL)',
+         'NEW.user_id', {'chats': live_change, 'deleted_chats': f'-({live_change})'}),
+        ('chat_messages_insert', 'AFTER INSERT ON chat_messages', 'NEW.user_id',
+         {'messages': '1', 'message_bytes': 'length(CAST(NEW.message AS BLOB))'}),
+        ('chat_messages_delete', 'AFTER DELETE ON chat_messages', 'OLD.user_id',
+         {'messages': '-1', 'message_bytes': '-length(CAST(OLD.message AS BLOB))'}),
+        ('chat_messages_update', 'AFTER UPDATE OF message ON chat_messages', 'NEW.user_id',
+         {'message_bytes': 'length(CAST(NEW.message AS BLOB)) - length(CAST(OLD.message AS BLOB))'}),
+        ('user_chats_insert', 'AFTER INSERT ON user_chats', 'NEW.user_id', {'legacy_chats': '1'}),
+        ('user_chats_delete', 'AFTER DELETE ON user_chats', 'OLD.user_id', {'legacy_chats': '-1'}),
+    ]
+    for name, event, user_id, deltas in triggers:
+        conn.execute(f'CREATE TRIGGER chat_stats_{name} {event} BEGIN {_count_statements(user_id, deltas)} END')
+
+
+def _chat_archive(conn):
+    """Cold tier: messages of long-untouched chats packed into one compressed row per chat"""
+    conn.execute('ALTER TABLE cloud_chats ADD COLUMN archived_at TIMESTAMP')
+    conn.execute('ALTER TABLE cloud_chats ADD COLUMN accessed_at TIMESTAMP')  # last rehydration
+    conn.execute('''
+        CREATE TABLE chat_archive (
+            user_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            messages BLOB NOT NULL,  -- format byte + message JSON lines, like chat_messages.message
+            PRIMARY KEY (user_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Listing covers archived_at so hot-only pages stay index-only
+    conn.execute('DROP INDEX idx_cloud_chats_listing')
+    conn.execute('''
+        CREATE INDEX idx_cloud_chats_listing
+        ON cloud_chats(user_id, updated_at, chat_id, title, created_at, message_count, deleted_at, archived_at)
+        WHERE deleted_at IS NULL
+    ''')
+    # Finds archiving candidates without scanning every chat
+    conn.execute('''
+        CREATE INDEX idx_cloud_chats_hot_age ON cloud_chats(updated_at)
+        WHERE deleted_at IS NULL AND archived_at IS NULL
+    ''')
+
+    # Archived messages still count as stored messages and bytes
+    for name, event, user_id, sign in (('insert', 'INSERT', 'NEW', ''), ('delete', 'DELETE', 'OLD', '-')):
+        deltas = {'messages': f'{sign}{user_id}.message_count', 'message_bytes': f'{sign}length({user_id}.messages)'}
+        conn.execute(f'''
+            CREATE TRIGGER chat_stats_chat_archive_{name} AFTER {event} ON chat_archive
+            BEGIN {_count_statements(f'{user_id}.user_id', deltas)} END
+        ''')
+
+
+def _token_generation(conn):
+    """Counter bumped when a user's password changes, so older session tokens stop verifying"""
+    conn.execute('ALTER TABLE users ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0')
+
+
+def _purge_totals(conn):
+    """Trigger-maintained size of the purge backlog, so /api/stats never scans purge_queue"""
+    conn.execute('''
+        CREATE TABLE purge_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            chats INTEGER NOT NULL,
+            accounts INTEGER NOT NULL,
+            rows_purged INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO purge_totals (id, chats, accounts, rows_purged)
+        SELECT 0, COUNT(chat_id), COUNT(*) - COUNT(chat_id), COALESCE(SUM(rows_purged), 0) FROM purge_queue
+    ''')
+    for name, event, row, sign in (('insert', 'INSERT', 'NEW', '+'), ('delete', 'DELETE', 'OLD', '-')):
+        conn.execute(f'''
+            CREATE TRIGGER purge_totals_{name} AFTER {event} ON purge_queue
+            BEGIN
+                UPDATE purge_totals SET
+                    chats = chats {sign} ({row}.chat_id IS NOT NULL),
+                    accounts = accounts {sign} ({row}.chat_id IS NULL),
+                    rows_purged = rows_purged {sign} {row}.rows_purged
+                WHERE id = 0;
+            END
+        ''')
+    conn.execute('''
+        CREATE TRIGGER purge_totals_progress AFTER UPDATE OF rows_purged ON purge_queue
+        BEGIN
+            UPDATE purge_totals SET rows_purged = rows_purged + NEW.rows_purged - OLD.rows_purged WHERE id = 0;
+        END
+    ''')
+    # Oldest pending deletion, read with MIN(queued_at)
+    conn.execute('CREATE INDEX idx_purge_queue_queued_at ON purge_queue(queued_at)')
+
+
+def rebuild_chat_search(conn):
+    """Refill the search index from the stored messages of every live chat, archived ones included (reshard.py)"""
+    chat_search.clear(conn)
+    _index_chat_messages(conn)
+
+    archived = conn.execute('''
+        SELECT a.user_id, a.chat_id, a.message_count, a.messages
+        FROM chat_archive a
+        JOIN cloud_chats c ON c.user_id = a.user_id AND c.chat_id = a.chat_id
+        WHERE c.deleted_at IS NULL
+    ''')
+    for user_id, chat_id, message_count, stored in archived:
+        # One message JSON per line, see database._archive_chat
+        message_jsons = _stored_message_json(stored).split('\n') if message_count else []
+        chat_search.index_messages(conn, user_id, chat_id, [json.loads(text) for text in message_jsons], 0)
+
+
+# (version, description, function, scope) - append only, never reorder
+MIGRATIONS = [
+    (1, 'baseline schema (users)', _baseline_users, SCOPE_GLOBAL),
+    (1, 'baseline schema (chats)', _baseline_chats, SCOPE_CHATS),
+    (2, 'per-user chat keys and sync indexes', _per_user_chat_keys, SCOPE_CHATS),
+    (3, 'chat content hashes', _chat_content_hash, SCOPE_CHATS),
+    (4, 'normalized chat messages', _normalized_chat_messages, SCOPE_CHATS),
+    (5, 'chat tombstones for delta sync', _chat_tombstones, SCOPE_CHATS),
+    (6, 'covering index for paginated chat listing', _chat_listing_index, SCOPE_CHATS),
+    (7, 'full-text search over chat messages', _chat_search_index, SCOPE_CHATS),
+    (8, 'users change counter for the user directory', _users_version, SCOPE_GLOBAL),
+    (9, 'deployment settings', _settings, SCOPE_GLOBAL),
+    (10, 'purge queue for soft-deleted chats and accounts', _purge_queue, SCOPE_CHATS),
+    (11, 'users count for constant-time stats', _user_totals, SCOPE_GLOBAL),
+    (12, 'chat, message and byte counters per user', _chat_stats, SCOPE_CHATS),
+    (13, 'archive tier for inactive chats', _chat_archive, SCOPE_CHATS),
+    (14, 'session token generation per user', _token_generation, SCOPE_GLOBAL),
+    (15, 'purge backlog counters for constant-time stats', _purge_totals, SCOPE_CHATS),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn) -> int:
+    """Return the schema version recorded in the database file"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def apply_migrations(conn, scopes=(SCOPE_GLOBAL, SCOPE_CHATS)) -> list:
+    """
+    Apply every migration newer than the database's schema version.
+
+    Must be called inside a write transaction so concurrent workers
+    starting at the same time serialize and only one applies each step.
+
+    Args:
+        scopes: Which migrations this database file receives; the others are
+                skipped but still counted in its schema version
+
+    Returns:
+        List of (version, description) tuples that were applied
+    """
+    current = get_schema_version(conn)
+    applied = []
+
+    for version, description, migrate, scope in MIGRATIONS:
+        if version <= current or scope not in scopes:
+            continue
+        migrate(conn)
+        applied.append((version, description))
+
+    if SCHEMA_VERSION > current:
+        # PRAGMA does not accept bound parameters
+        conn.execute(f'PRAGMA user_version = {int(SCHEMA_VERSION)}')
+    return applied
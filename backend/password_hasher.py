@@ -0,0 +1,202 @@
+"""
+Password Hasher Module
+Runs password hashing on a dedicated, size-limited thread pool.
+
+Password KDFs are deliberately slow and CPU-bound. Running them inline
+lets a burst of logins occupy every request thread; here they are queued
+on a bounded executor and callers get HashingBusy (-> HTTP 429) when the
+queue is full instead of piling up. hashlib's pbkdf2 and scrypt release
+the GIL, so pool threads hash in parallel.
+
+The pool bounds hashing within one process. With gunicorn sync workers
+each process only ever has one login in flight, so app.py also gives the
+hasher shared slots (rate_limiter.SharedSlots) that cap hashes running
+in all workers together; a login over that cap gets 429 at once instead
+of taking another worker.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Hashes running at once across all worker processes; the other cores stay free for /api/analyze
+MAX_CONCURRENT_HASHES = int(os.environ.get('PASSWORD_HASH_MAX_CONCURRENT', max(1, (os.cpu_count() or 2) // 2)))
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full or a hash did not finish in time"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def normalize_method(method: str) -> str:
+    """
+    Expand a werkzeug hash method to the full form stored in hashes,
+    e.g. 'pbkdf2' -> 'pbkdf2:sha256:600000', 'scrypt' -> 'scrypt:32768:8:1'.
+    """
+    name, *args = method.split(':')
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    if name == 'scrypt':
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    return method
+
+
+class PasswordHasher:
+    """
+    Bounded executor for password hashing and verification.
+    - workers: threads hashing concurrently
+    - max_queue: requests allowed to wait for a free worker
+    - method: werkzeug hash method for new hashes; older hashes are
+      upgraded on the next successful login (see needs_rehash)
+    """
+
+    def __init__(self, workers: int, max_queue: int, method: str, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.method = normalize_method(method)
+        self.timeout = timeout
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._rehashed = 0
+        self._latencies = deque(maxlen=500)  # (queue wait, run time) in seconds
+        self._shared_slots = None
+        self.max_concurrent = None
+
+        print(f"🔐 Password hasher: {workers} workers, queue {max_queue}, method {self.method}")
+
+    def use_shared_slots(self, slots, max_concurrent: int = MAX_CONCURRENT_HASHES):
+        """Also cap hashes in flight across processes, using slots shared by all workers"""
+        self._shared_slots = slots
+        self.max_concurrent = max_concurrent
+
+    def hash(self, password: str) -> str:
+        """Hash a password with the configured method"""
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        """Check a password against a stored hash"""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """True if a stored hash was made with different parameters than configured"""
+        return password_hash.split('$', 1)[0] != self.method
+
+    def record_rehash(self):
+        with self._lock:
+            self._rehashed += 1
+
+    def stats(self) -> dict:
+        """Queue depth and latency metrics"""
+        with self._lock:
+            latencies = list(self._latencies)
+            pending = self._pending
+            stats = {
+                'method': self.method,
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'in_flight': pending,
+                'queue_depth': max(0, pending - self.workers),
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'rehashed': self._rehashed,
+                'max_concurrent_all_workers': self.max_concurrent,
+            }
+        if self._shared_slots is not None:
+            try:
+                stats['in_flight_all_workers'] = self._shared_slots.in_use('password_hash')
+            except sqlite3.Error:
+                stats['in_flight_all_workers'] = None
+
+        for label, index in (('wait', 0), ('run', 1)):
+            values = sorted(sample[index] for sample in latencies)
+            stats[f'{label}_ms_p50'] = round(values[len(values) // 2] * 1000, 1) if values else None
+            stats[f'{label}_ms_p95'] = round(values[int(len(values) * 0.95) - 1] * 1000, 1) if values else None
+        return stats
+
+    def _run(self, func, *args):
+        shared_slot = self._take_shared_slot()
+        if not self._slots.acquire(blocking=False):
+            self._release_shared_slot(shared_slot)
+            with self._lock:
+                self._rejected += 1
+            raise HashingBusy("Too many sign-in requests right now, please try again shortly")
+
+        with self._lock:
+            self._pending += 1
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._latencies.append((started - submitted, finished - started))
+                    self._completed += 1
+                # Before the result is published: done callbacks may run only
+                # after the caller has returned and started its next hash
+                self._release_shared_slot(shared_slot)
+
+        def release(_future):
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+        future = self._executor.submit(timed)
+        # The slot is freed when the work finishes, even if the caller gave up waiting
+        future.add_done_callback(release)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise HashingBusy("Password check timed out, please try again", retry_after=2)
+
+    def _take_shared_slot(self):
+        """A slot from the cross-process cap, None if there is no cap; raises HashingBusy when full"""
+        if self._shared_slots is None:
+            return None
+        try:
+            # A slot outliving twice the timeout belongs to a stuck hash and is reclaimed
+            token = self._shared_slots.acquire('password_hash', self.max_concurrent, ttl=2 * self.timeout)
+        except sqlite3.Error as e:
+            print(f"⚠️ Shared hashing slots unavailable, hashing anyway: {e}")
+            return None
+        if token is None:
+            with self._lock:
+                self._rejected += 1
+            raise HashingBusy("Too many sign-in requests right now, please try again shortly")
+        return token
+
+    def _release_shared_slot(self, token):
+        if token is None:
+            return
+        try:
+            self._shared_slots.release(token)
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not release shared hashing slot: {e}")
+
+
+# Singleton instance for easy import
+password_hasher = PasswordHasher(
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)),
+    max_queue=int(os.environ.get('PASSWORD_HASH_QUEUE', 16)),
+    method=os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2'),
+    timeout=float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10)),
+)
@@ -0,0 +1,294 @@
+"""
+Rate Limiter Module
+Token-bucket rate limits and concurrency caps for expensive endpoints.
+
+/api/analyze holds a worker for seconds waiting on the AI provider and
+/api/upload burns CPU on document extraction, so each endpoint class gets:
+- a token bucket per client (signed-in user, else IP address) stored in
+  a small SQLite file next to the main database, so every gunicorn
+  worker draws from the same budget;
+- a cap on requests in flight across all workers, so a burst is turned
+  away with 429 + Retry-After instead of queuing behind busy workers.
+
+Each bucket update is a single UPSERT statement, which SQLite applies
+atomically across processes. Requests in flight are rows in the same
+file (see SharedSlots); the slots of a worker that died are reclaimed.
+If the limiter's database fails, requests are let through rather than
+blocking every user.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import math
+import time
+import sqlite3
+import secrets
+import threading
+
+import database
+
+# Budgets as "<requests>/<seconds>": a client may burst up to <requests>
+# calls, refilled evenly over <seconds>. "0" turns a limit off.
+DEFAULT_LIMITS = {
+    'analyze': os.environ.get('RATE_LIMIT_ANALYZE', '20/60'),
+    'upload': os.environ.get('RATE_LIMIT_UPLOAD', '10/60'),
+}
+
+# Requests of each class allowed in flight at once across all worker processes
+DEFAULT_CONCURRENCY = {
+    'analyze': int(os.environ.get('MAX_CONCURRENT_ANALYZE', 8)),
+    'upload': int(os.environ.get('MAX_CONCURRENT_UPLOAD', os.cpu_count() or 2)),
+}
+
+# Drop buckets that have refilled completely every this many checks
+PRUNE_EVERY = 1000
+
+# A slot still held after this long is reclaimed, in case its request hung
+SLOT_TTL_SECONDS = float(os.environ.get('CONCURRENCY_SLOT_TTL', 600))
+
+
+class RateLimited(Exception):
+    """Raised when a client is over its budget or the endpoint is saturated"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_limit(spec: str):
+    """'20/60' -> (capacity 20, refill 1/3 token per second); None if disabled"""
+    spec = (spec or '').strip()
+    if spec in ('', '0', 'off'):
+        return None
+    requests, _, seconds = spec.partition('/')
+    capacity, period = float(requests), float(seconds or 60)
+    if capacity <= 0 or period <= 0:
+        return None
+    return capacity, capacity / period
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedSlots:
+    """
+    Counted slots shared by every process using the same SQLite file, for
+    caps that must hold across gunicorn workers. A held slot is a row
+    tagged with its process id; when a name is full, rows of processes
+    that died and rows older than their ttl are reclaimed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._create_schema()
+
+    def _create_schema(self):
+        """Create the slots table; runs once, at startup"""
+        try:
+            conn = self._connection()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS concurrency_slots (
+                    token TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_concurrency_slots_name ON concurrency_slots(name, expires_at)')
+        except sqlite3.Error as e:
+            print(f"⚠️ Concurrency slots unavailable: {e}")
+
+    def _connection(self):
+        return database.get_connection(self.path)
+
+    def acquire(self, name: str, limit: int, ttl: float = SLOT_TTL_SECONDS):
+        """
+        Take one of limit slots called name. Returns a token to pass to
+        release(), or None if all are taken. Raises sqlite3.Error.
+        """
+        token = secrets.token_hex(8)
+        conn = self._connection()
+        for attempt in range(2):
+            now = time.time()
+            # One statement, so the count and the insert are atomic across processes
+            taken = conn.execute('''
+                INSERT INTO concurrency_slots (token, name, pid, expires_at)
+                SELECT ?, ?, ?, ?
+                WHERE (SELECT COUNT(*) FROM concurrency_slots WHERE name = ? AND expires_at > ?) < ?
+            ''', (token, name, os.getpid(), now + ttl, name, now, limit)).rowcount
+            if taken:
+                return token
+            if attempt == 0 and not self._reclaim(conn, name, now):
+                break
+        return None
+
+    def _reclaim(self, conn, name: str, now: float) -> bool:
+        """Free slots held past their ttl or by dead processes; True if any were freed"""
+        freed = conn.execute('DELETE FROM concurrency_slots WHERE name = ? AND expires_at <= ?', (name, now)).rowcount
+        pids = [row[0] for row in conn.execute('SELECT DISTINCT pid FROM concurrency_slots WHERE name = ?', (name,))]
+        dead = [(pid,) for pid in pids if not _process_alive(pid)]
+        if dead:
+            freed += conn.executemany('DELETE FROM concurrency_slots WHERE pid = ?', dead).rowcount
+        return freed > 0
+
+    def release(self, token: str):
+        self._connection().execute('DELETE FROM concurrency_slots WHERE token = ?', (token,))
+
+    def in_use(self, name: str) -> int:
+        """Slots of name held by live processes (for stats)"""
+        conn = self._connection()
+        now = time.time()
+        self._reclaim(conn, name, now)
+        return conn.execute(
+            'SELECT COUNT(*) FROM concurrency_slots WHERE name = ? AND expires_at > ?', (name, now)
+        ).fetchone()[0]
+
+
+class RateLimiter:
+    """
+    Shared token buckets plus shared concurrency slots.
+    - limits: endpoint class -> "<requests>/<seconds>" budget
+    - concurrency: endpoint class -> max requests in flight across all workers
+    """
+
+    def __init__(self, path: str, limits: dict, concurrency: dict):
+        self.path = path
+        self.limits = {name: parse_limit(spec) for name, spec in limits.items()}
+        self.slots = SharedSlots(path)
+        self.concurrency = {name: n for name, n in concurrency.items() if n > 0}
+        self._lock = threading.Lock()
+        self._checks = 0
+        self._counts = {name: {'allowed': 0, 'limited': 0, 'shed': 0, 'in_flight': 0}
+                        for name in set(limits) | set(concurrency)}
+
+        # Buckets untouched this long are full again and can be forgotten
+        refill_times = [capacity / rate for capacity, rate in filter(None, self.limits.values())]
+        self._idle_seconds = max(refill_times, default=0)
+
+        enabled = ', '.join(f"{name} {spec}" for name, spec in limits.items() if self.limits[name])
+        print(f"🚦 Rate limits: {enabled or 'off'}; concurrency {self.concurrency}")
+        self._create_schema()
+
+    def _create_schema(self):
+        """Create the limiter's table; runs once, when the limiter is created at startup"""
+        try:
+            self._connection().execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+        except sqlite3.Error as e:
+            print(f"⚠️ Rate limiter storage unavailable: {e}")
+
+    def _connection(self):
+        return database.get_connection(self.path)
+
+    def _take(self, name: str, client: str, cost: float = 1.0):
+        """Take cost tokens from the client's bucket; raise RateLimited if it is short"""
+        limit = self.limits.get(name)
+        if limit is None:
+            return
+        capacity, rate = limit
+        key = f"{name}:{client}"
+        now = time.time()
+
+        try:
+            conn = self._connection()
+            # The WHERE clause leaves an empty bucket untouched, so no row comes back
+            row = conn.execute('''
+                INSERT INTO rate_buckets (key, tokens, updated) VALUES (?1, ?2 - ?5, ?3)
+                ON CONFLICT(key) DO UPDATE SET
+                    tokens = min(?2, tokens + max(0, ?3 - updated) * ?4) - ?5,
+                    updated = max(updated, ?3)
+                WHERE min(?2, tokens + max(0, ?3 - updated) * ?4) >= ?5
+                RETURNING tokens
+            ''', (key, capacity, now, rate, cost)).fetchone()
+
+            if row is None:
+                current = conn.execute(
+                    'SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)
+                ).fetchone()
+                available = min(capacity, current[0] + max(0.0, now - current[1]) * rate) if current else 0.0
+                retry_after = max(1, math.ceil((cost - available) / rate))
+                with self._lock:
+                    self._counts[name]['limited'] += 1
+                raise RateLimited("Too many requests, please slow down and try again shortly", retry_after)
+
+            with self._lock:
+                self._checks += 1
+                prune = self._checks % PRUNE_EVERY == 0
+            if prune:
+                conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - self._idle_seconds,))
+        except sqlite3.Error as e:
+            print(f"⚠️ Rate limiter unavailable, allowing request: {e}")
+
+    def acquire(self, name: str, client: str):
+        """
+        Admit one request of class name from client, or raise RateLimited.
+        Returns the request's slot token (None if uncapped); every
+        successful acquire must be paired with release(name, token).
+        """
+        token = None
+        if name in self.concurrency:
+            try:
+                token = self.slots.acquire(name, self.concurrency[name])
+            except sqlite3.Error as e:
+                print(f"⚠️ Concurrency slots unavailable, allowing request: {e}")
+            else:
+                if token is None:
+                    with self._lock:
+                        self._counts[name]['shed'] += 1
+                    raise RateLimited("The server is busy right now, please try again shortly")
+        try:
+            self._take(name, client)
+        except RateLimited:
+            self._release_slot(token)
+            raise
+        with self._lock:
+            self._counts[name]['allowed'] += 1
+            self._counts[name]['in_flight'] += 1
+        return token
+
+    def release(self, name: str, token: str = None):
+        with self._lock:
+            self._counts[name]['in_flight'] -= 1
+        self._release_slot(token)
+
+    def _release_slot(self, token: str):
+        if token is None:
+            return
+        try:
+            self.slots.release(token)
+        except sqlite3.Error as e:
+            # The slot expires after SLOT_TTL_SECONDS
+            print(f"⚠️ Could not release concurrency slot: {e}")
+
+    def stats(self) -> dict:
+        """Per-class limits, this process's admission counters and requests in flight in all workers"""
+        with self._lock:
+            counts = {name: dict(values) for name, values in self._counts.items()}
+        for name, values in counts.items():
+            limit = self.limits.get(name)
+            values['burst'] = int(limit[0]) if limit else None
+            values['per_minute'] = round(limit[1] * 60, 2) if limit else None
+            values['max_concurrent'] = self.concurrency.get(name)
+            if name in self.concurrency:
+                try:
+                    values['in_flight_all_workers'] = self.slots.in_use(name)
+                except sqlite3.Error:
+                    values['in_flight_all_workers'] = None
+        return counts
+
+
+def create_rate_limiter(database_path: str) -> RateLimiter:
+    return RateLimiter(database_path + '.ratelimit', DEFAULT_LIMITS, DEFAULT_CONCURRENCY)
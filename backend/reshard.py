@@ -0,0 +1,165 @@
+"""
+Reshard Tool
+Moves chat data to a different number of chat shard files.
+
+Stop the app (every gunicorn worker) first; the tool refuses to run while
+a worker holds the background-jobs lock. New shard files are filled
+completely before the shard count recorded in the main database is
+switched, so an interrupted run leaves the old layout in use and can
+simply be repeated. Afterwards start the app with CHAT_SHARDS set to the
+new count.
+
+Usage:
+    python reshard.py --shards 4 [--database path/to/users.db]
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+import migrations
+import chat_search
+from shards import ShardRouter, SHARDED_TABLES, shard_index
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+DEFAULT_DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db'))
+
+
+def open_database(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.create_function('shard_of', 2, shard_index, deterministic=True)
+    return conn
+
+
+def migrate(conn, scopes):
+    conn.execute('BEGIN IMMEDIATE')
+    migrations.apply_migrations(conn, scopes=scopes)
+    conn.execute('COMMIT')
+
+
+def copy_columns(conn, table):
+    """Columns to copy; surrogate INTEGER PRIMARY KEY ids are reassigned"""
+    return ', '.join(
+        name for _cid, name, _type, _notnull, _default, pk in conn.execute(f'PRAGMA main.table_info({table})')
+        if not (name == 'id' and pk)
+    )
+
+
+def clear_chat_tables(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    for table in SHARDED_TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    chat_search.clear(conn)
+    conn.execute('COMMIT')
+
+
+def remove_database_files(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def app_is_running(main_path):
+    """True if an app worker holds the background-jobs lock"""
+    if not FCNTL_AVAILABLE or not os.path.exists(main_path + '.jobs.lock'):
+        return False
+    with open(main_path + '.jobs.lock', 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    return False
+
+
+def reshard(main_path, target):
+    main = open_database(main_path)
+    migrate(main, (migrations.SCOPE_GLOBAL, migrations.SCOPE_CHATS))
+    current = int(main.execute("SELECT value FROM settings WHERE name = 'chat_shards'").fetchone()[0])
+    if current == target:
+        print(f"Chats are already stored in {target} shard(s), nothing to do")
+        return
+
+    old_paths = [path or main_path for path in ShardRouter(main_path, current).paths()]
+    new_paths = [path or main_path for path in ShardRouter(main_path, target).paths()]
+    print(f"Resharding chats from {current} to {target} shard(s)")
+    started = time.perf_counter()
+
+    # Start from empty destinations (left over if an earlier run was interrupted)
+    for path in new_paths:
+        if path == main_path:
+            # Not live while chats are sharded, so any rows here are leftovers
+            clear_chat_tables(main)
+        else:
+            remove_database_files(path)
+            conn = open_database(path)
+            migrate(conn, (migrations.SCOPE_CHATS,))
+            conn.close()
+
+    for index, dest_path in enumerate(new_paths):
+        dest = main if dest_path == main_path else open_database(dest_path)
+        copied = dict.fromkeys(SHARDED_TABLES, 0)
+        for src_path in old_paths:
+            # ATTACH is not allowed inside a transaction, so copy one source at a time
+            dest.execute('ATTACH DATABASE ? AS src', (src_path,))
+            dest.execute('BEGIN IMMEDIATE')
+            for table in SHARDED_TABLES:
+                columns = copy_columns(dest, table)
+                copied[table] += dest.execute(f'''
+                    INSERT INTO main.{table} ({columns})
+                    SELECT {columns} FROM src.{table} WHERE shard_of(user_id, ?) = ?
+                ''', (target, index)).rowcount
+            dest.execute('COMMIT')
+            dest.execute('DETACH DATABASE src')
+        # The contentless search index holds no text to copy; index the moved messages
+        dest.execute('BEGIN IMMEDIATE')
+        migrations.rebuild_chat_search(dest)
+        dest.execute('COMMIT')
+        print(f"  {os.path.basename(dest_path)}: " + ', '.join(f"{count} {table}" for table, count in copied.items()))
+        if dest is not main:
+            dest.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            dest.close()
+
+    # Switch to the new layout, then drop the old copies
+    main.execute('BEGIN IMMEDIATE')
+    main.execute("UPDATE settings SET value = ? WHERE name = 'chat_shards'", (str(target),))
+    main.execute('COMMIT')
+
+    for path in old_paths:
+        if path == main_path:
+            clear_chat_tables(main)
+        else:
+            remove_database_files(path)
+
+    print(f"✅ Done in {time.perf_counter() - started:.1f}s - start the app with CHAT_SHARDS={target}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shards', type=int, required=True, help='new number of chat shards')
+    parser.add_argument('--database', default=DEFAULT_DATABASE_PATH, help='main database (users.db)')
+    args = parser.parse_args()
+
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+    if not os.path.exists(args.database):
+        parser.error(f'{args.database} does not exist')
+    if app_is_running(args.database):
+        print("❌ The app is running against this database; stop it before resharding")
+        sys.exit(1)
+
+    reshard(args.database, args.shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Session Tokens Module
+Signed, expiring session tokens issued at login.
+
+A token is base64url(JSON claims) + '.' + base64url(HMAC-SHA256 of the
+claims). Verifying one needs the secret key and a primary-key lookup of
+the user's token generation, so authenticated requests never hash the
+password: it is hashed once per session instead of on every sensitive call.
+
+The generation is bumped when the password is changed or reset, which
+revokes every token issued before; a deleted account has no generation,
+so its tokens stop verifying too. Tokens from before generations existed
+count as generation 0.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+from typing import Callable, Optional
+
+# How long a token stays valid after login
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', 30 * 24 * 3600))
+
+# Sensitive operations (password change, account deletion) accept the
+# session instead of the password only within this long after login
+SESSION_REAUTH_SECONDS = int(os.environ.get('SESSION_REAUTH_SECONDS', 3600))
+
+
+def _load_secret(path: str) -> bytes:
+    """
+    SESSION_SECRET from the environment, or a random key persisted at path
+    so every worker process (and restarts) share the same key.
+    """
+    secret = os.environ.get('SESSION_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+
+    if not os.path.exists(path):
+        # Write a complete key under a temporary name, then link it into
+        # place; if another worker won the race, use its key instead
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_hex(32).encode('ascii'))
+        try:
+            os.link(tmp_path, path)
+            print(f"🔑 Generated session secret at {path} (set SESSION_SECRET to manage it yourself)")
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class SessionTokens:
+    """
+    Issues and verifies HMAC-signed session tokens.
+    - generation_of: returns a user id's current token generation, or None
+      if the user no longer exists; without it generations are not checked
+    """
+
+    def __init__(self, secret: bytes, ttl: int = SESSION_TTL_SECONDS,
+                 generation_of: Callable[[int], Optional[int]] = None):
+        self._secret = secret
+        self.ttl = ttl
+        self.generation_of = generation_of
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, user: dict, auth_time: int = None) -> str:
+        """
+        Create a token for a user dict (id, email).
+        auth_time is when the password was last checked; it is kept when a
+        token is reissued after a profile change.
+        """
+        now = int(time.time())
+        claims = {
+            'uid': user['id'],
+            'email': user['email'],
+            'auth': auth_time or now,
+            'exp': now + self.ttl,
+        }
+        if self.generation_of is not None:
+            claims['gen'] = self.generation_of(user['id'])
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str):
+        """Return the token's claims, or None if it is malformed, forged, expired or revoked"""
+        try:
+            payload, signature = token.split('.')
+            # Non-ASCII text cannot be one of our tokens (TypeError from compare_digest)
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+            return None
+        if self.generation_of is not None:
+            generation = self.generation_of(claims.get('uid'))
+            if generation is None or generation != claims.get('gen', 0):
+                return None
+        return claims
+
+    @staticmethod
+    def recently_authenticated(claims) -> bool:
+        """True if the session's password check is recent enough for sensitive operations"""
+        return bool(claims) and time.time() - claims.get('auth', 0) <= SESSION_REAUTH_SECONDS
+
+
+def create_session_tokens(database_path: str, generation_of: Callable[[int], Optional[int]] = None) -> SessionTokens:
+    return SessionTokens(_load_secret(database_path + '.session-secret'), generation_of=generation_of)
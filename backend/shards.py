@@ -0,0 +1,77 @@
+"""
+Chat Shards Module
+Maps users to the SQLite file that holds their chats.
+
+SQLite allows one writer per database file, so with every chat in
+users.db all saves queue on the same lock. Chat tables (cloud_chats,
+chat_messages, chat_search, user_chats) can instead be spread over N
+files by a hash of user_id; each user's chats live in exactly one file,
+so per-user operations never span shards. The users table always stays
+in the main database.
+
+With one shard the chats stay in the main database file, the layout used
+before sharding existed. Changing the shard count of an existing
+deployment requires moving data with reshard.py.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import zlib
+
+# Per-user tables that live in the chat shards. Every one has a user_id
+# column; reshard.py moves rows of exactly these tables. The search index
+# (chat_search, chat_search_rows) also lives in the shards but is rebuilt
+# from the moved messages rather than copied.
+SHARDED_TABLES = ('user_chats', 'cloud_chats', 'chat_messages', 'purge_queue', 'chat_archive')
+
+
+def shard_key(user_id) -> str:
+    """Canonical text of a user id, so 5 and '5' land on the same shard"""
+    try:
+        return str(int(user_id))
+    except (TypeError, ValueError):
+        return str(user_id)
+
+
+def shard_index(user_id, count: int) -> int:
+    """Shard number (0..count-1) holding a user's chats"""
+    if count == 1:
+        return 0
+    return zlib.crc32(shard_key(user_id).encode('utf-8')) % count
+
+
+class ShardRouter:
+    """Resolves user ids to chat database paths for a fixed shard count"""
+
+    def __init__(self, main_path: str, count: int):
+        if count < 1:
+            raise ValueError("Shard count must be at least 1")
+        self.main_path = main_path
+        self.count = count
+
+    def path(self, index: int):
+        """
+        Path of shard `index`. None stands for the main database, which
+        database.get_connection resolves at call time.
+        """
+        if self.count == 1:
+            return None
+        root, ext = os.path.splitext(self.main_path)
+        # The count is part of the name, so a reshard never writes into live files
+        return f"{root}.chats-{index}-of-{self.count}{ext or '.db'}"
+
+    def paths(self) -> list:
+        """Every shard path, in shard order"""
+        return [self.path(index) for index in range(self.count)]
+
+    def path_for(self, user_id):
+        """Path of the shard holding a user's chats"""
+        return self.path(shard_index(user_id, self.count))
+
+    def group_by_shard(self, user_ids) -> dict:
+        """{shard path: [user ids]} for a collection of users"""
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.path_for(user_id), []).append(user_id)
+        return groups
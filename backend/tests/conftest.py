@@ -0,0 +1,49 @@
+"""
+Shared pytest setup for the backend tests.
+
+The database module opens DATABASE_PATH when it is imported, so the path
+is pointed at a throwaway directory before any test imports it. The
+write-behind flusher is slowed down so tests decide when saves are flushed,
+and passwords use a cheap hash so creating users stays fast.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sys
+import uuid
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='medical-ai-tests-'), 'users.db')
+os.environ['WRITE_BEHIND_MAX_DELAY'] = '60'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+
+
+@pytest.fixture
+def flask_app():
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def user(flask_app):
+    """A freshly registered user dict (id, username, email)"""
+    name = f'user-{uuid.uuid4().hex[:12]}'
+    result = flask_app.database.create_user(name, f'{name}@example.com', 'secret123')
+    assert result['success'], result
+    return result['user']
+
+
+@pytest.fixture
+def client(flask_app, user):
+    """Test client sending a session token of user"""
+    client = flask_app.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f"Bearer {flask_app.session_tokens.issue(user)}"
+    return client
@@ -0,0 +1,59 @@
+"""
+Tests for batched chat sync.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import pytest
+
+
+def chat(chat_id, *contents, title='Chat'):
+    return {'id': chat_id, 'title': title, 'messages': [{'role': 'user', 'content': c} for c in contents]}
+
+
+@pytest.fixture
+def database():
+    import database
+    database.chat_writer.flush()
+    return database
+
+
+def statuses(result):
+    assert result['success'], result
+    return {chat_id: status['status'] for chat_id, status in result['results'].items()}
+
+
+def test_round_trip(database):
+    assert statuses(database.sync_chats_to_cloud(201, [chat('a', 'hi'), chat('b')])) == {'a': 'created', 'b': 'created'}
+    assert statuses(database.sync_chats_to_cloud(201, [chat('a', 'hi'), chat('b')])) == {'a': 'unchanged', 'b': 'unchanged'}
+    assert statuses(database.sync_chats_to_cloud(201, [chat('a', 'hi', 'there')])) == {'a': 'updated'}
+
+    stored = database.get_user_chats_from_cloud(201)
+    assert [m['content'] for m in stored['a']['messages']] == ['hi', 'there']
+    assert stored['b']['messages'] == []
+
+
+def test_numeric_id_resync(database):
+    assert statuses(database.sync_chats_to_cloud(202, [chat(5, 'hi')])) == {'5': 'created'}
+    assert statuses(database.sync_chats_to_cloud(202, [chat(5, 'hi')])) == {'5': 'unchanged'}
+    assert statuses(database.sync_chats_to_cloud(202, [chat(5, 'hi', 'again')])) == {'5': 'updated'}
+    assert statuses(database.sync_chats_to_cloud(202, [chat('5', 'hi', 'again')])) == {'5': 'unchanged'}
+
+    stored = database.get_user_chats_from_cloud(202)
+    assert list(stored) == ['5']
+    assert len(stored['5']['messages']) == 2
+
+
+def test_numeric_and_string_id_save_once(database):
+    database.save_chat_to_cloud(203, chat(7, 'one'))
+    database.save_chat_to_cloud(203, chat('7', 'one', 'two'))
+    database.flush_pending_saves(203)
+
+    stored = database.get_user_chats_from_cloud(203)
+    assert list(stored) == ['7']
+    assert len(stored['7']['messages']) == 2
+
+
+def test_invalid_chat_does_not_fail_batch(database):
+    result = database.sync_chats_to_cloud(204, [chat('ok'), {'title': 'no id'}, {'id': 'bad', 'messages': 'x'}])
+    assert statuses(result) == {'ok': 'created', '#1': 'error', 'bad': 'error'}
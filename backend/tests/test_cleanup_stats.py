@@ -0,0 +1,72 @@
+"""
+Tests for the purge backlog counters shown on /api/stats.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import sqlite3
+
+import pytest
+
+import migrations
+
+
+@pytest.fixture
+def database(monkeypatch):
+    import database
+    database.chat_writer.flush()
+    monkeypatch.setattr(database, 'CLEANUP_STATS_MAX_AGE', 0)
+    return database
+
+
+def actual_backlog(database):
+    queue = {'chats': 0, 'accounts': 0, 'rows_purged': 0}
+    for path in database.shards.paths():
+        chats, accounts, rows_purged = database.get_connection(path).execute(
+            'SELECT COUNT(chat_id), COUNT(*) - COUNT(chat_id), COALESCE(SUM(rows_purged), 0) FROM purge_queue'
+        ).fetchone()
+        queue.update(chats=queue['chats'] + chats, accounts=queue['accounts'] + accounts,
+                     rows_purged=queue['rows_purged'] + rows_purged)
+    return queue
+
+
+def backlog(database):
+    queue = database.get_cleanup_progress()['purge_queue']
+    return {key: queue[key] for key in ('chats', 'accounts', 'rows_purged')}
+
+
+def test_counters_follow_deletes_and_purges(database):
+    messages = [{'role': 'user', 'content': str(i)} for i in range(5)]
+    database.sync_chats_to_cloud(401, [{'id': f'c{i}', 'title': 't', 'messages': messages} for i in range(3)])
+    for i in range(2):
+        database.delete_chat_from_cloud(401, f'c{i}')
+    assert backlog(database) == actual_backlog(database)
+    assert database.get_cleanup_progress()['purge_queue']['oldest_queued_at'] is not None
+
+    while database.purge_deleted(batch_size=2):
+        assert backlog(database) == actual_backlog(database)
+    assert backlog(database) == {'chats': 0, 'accounts': 0, 'rows_purged': 0}
+
+
+def test_result_is_reused_within_max_age(database, monkeypatch):
+    first = database.get_cleanup_progress()
+    monkeypatch.setattr(database, 'CLEANUP_STATS_MAX_AGE', 60)
+    database.sync_chats_to_cloud(402, [{'id': 'x', 'title': 't', 'messages': []}])
+    database.delete_chat_from_cloud(402, 'x')
+    assert database.get_cleanup_progress() is database.get_cleanup_progress()
+    monkeypatch.setattr(database, 'CLEANUP_STATS_MAX_AGE', 0)
+    assert database.get_cleanup_progress()['purge_queue']['chats'] == first['purge_queue']['chats'] + 1
+
+
+def test_migration_backfills_queued_deletions(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'chats.db', isolation_level=None)
+    conn.execute('BEGIN')
+    for version, _description, migrate, scope in migrations.MIGRATIONS:
+        if version < 15 and scope == migrations.SCOPE_CHATS:
+            migrate(conn)
+    conn.executemany('INSERT INTO purge_queue (user_id, chat_id, rows_purged) VALUES (?, ?, ?)',
+                     [(1, 'a', 3), (1, None, 4), (2, 'b', 0)])
+    migrations._purge_totals(conn)
+    conn.execute('COMMIT')
+
+    assert conn.execute('SELECT chats, accounts, rows_purged FROM purge_totals').fetchone() == (2, 1, 7)
@@ -0,0 +1,47 @@
+"""
+Tests for how rate-limited requests are attributed to clients.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import pytest
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+
+@pytest.mark.parametrize('environ, expected', [
+    ({}, 0),
+    ({'RENDER': 'true'}, 1),
+    ({'DYNO': 'web.1'}, 1),
+    ({'RENDER': 'true', 'TRUSTED_PROXIES': '2'}, 2),
+    ({'DYNO': 'web.1', 'TRUSTED_PROXIES': '0'}, 0),
+])
+def test_trusted_proxy_count(flask_app, environ, expected):
+    assert flask_app.trusted_proxy_count(environ) == expected
+
+
+def test_signed_in_client_is_keyed_by_user(flask_app, user):
+    token = flask_app.session_tokens.issue(user)
+    with flask_app.app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+        assert flask_app.client_identity() == f"user:{user['id']}"
+
+
+def test_anonymous_clients_behind_proxy_get_own_buckets(flask_app):
+    identities = []
+    app = flask_app.app
+
+    @app.route('/_test/identity')
+    def identity():
+        identities.append(flask_app.client_identity())
+        return ''
+
+    proxied = ProxyFix(app.wsgi_app, x_for=1)
+    original, app.wsgi_app = app.wsgi_app, proxied
+    try:
+        client = app.test_client()
+        for ip in ('203.0.113.5', '198.51.100.7'):
+            client.get('/_test/identity', headers={'X-Forwarded-For': f'6.6.6.6, {ip}'},
+                       environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    finally:
+        app.wsgi_app = original
+
+    assert identities == ['ip:203.0.113.5', 'ip:198.51.100.7']
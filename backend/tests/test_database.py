@@ -0,0 +1,55 @@
+"""
+Tests for the shared connection and transaction helpers.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import threading
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'scratch.db')
+    database.get_connection(path).execute('CREATE TABLE items (name TEXT)')
+    return path
+
+
+def names(path):
+    return [row[0] for row in database.get_connection(path).execute('SELECT name FROM items ORDER BY name')]
+
+
+def test_connection_is_shared_per_thread(path):
+    assert database.get_connection(path) is database.get_connection(path)
+    others = []
+    thread = threading.Thread(target=lambda: others.append(database.get_connection(path)))
+    thread.start()
+    thread.join()
+    assert others[0] is not database.get_connection(path)
+
+
+def test_connection_uses_wal(path):
+    assert database.get_connection(path).execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_transaction_commits_and_rolls_back(path):
+    with database.transaction(path) as conn:
+        conn.execute("INSERT INTO items VALUES ('kept')")
+    with pytest.raises(RuntimeError):
+        with database.transaction(path) as conn:
+            conn.execute("INSERT INTO items VALUES ('lost')")
+            raise RuntimeError
+    assert names(path) == ['kept']
+
+
+def test_nested_failure_keeps_outer_work(path):
+    with database.transaction(path) as conn:
+        conn.execute("INSERT INTO items VALUES ('outer')")
+        with pytest.raises(RuntimeError):
+            with database.transaction(path) as inner:
+                inner.execute("INSERT INTO items VALUES ('inner')")
+                raise RuntimeError
+    assert names(path) == ['outer']
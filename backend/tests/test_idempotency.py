@@ -0,0 +1,77 @@
+"""
+Tests for Idempotency-Key replay.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import pytest
+
+import idempotency
+from idempotency import IdempotencyConflict, IdempotencyStore, request_fingerprint
+from rate_limiter import RateLimited
+
+
+@pytest.fixture
+def store(tmp_path):
+    return IdempotencyStore(str(tmp_path / 'idempotency.db'))
+
+
+class TestStore:
+    def test_replays_stored_response(self, store):
+        fingerprint = request_fingerprint('POST', '/api/analyze', [b'{"text": "a"}'])
+        assert store.begin('k', fingerprint) is None
+        store.finish('k', 200, {'Content-Type': 'application/json'}, b'{"ok": true}')
+
+        assert store.begin('k', fingerprint) == (200, {'Content-Type': 'application/json'}, b'{"ok": true}')
+        assert store.stats()['replayed'] == 1
+
+    def test_rejects_key_reused_for_other_request(self, store):
+        store.begin('k', request_fingerprint('POST', '/api/analyze', [b'a']))
+        store.finish('k', 200, {}, b'')
+
+        with pytest.raises(IdempotencyConflict) as e:
+            store.begin('k', request_fingerprint('POST', '/api/analyze', [b'b']))
+        assert e.value.status == 422
+
+    def test_abandoned_key_runs_again(self, store):
+        assert store.begin('k', 'f') is None
+        store.abandon('k')
+        assert store.begin('k', 'f') is None
+
+    def test_expired_response_is_not_replayed(self, store, monkeypatch):
+        monkeypatch.setattr(idempotency, 'IDEMPOTENCY_TTL_SECONDS', -1)
+        store.begin('k', 'f')
+        store.finish('k', 200, {}, b'old')
+        assert store.begin('k', 'f') is None
+
+
+class TestEndpoints:
+    def test_retried_save_is_replayed(self, client):
+        body = {'chat_data': {'id': 'idem', 'title': 'Idem', 'messages': []}}
+        first = client.post('/api/chats/save', json=body, headers={'Idempotency-Key': 'save-1'})
+        retry = client.post('/api/chats/save', json=body, headers={'Idempotency-Key': 'save-1'})
+
+        assert first.status_code == retry.status_code == 200
+        assert retry.headers.get('Idempotent-Replayed') == 'true'
+        assert retry.get_data() == first.get_data()
+
+    def test_key_reused_with_other_body_conflicts(self, client):
+        client.post('/api/chats/save', json={'chat_data': {'id': 'a', 'messages': []}},
+                    headers={'Idempotency-Key': 'save-2'})
+        response = client.post('/api/chats/save', json={'chat_data': {'id': 'b', 'messages': []}},
+                               headers={'Idempotency-Key': 'save-2'})
+
+        assert response.status_code == 422
+        assert 'Idempotent-Replayed' not in response.headers
+
+    def test_rate_limit_is_checked_before_the_key_is_claimed(self, flask_app, client, monkeypatch):
+        def limited(endpoint_class, client):
+            raise RateLimited('Too many requests', retry_after=3)
+
+        claims = []
+        monkeypatch.setattr(flask_app.rate_limiter, 'acquire', limited)
+        monkeypatch.setattr(flask_app.idempotency_store, 'begin', lambda *args: claims.append(args))
+        response = client.post('/api/analyze', json={'text': 'headache'}, headers={'Idempotency-Key': 'analyze-1'})
+
+        assert response.status_code == 429
+        assert claims == []
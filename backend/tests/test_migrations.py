@@ -0,0 +1,121 @@
+"""
+Tests for the versioned schema migrations.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+import chat_search
+import migrations
+
+
+# Schema of the original single-file database, before any migration existed
+BASELINE_SCHEMA = (
+    '''CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE cloud_chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        chat_id TEXT UNIQUE NOT NULL,
+        title TEXT NOT NULL,
+        messages TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE user_chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        chat_id TEXT NOT NULL,
+        chat_data TEXT NOT NULL,
+        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+)
+
+
+def migrate(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    applied = migrations.apply_migrations(conn)
+    conn.execute('COMMIT')
+    return applied
+
+
+def table_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+@pytest.fixture
+def conn(tmp_path):
+    connection = sqlite3.connect(tmp_path / 'users.db', isolation_level=None)
+    yield connection
+    connection.close()
+
+
+@pytest.fixture
+def baseline_conn(conn):
+    for statement in BASELINE_SCHEMA:
+        conn.execute(statement)
+    conn.execute("INSERT INTO users (username, email, password_hash) VALUES ('ama', 'ama@example.com', 'x')")
+    for i in range(3):
+        messages = [
+            {'role': 'user', 'content': f'my headache number {i}'},
+            {'role': 'assistant', 'content': 'drink some water'},
+        ]
+        conn.execute(
+            'INSERT INTO cloud_chats (user_id, chat_id, title, messages) VALUES (1, ?, ?, ?)',
+            (f'chat-{i}', f'Chat {i}', json.dumps(messages))
+        )
+    return conn
+
+
+def test_migrates_empty_database_to_latest(conn):
+    applied = migrate(conn)
+
+    assert [version for version, _ in applied][-1] == migrations.SCHEMA_VERSION
+    assert migrations.get_schema_version(conn) == migrations.SCHEMA_VERSION
+    assert {'users', 'cloud_chats', 'chat_messages', 'chat_search', 'chat_search_rows'} <= table_names(conn)
+
+
+def test_migrations_run_once(conn):
+    migrate(conn)
+    assert migrate(conn) == []
+
+
+def test_search_index_is_contentless(baseline_conn):
+    migrate(baseline_conn)
+    # A contentless index keeps no copy of the text, only the tokens
+    bodies = baseline_conn.execute('SELECT body FROM chat_search').fetchall()
+    assert len(bodies) == 6
+    assert all(body is None for body, in bodies)
+
+
+def test_migrates_baseline_database(baseline_conn):
+    migrate(baseline_conn)
+
+    assert migrations.get_schema_version(baseline_conn) == migrations.SCHEMA_VERSION
+    stored = baseline_conn.execute(
+        'SELECT COUNT(*) FROM chat_messages WHERE user_id = 1 AND chat_id = ?', ('chat-1',)
+    ).fetchone()[0]
+    assert stored == 2
+    stats = baseline_conn.execute('SELECT chats, messages FROM user_chat_stats WHERE user_id = 1').fetchone()
+    assert stats == (3, 6)
+
+
+def test_baseline_messages_are_searchable(baseline_conn):
+    migrate(baseline_conn)
+
+    assert sorted(chat_search.indexed_chats(baseline_conn, 1)) == ['chat-0', 'chat-1', 'chat-2']
+    hits = chat_search.search(
+        baseline_conn, 1, 'headache', limit=10,
+        load_texts=lambda c, user_id, keys: {key: 'my headache' for key in keys},
+    )
+    assert {hit['chat_id'] for hit in hits} == {'chat-0', 'chat-1', 'chat-2'}
+    assert chat_search.search(baseline_conn, 2, 'headache', limit=10, load_texts=lambda *a: {}) == []
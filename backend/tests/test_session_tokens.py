@@ -0,0 +1,88 @@
+"""
+Tests for signed session tokens.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import json
+
+import pytest
+
+from session_tokens import SessionTokens, _b64encode
+
+USER = {'id': 7, 'email': 'ama@example.com'}
+
+
+@pytest.fixture
+def tokens():
+    return SessionTokens(b'test-secret', ttl=3600)
+
+
+class TestVerify:
+    def test_round_trip(self, tokens):
+        claims = tokens.verify(tokens.issue(USER))
+        assert (claims['uid'], claims['email']) == (7, 'ama@example.com')
+
+    def test_expired(self):
+        tokens = SessionTokens(b'test-secret', ttl=-1)
+        assert tokens.verify(tokens.issue(USER)) is None
+
+    def test_other_secret(self, tokens):
+        assert SessionTokens(b'other-secret').verify(tokens.issue(USER)) is None
+
+    def test_tampered_claims(self, tokens):
+        payload, signature = tokens.issue(USER).split('.')
+        claims = json.loads(json.dumps({'uid': 8, 'email': 'x@example.com', 'auth': 0, 'exp': 2 ** 40}))
+        forged = _b64encode(json.dumps(claims).encode('utf-8'))
+        assert tokens.verify(f'{forged}.{signature}') is None
+
+    @pytest.mark.parametrize('token', [
+        '', 'no-dot', 'a.b.c', None, 'é.x', 'x.é', '\udcff.x',
+    ])
+    def test_malformed(self, tokens, token):
+        assert tokens.verify(token) is None
+
+    def test_signed_non_object(self, tokens):
+        payload = _b64encode(b'[1, 2]')
+        assert tokens.verify(f'{payload}.{tokens._sign(payload)}') is None
+
+
+class TestGenerations:
+    def test_bumped_generation_revokes(self):
+        generations = {7: 0}
+        tokens = SessionTokens(b'test-secret', generation_of=generations.get)
+        token = tokens.issue(USER)
+        assert tokens.verify(token) is not None
+
+        generations[7] = 1
+        assert tokens.verify(token) is None
+        assert tokens.verify(tokens.issue(USER)) is not None
+
+    def test_deleted_user_is_revoked(self):
+        generations = {7: 0}
+        tokens = SessionTokens(b'test-secret', generation_of=generations.get)
+        token = tokens.issue(USER)
+        del generations[7]
+        assert tokens.verify(token) is None
+
+    def test_token_without_generation_counts_as_zero(self):
+        old_token = SessionTokens(b'test-secret').issue(USER)
+        assert SessionTokens(b'test-secret', generation_of={7: 0}.get).verify(old_token) is not None
+        assert SessionTokens(b'test-secret', generation_of={7: 1}.get).verify(old_token) is None
+
+
+class TestRevocation:
+    def test_password_reset_revokes_sessions(self, flask_app, user):
+        token = flask_app.session_tokens.issue(user)
+        assert flask_app.database.reset_password(user['email'], 'new-secret')['success']
+        assert flask_app.session_tokens.verify(token) is None
+
+    def test_account_deletion_revokes_sessions(self, flask_app, user):
+        token = flask_app.session_tokens.issue(user)
+        assert flask_app.database.delete_user_account(user['email'], 'secret123')['success']
+        assert flask_app.session_tokens.verify(token) is None
+
+    def test_revoked_token_is_refused(self, flask_app, user, client):
+        assert client.get('/api/chats/list').status_code == 200
+        flask_app.database.reset_password(user['email'], 'new-secret')
+        assert client.get('/api/chats/list').status_code == 401
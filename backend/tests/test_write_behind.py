@@ -0,0 +1,169 @@
+"""
+Tests for write-behind buffering of chat saves.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from write_behind import FlushFailed, PendingMarkers, WriteBehindBuffer
+
+
+def chat(chat_id, *contents):
+    return {'id': chat_id, 'title': f'Chat {chat_id}', 'messages': [{'role': 'user', 'content': c} for c in contents]}
+
+
+class TestBuffer:
+    def test_coalesces_saves_of_the_same_chat(self):
+        flushed = []
+        buffer = WriteBehindBuffer(lambda batch: flushed.append(batch), max_items=100, max_delay=60)
+        buffer.put(1, chat('a', 'one'))
+        buffer.put(1, chat('a', 'one', 'two'))
+        buffer.flush()
+
+        assert flushed == [{'1': [chat('a', 'one', 'two')]}]
+        assert buffer.stats()['coalesced'] == 1
+
+    def test_flush_failed_keeps_only_failed_users(self):
+        attempts = []
+
+        def flush_func(batch):
+            attempts.append(sorted(batch))
+            if len(attempts) == 1:
+                raise FlushFailed('database is locked', ['2'], dropped=1)
+            return 0
+
+        buffer = WriteBehindBuffer(flush_func, max_items=100, max_delay=60)
+        buffer.put(1, chat('a'))
+        buffer.put(2, chat('b'))
+        with pytest.raises(FlushFailed):
+            buffer.flush()
+        assert buffer.stats()['pending'] == 1
+
+        buffer.flush()
+        assert attempts == [['1', '2'], ['2']]
+        stats = buffer.stats()
+        assert (stats['pending'], stats['dropped'], stats['chats_written']) == (0, 1, 1)
+
+    def test_dropped_saves_are_counted(self):
+        buffer = WriteBehindBuffer(lambda batch: 1, max_items=100, max_delay=60)
+        buffer.put(1, chat('a'))
+        buffer.put(1, chat('b'))
+        buffer.flush()
+
+        stats = buffer.stats()
+        assert (stats['pending'], stats['dropped'], stats['chats_written']) == (0, 1, 1)
+
+
+class TestMarkers:
+    def test_marks_until_cleared(self, tmp_path):
+        markers = PendingMarkers(str(tmp_path), wait_seconds=0)
+        markers.forget_process()
+        markers.mark(7)
+        markers.mark(7)
+        markers.mark(8)
+        assert sorted((tmp_path / str(os.getpid())).read_text().split()) == ['7', '8']
+
+        markers.clear([7])
+        assert (tmp_path / str(os.getpid())).read_text().split() == ['8']
+        markers.clear([8])
+        assert not (tmp_path / str(os.getpid())).exists()
+
+    def test_waits_for_other_live_process(self, tmp_path):
+        (tmp_path / str(os.getppid())).write_text('7\n')
+        markers = PendingMarkers(str(tmp_path), wait_seconds=0.1)
+
+        markers.wait_for(8)
+        assert markers.timeouts == 0
+        markers.wait_for(7)
+        assert markers.timeouts == 1
+
+    def test_ignores_dead_process(self, tmp_path):
+        child = subprocess.Popen([sys.executable, '-c', 'pass'])
+        child.wait()
+        (tmp_path / str(child.pid)).write_text('7\n')
+        markers = PendingMarkers(str(tmp_path), wait_seconds=5)
+
+        markers.wait_for(7)
+        assert markers.timeouts == 0
+        assert not (tmp_path / str(child.pid)).exists()
+
+
+class TestDatabaseFlush:
+    @pytest.fixture
+    def database(self):
+        import database
+        database.chat_writer.flush()
+        return database
+
+    @pytest.fixture
+    def failing_chat(self, database, monkeypatch):
+        """Make every write of chat 'bad' fail the way a corrupt row would"""
+        write = database._write_chat_messages
+
+        def write_chat_messages(conn, user_id, chat_id, *args):
+            if chat_id == 'bad':
+                raise sqlite3.IntegrityError('constraint failed')
+            return write(conn, user_id, chat_id, *args)
+
+        monkeypatch.setattr(database, '_write_chat_messages', write_chat_messages)
+
+    def stored_titles(self, database, user_id):
+        return {chat_id: c['title'] for chat_id, c in database.get_user_chats_from_cloud(user_id).items()}
+
+    def test_failing_chat_is_dropped_without_blocking_others(self, database, failing_chat):
+        database.save_chat_to_cloud(101, chat('bad', 'x'))
+        database.save_chat_to_cloud(101, chat('good', 'y'))
+        database.save_chat_to_cloud(102, chat('other', 'z'))
+        database.flush_pending_saves(101)
+        database.chat_writer.flush()
+
+        assert self.stored_titles(database, 101) == {'good': 'Chat good'}
+        assert self.stored_titles(database, 102) == {'other': 'Chat other'}
+        assert database.chat_writer.stats()['pending'] == 0
+
+        database.save_chat_to_cloud(101, chat('later', 'w'))
+        database.flush_pending_saves(101)
+        assert 'later' in self.stored_titles(database, 101)
+
+    def test_locked_database_keeps_saves_queued(self, database, monkeypatch):
+        sync = database.sync_chats_to_cloud
+
+        def locked(*args, **kwargs):
+            raise sqlite3.OperationalError('database is locked')
+
+        database.save_chat_to_cloud(103, chat('queued', 'hello'))
+        monkeypatch.setattr(database, 'sync_chats_to_cloud', locked)
+        with pytest.raises(FlushFailed):
+            database.flush_pending_saves(103)
+        assert database.chat_writer.stats()['pending'] == 1
+
+        monkeypatch.setattr(database, 'sync_chats_to_cloud', sync)
+        database.flush_pending_saves(103)
+        assert self.stored_titles(database, 103) == {'queued': 'Chat queued'}
+
+
+class TestReadYourWrites:
+    @pytest.fixture(autouse=True)
+    def locked(self, flask_app, monkeypatch):
+        flask_app.database.chat_writer.flush()
+
+        def flush_pending_saves(user_id):
+            raise FlushFailed('database is locked', [user_id])
+
+        monkeypatch.setattr(flask_app.database, 'flush_pending_saves', flush_pending_saves)
+
+    def test_reads_serve_committed_chats(self, client):
+        response = client.get('/api/chats/list')
+        assert response.status_code == 200
+        assert response.json['success'] is True
+
+    def test_writes_are_refused(self, client):
+        response = client.post('/api/chats/sync', json={'chats': [chat('c')]})
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
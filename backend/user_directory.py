@@ -0,0 +1,108 @@
+"""
+User Directory Module
+In-process index of registered emails and usernames.
+
+Registration, email checks during password reset and profile updates ask
+"does this email / username exist?" far more often than users change.
+The directory answers those from memory. A trigger-maintained counter in
+the users_version table tells it when another process changed the users
+table, and it re-checks that counter at most every MAX_AGE seconds.
+Writes made through database.py update the directory directly.
+
+Answers can lag other processes by up to MAX_AGE, so the UNIQUE
+constraints on users stay the final word on duplicates.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import time
+import threading
+
+# Longest time a cached answer may miss changes made by other processes
+MAX_AGE = float(os.environ.get('USER_DIRECTORY_MAX_AGE', 1.0))
+
+
+class UserDirectory:
+    """email -> (id, username) and username -> id, kept in sync with the users table"""
+
+    def __init__(self, get_connection, max_age: float = MAX_AGE):
+        self._get_connection = get_connection
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._by_email = {}
+        self._by_username = {}
+        self._version = None  # users_version the maps reflect; None forces a reload
+        self._checked = 0.0
+        self.reloads = 0
+
+    @staticmethod
+    def version(conn) -> int:
+        """Current users_version; read it inside the transaction that changes users"""
+        return conn.execute('SELECT version FROM users_version').fetchone()[0]
+
+    def refresh(self, force: bool = False):
+        """Reload from the database if the users table changed since the last load"""
+        now = time.monotonic()
+        if not force and self._version is not None and now - self._checked < self.max_age:
+            return
+
+        conn = self._get_connection()
+        version = self.version(conn)
+        with self._lock:
+            self._checked = now
+            if version == self._version and not force:
+                return
+
+        rows = conn.execute('SELECT id, email, username FROM users').fetchall()
+        by_email = {email: (user_id, username) for user_id, email, username in rows}
+        by_username = {username: user_id for user_id, email, username in rows}
+        with self._lock:
+            self._by_email = by_email
+            self._by_username = by_username
+            self._version = version
+        self.reloads += 1
+
+    def lookup_email(self, email):
+        """Return (id, username) for an email, or None"""
+        self.refresh()
+        return self._by_email.get(email)
+
+    def lookup_username(self, username):
+        """Return the id of a username, or None"""
+        self.refresh()
+        return self._by_username.get(username)
+
+    def apply(self, before: int, after: int, removed=None, added=None):
+        """
+        Record a committed change to users.
+
+        before/after are users_version read at the start and end of the
+        writing transaction. If the directory was not at `before`, some
+        other change was missed and it reloads instead.
+
+        Args:
+            removed: (email, username) that no longer exists
+            added: (id, email, username) that now exists
+        """
+        with self._lock:
+            if self._version != before:
+                self._version = None
+                return
+            if removed:
+                email, username = removed
+                self._by_email.pop(email, None)
+                self._by_username.pop(username, None)
+            if added:
+                user_id, email, username = added
+                self._by_email[email] = (user_id, username)
+                self._by_username[username] = user_id
+            self._version = after
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'users': len(self._by_email),
+                'version': self._version,
+                'reloads': self.reloads,
+            }
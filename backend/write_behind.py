@@ -0,0 +1,377 @@
+"""
+Write-Behind Module
+Coalescing buffer for chat saves.
+
+The frontend re-saves a chat every few seconds while it changes, so most
+saves are superseded moments later. Saves are buffered per process keyed
+by (user_id, chat_id), keeping only the latest version, and a flusher
+thread commits everything buffered in one transaction once the oldest
+entry is max_delay seconds old or max_items chats are waiting.
+
+Durability: the buffer is flushed at interpreter exit and on SIGTERM, and
+a user's pending saves are flushed before any of their chats are read or
+changed, so clients always see their own writes. Saves buffered in other
+gunicorn workers are tracked in small per-process files (see
+PendingMarkers); a read waits for them to be committed.
+
+Failures: flush_func decides what is retried. The database flush keeps a
+save queued only while the database is locked or busy; a chat that fails
+for any other reason would fail forever and is dropped with a log line.
+
+Author: Annor Prince & Collins Yeboah
+"""
+
+import os
+import time
+import atexit
+import signal
+import threading
+import traceback
+from typing import Callable, Dict, List
+
+# Interval at which a read re-checks saves pending in other worker processes
+POLL_INTERVAL = 0.05
+
+
+class FlushFailed(Exception):
+    """Raised by a flush_func when some users' saves could not be committed yet; only those stay queued"""
+
+    def __init__(self, message: str, failed_users, dropped: int = 0):
+        super().__init__(message)
+        self.failed_users = {str(user_id) for user_id in failed_users}
+        self.dropped = dropped  # saves of the other users that were given up on
+
+
+class PendingMarkers:
+    """
+    Which users have saves buffered in which worker process, so every
+    worker can see them. Each process lists its users in a file named
+    after its pid in directory: a user's first buffered save appends one
+    line, and the file is rewritten when a flush commits users' saves.
+    - directory: shared by every worker of the deployment
+    - wait_seconds: longest a read waits for another worker's saves
+    """
+
+    def __init__(self, directory: str, wait_seconds: float):
+        self.directory = directory
+        self.wait_seconds = wait_seconds
+        self.timeouts = 0
+        self._pid = None  # process the users below belong to
+        self._users = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, pid) -> str:
+        return os.path.join(self.directory, str(pid))
+
+    def forget_process(self):
+        """Drop markers left by an earlier process that had this pid"""
+        self._pid = os.getpid()
+        self._users = set()
+        try:
+            os.remove(self._path(self._pid))
+        except FileNotFoundError:
+            pass
+
+    def mark(self, user_id):
+        """Record that this process holds saves of user_id"""
+        if self._pid != os.getpid():
+            # First mark since a fork: the parent's users are not ours
+            self.forget_process()
+        user_id = str(user_id)
+        if user_id in self._users:
+            return
+        # Visible to other processes once written; no fsync, a crash loses the buffer anyway
+        with open(self._path(self._pid), 'a', encoding='utf-8') as f:
+            f.write(user_id + '\n')
+        self._users.add(user_id)
+
+    def clear(self, user_ids):
+        """This process no longer holds saves of these users"""
+        if self._pid != os.getpid():
+            return
+        done = self._users.intersection(str(user_id) for user_id in user_ids)
+        if not done:
+            return
+        self._users.difference_update(done)
+        path = self._path(self._pid)
+        if not self._users:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(user_id + '\n' for user_id in self._users))
+        os.replace(temp_path, path)
+
+    def _holders(self, user_id: str) -> list:
+        """Other live processes that hold saves of user_id; files of dead ones are removed"""
+        holders = []
+        for name in os.listdir(self.directory):
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            pid = int(name)
+            if not _process_alive(pid):
+                # Its buffer died with it; nothing left to wait for
+                try:
+                    os.remove(self._path(pid))
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(self._path(pid), encoding='utf-8') as f:
+                    if user_id in f.read().split('\n'):
+                        holders.append(pid)
+            except FileNotFoundError:
+                pass  # Cleared meanwhile
+        return holders
+
+    def wait_for(self, user_id):
+        """Wait until no other live process holds saves of user_id"""
+        user_id = str(user_id)
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            pids = self._holders(user_id)
+            if not pids:
+                return
+            if time.monotonic() >= deadline:
+                self.timeouts += 1
+                print(f"⚠️ Saves of user {user_id} still pending in process(es) {pids}, reading without them")
+                return
+            time.sleep(POLL_INTERVAL)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WriteBehindBuffer:
+    """
+    Per-process buffer of pending chat saves.
+    - flush_func: called with {user_id: [chat, ...]}, returns how many saves
+      it gave up on; raising keeps the batch queued, raising FlushFailed
+      keeps only the failed users' saves
+    - max_items: flush as soon as this many chats are buffered
+    - max_delay: longest a save waits in the buffer (seconds)
+    - markers: shares which users have pending saves with other processes
+    """
+
+    def __init__(self, flush_func: Callable[[Dict[str, List[dict]]], int], max_items: int, max_delay: float,
+                 markers: PendingMarkers = None):
+        self.flush_func = flush_func
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.markers = markers
+        self._mark_lock = threading.Lock()  # orders marker writes with the buffer changes they describe
+
+        self._pending = {}  # (user_id, chat_id) -> chat, insertion ordered
+        self._oldest = None  # monotonic time the oldest pending save arrived
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one flush at a time keeps saves in order
+        self._thread = None
+        self._closed = False
+
+        self.saves = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.chats_written = 0
+        self.dropped = 0
+        self.last_error = None
+
+        if markers is not None:
+            try:
+                markers.forget_process()
+            except OSError as e:
+                print(f"⚠️ Could not reset pending-save markers: {e}")
+
+    def put(self, user_id, chat: dict):
+        """Buffer a chat save, replacing any pending save of the same chat"""
+        key = (str(user_id), str(chat['id']))
+        with self._mark_lock:
+            self._mark(key[0])
+            self._put(key, chat)
+
+        self._ensure_thread()
+        if self._closed:
+            # Saved after shutdown began - nobody else will flush it
+            self.flush()
+
+    def _put(self, key, chat: dict):
+        with self._cond:
+            self.saves += 1
+            if key in self._pending:
+                self.coalesced += 1
+                del self._pending[key]  # Re-insert so flush order follows the latest save
+            self._pending[key] = chat
+            if self._oldest is None:
+                # Wake the idle flusher so it starts the max_delay countdown
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif len(self._pending) >= self.max_items:
+                self._cond.notify()
+
+    def _mark(self, user_id: str):
+        """Tell other processes this one holds saves of user_id (call with _mark_lock held)"""
+        if self.markers is None:
+            return
+        try:
+            self.markers.mark(user_id)
+        except OSError as e:
+            print(f"⚠️ Could not record pending saves of user {user_id}: {e}")
+
+    def _unmark_flushed(self, user_ids):
+        """Drop the markers of users whose saves are all committed"""
+        if self.markers is None:
+            return
+        with self._mark_lock:
+            with self._cond:
+                still_pending = {key[0] for key in self._pending}
+            done = [user_id for user_id in user_ids if user_id not in still_pending]
+            try:
+                self.markers.clear(done)
+            except OSError as e:
+                print(f"⚠️ Could not clear pending-save markers: {e}")
+
+    def flush(self, user_id=None):
+        """Commit pending saves now - all of them, or only one user's"""
+        with self._flush_lock:
+            with self._cond:
+                if user_id is None:
+                    taken, self._pending = self._pending, {}
+                else:
+                    user_id = str(user_id)
+                    taken = {key: chat for key, chat in self._pending.items() if key[0] == user_id}
+                    for key in taken:
+                        del self._pending[key]
+                if not self._pending:
+                    self._oldest = None
+            if not taken:
+                return
+
+            batch = {}
+            for (owner, _chat_id), chat in taken.items():
+                batch.setdefault(owner, []).append(chat)
+
+            try:
+                dropped = self.flush_func(batch) or 0
+            except Exception as e:
+                dropped = 0
+                if isinstance(e, FlushFailed):
+                    kept = {key: chat for key, chat in taken.items() if key[0] in e.failed_users}
+                    dropped = e.dropped
+                else:
+                    kept = taken
+                self.last_error = str(e)
+                self.chats_written += len(taken) - len(kept) - dropped
+                self.dropped += dropped
+                print(f"❌ Write-behind flush failed, {len(kept)} chats kept for retry: {e}")
+                traceback.print_exc()
+                with self._cond:
+                    # Put the failed saves back unless newer saves replaced them meanwhile
+                    for key, chat in kept.items():
+                        self._pending.setdefault(key, chat)
+                    if self._pending and self._oldest is None:
+                        self._oldest = time.monotonic()
+                self._unmark_flushed(set(batch) - {key[0] for key in kept})
+                raise
+
+            self.flushes += 1
+            self.chats_written += len(taken) - dropped
+            self.dropped += dropped
+            self.last_error = None
+            self._unmark_flushed(set(batch))
+
+    def flush_user(self, user_id):
+        """
+        Read-your-writes: commit one user's pending saves before reading
+        their chats, and wait for saves other processes still hold
+        """
+        if self._pending:
+            self.flush(user_id)
+        if self.markers is not None:
+            try:
+                self.markers.wait_for(user_id)
+            except OSError as e:
+                print(f"⚠️ Could not check saves pending in other workers: {e}")
+
+    def discard_user(self, user_id):
+        """Drop one user's pending saves (their account is being deleted)"""
+        user_id = str(user_id)
+        with self._flush_lock:
+            with self._cond:
+                for key in [key for key in self._pending if key[0] == user_id]:
+                    del self._pending[key]
+                if not self._pending:
+                    self._oldest = None
+            self._unmark_flushed([user_id])
+
+    def close(self):
+        """Flush everything and stop accepting delayed saves (shutdown)"""
+        self._closed = True
+        with self._cond:
+            self._cond.notify()
+        try:
+            self.flush()
+        except Exception:
+            pass  # Already reported by flush()
+
+    def install_shutdown_hooks(self):
+        """Flush at interpreter exit, and on SIGTERM when nothing else handles it"""
+        atexit.register(self.close)
+
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+            # e.g. gunicorn workers, which exit normally and run atexit
+            return
+
+        def on_sigterm(signum, frame):
+            self.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.raise_signal(signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'saves': self.saves,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'chats_written': self.chats_written,
+            'dropped': self.dropped,
+            'last_error': self.last_error,
+            'read_wait_timeouts': self.markers.timeouts if self.markers is not None else None,
+        }
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._cond:
+                if self._thread is None or not self._thread.is_alive():
+                    # Also restarts the flusher in forked worker processes
+                    self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            with self._cond:
+                if self._oldest is None:
+                    self._cond.wait()
+                    continue
+                wait = self._oldest + self.max_delay - time.monotonic()
+                if wait > 0 and len(self._pending) < self.max_items:
+                    self._cond.wait(wait)
+                    continue
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(self.max_delay)  # Database trouble - back off before retrying